@@ -0,0 +1,166 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+import threading
+import warnings
+
+import numpy as np
+
+
+class DynaboardTensor:
+    """
+    Everything that is needed to render a dynaboard, loaded once from the db.
+
+    values has the shape (number of models, number of datasets, number of metrics),
+    where datasets and metrics follow the order of the leaderboard. Only models that
+    have a complete set of scores are kept.
+    """
+
+    def __init__(self, model_infos, dataset_infos, field_names, values):
+        self.model_infos = model_infos
+        self.dataset_infos = dataset_infos
+        self.field_names = field_names
+        self.values = values
+
+    @classmethod
+    def empty(cls, field_names):
+        return cls([], [], field_names, np.zeros((0, 0, len(field_names))))
+
+    def __len__(self):
+        return len(self.model_infos)
+
+    def average_over_datasets(self, dataset_weights):
+        # This is a weighted sum, summed in dataset order, to give exactly the same
+        # results as the dataframe based implementation that it replaces.
+        averaged = np.zeros((len(self), len(self.field_names)))
+        for index, weight in enumerate(dataset_weights):
+            averaged += weight * self.values[:, index, :]
+        return averaged
+
+
+class DynaboardCache:
+    """
+    Entries are stored along with the version of the task's leaderboard rows that
+    they were loaded from, so that writes made by other processes (e.g. the eval
+    server) are noticed with a single cheap query. Writes made by this process
+    also drop the entries of the task right away.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_version, tensor = entry
+            if entry_version != version:
+                del self._entries[key]
+                return None
+            return tensor
+
+    def set(self, key, version, tensor):
+        with self._lock:
+            self._entries[key] = (version, tensor)
+
+    def invalidate(self, tid):
+        # Keys always start with the task id.
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == tid]:
+                del self._entries[key]
+
+
+dynaboard_cache = DynaboardCache()
+
+
+# calculate the dynascore
+# normalization is automatically done via AMRS
+# e.g., raw FLOPs are on the scale of 10e7 but the AMRS-converted compute is
+# at approximately the same scale as all the other metrics (not necessarily
+# in a fixed range like [0, 100], though)
+def dynascore(
+    perf_index,
+    data,
+    weights,
+    direction_multipliers,
+    offsets,
+    delta_cutoff_proportion=0.0001,
+):
+    """
+    data is a (number of models, number of metrics) array, and weights,
+    direction_multipliers and offsets are sequences with one entry per metric.
+    Returns the AMRS-normalized data and the dynascore of every model, both in the
+    row order of data.
+    """
+    data = np.asarray(data, dtype=float)
+    n_models, n_metrics = data.shape
+    if n_models == 0:
+        return data.copy(), np.zeros(0)
+
+    converted_data = data * np.asarray(direction_multipliers) + np.asarray(offsets)
+
+    # Sort like pandas does with sort_values: quicksort, with nans at the end.
+    perf = data[:, perf_index]
+    nan_mask = np.isnan(perf)
+    non_nan_rows = np.flatnonzero(~nan_mask)
+    order = np.concatenate(
+        [
+            non_nan_rows[perf[non_nan_rows].argsort(kind="quicksort")],
+            np.flatnonzero(nan_mask),
+        ]
+    )
+
+    # We don't want small denominators to make AMRS super sensitive to noise in
+    # the model submissions.
+    delta = np.full((n_models, n_metrics), np.nan)
+    delta[1:] = np.diff(converted_data[order], axis=0)
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        delta_threshold = np.nanmax(converted_data[:, perf_index])
+        delta_threshold *= delta_cutoff_proportion
+        satisfied = np.abs(delta[:, perf_index]) > delta_threshold
+        satisfied_delta = delta[satisfied]
+        AMRS = np.nanmean(
+            np.abs(satisfied_delta) / satisfied_delta[:, [perf_index]], axis=0
+        )
+
+        converted_data = converted_data / np.abs(AMRS)
+        weights = np.asarray(weights, dtype=float)
+        weights = weights / weights.sum()
+        scores = np.zeros(n_models)
+        for metric_index in range(n_metrics):
+            scores += converted_data[:, metric_index] * weights[metric_index]
+
+    return converted_data, scores
+
+
+def nan_to_zero(value):
+    # It is possible for the dynascore to be nan if the leaderboard is
+    # uninteresting. For example, if, for any metric, all models on the leaderboard
+    # have that metric as 0. In these cases, dynascores for all models will be nan.
+    value = float(value)
+    return value if not math.isnan(value) else 0
+
+
+def top_k_order(keys, k, reverse=False):
+    """
+    Returns the indices of the first k items of a stable sort of keys, i.e. ties
+    keep their original order, as with list.sort. NaN keys go last. Only the items
+    that can make it into the first k are sorted.
+    """
+    keys = np.asarray(keys, dtype=float)
+    if reverse:
+        keys = -keys
+    is_nan = np.isnan(keys)
+    finite = np.flatnonzero(~is_nan)
+    if k <= len(finite) and k < len(keys):
+        kth_key = np.partition(keys[finite], k - 1)[k - 1]
+        candidates = finite[keys[finite] <= kth_key]
+    else:
+        candidates = np.arange(len(keys))
+    order = np.lexsort((candidates, keys[candidates], is_nan[candidates]))
+    return candidates[order][:k]
@@ -192,6 +192,40 @@ def read_file_content(file_obj, max_limit):
     return b"".join(data_blocks)
 
 
+class JsonlDecodeError(ValueError):
+    def __init__(self, line_number):
+        super().__init__(f"Could not parse line {line_number}")
+        self.line_number = line_number
+
+
+def iter_jsonl(file_obj):
+    """
+    Yields (line number, decoded object) for every line of a binary jsonl file
+    object, reading it one line at a time so that large uploads never have to be
+    held in memory. Raises JsonlDecodeError if a line is not utf-8 encoded json.
+    """
+    for line_number, line in enumerate(file_obj, 1):
+        try:
+            obj = json_decode(line.decode("utf-8"))
+        except ValueError as ex:
+            raise JsonlDecodeError(line_number) from ex
+        yield line_number, obj
+
+
+def format_line_errors(line_errors, max_errors=50):
+    """
+    Formats a list of (line number, error message) tuples, e.g. for the lines of
+    an uploaded jsonl, into a single message for an error response.
+    """
+    messages = [
+        f"line {line_number}: {message}"
+        for line_number, message in line_errors[:max_errors]
+    ]
+    if len(line_errors) > max_errors:
+        messages.append(f"... and {len(line_errors) - max_errors} more errors")
+    return "\n".join(messages)
+
+
 def get_round_data_for_export(tid, rid):
     e = ExampleModel()
     examples_with_validation_ids = e.getByTidAndRidWithValidationIds(tid, rid)
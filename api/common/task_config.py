@@ -0,0 +1,85 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+
+import yaml
+
+
+def get_name_to_full_annotation_config_obj(config):
+    name_to_config_obj = {}
+
+    # It is important that output is first in this list, so that objects with the same
+    # name in input and context overwrite those from output in name_to_config_obj.
+    # This is because config objects in output can be abbreviated to only contain
+    # the name and none of the other arguments, as long as the name is from
+    # a config object in input or context. We need to get the full information from
+    # the input or context.
+    annotation_config_objs = (
+        config.get("output", [])
+        + config.get("input", [])
+        + config.get("context", [])
+        + config.get("metadata", {}).get("create", [])
+        + config.get("metadata", {}).get("validate", [])
+    )
+
+    for obj in annotation_config_objs:
+        name_to_config_obj[obj["name"]] = obj
+    return name_to_config_obj
+
+
+class TaskConfig:
+    """
+    A parsed config_yaml, along with the structures derived from it that are needed
+    on hot paths. Instances are shared by everything that reads the config of the
+    task in this process, so they must not be mutated.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.name_to_full_annotation_config_obj = (
+            get_name_to_full_annotation_config_obj(config)
+        )
+        self.name_to_type = {
+            name: obj["type"]
+            for name, obj in self.name_to_full_annotation_config_obj.items()
+        }
+        self.input_names = [obj["name"] for obj in config.get("input", [])]
+        self.output_names = [obj["name"] for obj in config.get("output", [])]
+        self.context_names = [obj["name"] for obj in config.get("context", [])]
+        perf_metric = config.get("perf_metric", {})
+        self.perf_metric_type = perf_metric.get("type")
+        self.perf_metric_reference_name = perf_metric.get("reference_name")
+        self.delta_metric_types = [
+            obj["type"] for obj in config.get("delta_metrics", [])
+        ]
+        self.batch_transform = config.get("batch_transform", {})
+        # Filled in lazily by Task.get_annotation_validator, keyed by mode.
+        self.annotation_validators = {}
+
+
+_task_configs = {}
+_task_configs_lock = threading.Lock()
+
+
+def get_task_config(task):
+    """
+    Returns the TaskConfig of a task, i.e. of anything with a config_yaml attribute.
+    The yaml is only parsed once per process for a given task id and config.
+    """
+    config_yaml = task.config_yaml
+    key = (getattr(task, "id", None), hash(config_yaml))
+    entry = _task_configs.get(key)
+    if entry is None or entry[0] != config_yaml:
+        entry = (config_yaml, TaskConfig(yaml.load(config_yaml, yaml.SafeLoader)))
+        with _task_configs_lock:
+            _task_configs[key] = entry
+    return entry[1]
+
+
+def invalidate_task_config(tid):
+    """Drops the parsed configs of a task, e.g. after its config_yaml changed."""
+    with _task_configs_lock:
+        for key in [key for key in _task_configs if key[0] == tid]:
+            del _task_configs[key]
@@ -5,11 +5,11 @@
 from urllib.parse import parse_qs
 
 import bottle
-import yaml
 
 import common.auth as _auth
 import common.helpers as util
 from common.logging import logger
+from common.task_config import get_task_config
 from models.context import Context, ContextModel
 from models.round import RoundModel
 from models.task import TaskModel
@@ -17,6 +17,9 @@ from models.task import TaskModel
 from .tasks import ensure_owner_or_admin
 
 
+CONTEXT_INSERT_BATCH_SIZE = 1000
+
+
 @bottle.get("/contexts/<tid:int>/<rid:int>")
 @bottle.get("/contexts/<tid:int>/<rid:int>/min")
 @_auth.turk_endpoint
@@ -96,48 +99,55 @@ def do_upload(credentials, tid, rid):
 
     tm = TaskModel()
     task = tm.get(tid)
+    context_names = get_task_config(task).context_names
 
+    # The upload is streamed twice, once to verify it and once to insert the
+    # contexts, so that it never has to be held in memory.
+    validator = task.get_annotation_validator()
+    line_errors = []
     try:
-        parsed_upload_data = [
-            util.json_decode(line)
-            for line in upload.file.read().decode("utf-8").splitlines()
-        ]
-
-    except Exception as ex:
+        for line_number, context_info in util.iter_jsonl(upload.file):
+            try:
+                assert (
+                    "context" in context_info
+                ), "there must be a field called 'context' on every line of the jsonl"
+                assert (
+                    "tag" in context_info
+                ), "there must be a field called 'tag' on every line of the jsonl"
+                assert (
+                    "metadata" in context_info
+                ), "there must be a field called 'metadata' on every line of the jsonl"
+                assert isinstance(
+                    context_info["metadata"], dict
+                ), "'metadata' must be a dict on every line of the jsonl"
+                for name in context_names:
+                    assert name in context_info["context"], (
+                        "for every line, 'context' must have all of the context"
+                        + " fields defined in the task's config"
+                    )
+            except Exception as ex:
+                line_errors.append((line_number, str(ex)))
+                continue
+
+            for message in validator.verify(context_info["context"]):
+                line_errors.append((line_number, message))
+    except util.JsonlDecodeError as ex:
         logger.exception(ex)
-        bottle.abort(400, "Could not parse contexts file. Is it a utf-8 jsonl?")
-
-    for context_info in parsed_upload_data:
-        try:
-            assert (
-                "context" in context_info
-            ), "there must be a field called 'context' on every line of the jsonl"
-            assert (
-                "tag" in context_info
-            ), "there must be a field called 'tag' on every line of the jsonl"
-            assert (
-                "metadata" in context_info
-            ), "there must be a field called 'metadata' on every line of the jsonl"
-            assert isinstance(
-                context_info["metadata"], dict
-            ), "'metadata' must be a dict on every line of the jsonl"
-            for item in yaml.load(task.config_yaml, yaml.SafeLoader).get("context", []):
-                assert item["name"] in context_info["context"], (
-                    "for every line, 'context' must have all of the context fields"
-                    + " defined in the task's config"
-                )
-        except Exception as ex:
-            bottle.abort(400, str(ex))
-
-        verified, message = task.verify_annotation(context_info["context"])
-        if not verified:
-            bottle.abort(400, message)
+        bottle.abort(
+            400,
+            f"Could not parse contexts file at line {ex.line_number}."
+            + " Is it a utf-8 jsonl?",
+        )
+
+    if line_errors:
+        bottle.abort(400, util.format_line_errors(line_errors))
 
     rm = RoundModel()
     round = rm.getByTidAndRid(tid, rid)
     r_realid = round.id
     contexts_to_add = []
-    for context_info in parsed_upload_data:
+    upload.file.seek(0)
+    for _, context_info in util.iter_jsonl(upload.file):
         c = Context(
             r_realid=r_realid,
             context_json=util.json_encode(context_info["context"]),
@@ -145,6 +155,9 @@ def do_upload(credentials, tid, rid):
             tag=context_info["tag"],
         )
         contexts_to_add.append(c)
+        if len(contexts_to_add) == CONTEXT_INSERT_BATCH_SIZE:
+            rm.dbs.bulk_save_objects(contexts_to_add)
+            contexts_to_add = []
 
     rm.dbs.bulk_save_objects(contexts_to_add)
     rm.dbs.commit()
@@ -9,13 +9,13 @@ import tempfile
 
 import boto3
 import bottle
-import yaml
 from bottle import response
 
 import common.auth as _auth
 import common.helpers as util
 from common.config import config
 from common.logging import logger
+from common.task_config import get_task_config
 from models.dataset import AccessTypeEnum, DatasetModel, LogAccessTypeEnum
 from models.score import ScoreModel
 from models.task import AnnotationVerifierMode, TaskModel
@@ -87,13 +87,7 @@ def delete(credentials, did):
     for score in scores_to_delete:
         sm.delete(score)
 
-    delta_metric_types = [
-        config["type"]
-        for config in yaml.load(task.config_yaml, yaml.SafeLoader).get(
-            "delta_metrics", []
-        )
-    ]
-    delta_metric_types.append(None)
+    delta_metric_types = get_task_config(task).delta_metric_types + [None]
 
     s3_client = boto3.client(
         "s3",
@@ -143,12 +137,7 @@ def create(credentials, tid, name):
     task = tm.get(tid)
 
     delta_dataset_uploads = []
-    delta_metric_types = [
-        config["type"]
-        for config in yaml.load(task.config_yaml, yaml.SafeLoader).get(
-            "delta_metrics", []
-        )
-    ]
+    delta_metric_types = get_task_config(task).delta_metric_types
     for delta_metric_type in delta_metric_types:
         delta_dataset_uploads.append(
             (bottle.request.files.get(delta_metric_type), delta_metric_type)
@@ -156,61 +145,75 @@ def create(credentials, tid, name):
 
     uploads = [(dataset_upload, None)] + delta_dataset_uploads
 
-    parsed_uploads = []
-    # Ensure correct format
-    for upload, perturb_prefix in uploads:
-        try:
-            parsed_upload = [
-                util.json_decode(line)
-                for line in upload.file.read().decode("utf-8").splitlines()
-            ]
-        except Exception as ex:
-            logger.exception(ex)
-            bottle.abort(400, "Could not parse dataset file. Is it a utf-8 jsonl?")
-
-        for io in parsed_upload:
-            try:
-                assert "uid" in io, "'uid' must be present for every example"
-                assert (
-                    "tags" in io
-                ), "there must be a field called 'tags' on every line of the jsonl"
-                assert isinstance(
-                    io["tags"], list
-                ), "'tags' must be a list on every line of the jsonl"
-                if perturb_prefix is not None:
-                    assert "input_id" in io, (
-                        "'input_id' must be present for every example for"
-                        + " perturbed dataset uploads"
+    validator = task.get_annotation_validator(AnnotationVerifierMode.dataset_upload)
+    spooled_uploads = []
+    try:
+        # Ensure correct format, while streaming the converted examples to local
+        # files so that the uploads never have to be held in memory.
+        for upload, perturb_prefix in uploads:
+            line_errors = []
+            with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
+                spooled_uploads.append((tmp.name, perturb_prefix))
+                try:
+                    for line_number, io in util.iter_jsonl(upload.file):
+                        try:
+                            assert (
+                                "uid" in io
+                            ), "'uid' must be present for every example"
+                            assert "tags" in io, (
+                                "there must be a field called 'tags' on every line"
+                                + " of the jsonl"
+                            )
+                            assert isinstance(
+                                io["tags"], list
+                            ), "'tags' must be a list on every line of the jsonl"
+                            if perturb_prefix is not None:
+                                assert "input_id" in io, (
+                                    "'input_id' must be present for every example"
+                                    + " for perturbed dataset uploads"
+                                )
+                        except Exception as ex:
+                            line_errors.append((line_number, str(ex)))
+
+                        for message in validator.verify(io):
+                            line_errors.append((line_number, message))
+
+                        if not line_errors:
+                            try:
+                                datum = task.convert_to_model_io(io)
+                            except Exception as ex:
+                                logger.exception(ex)
+                                line_errors.append(
+                                    (line_number, "could not convert the example")
+                                )
+                            else:
+                                tmp.write(util.json_encode(datum) + "\n")
+                except util.JsonlDecodeError as ex:
+                    logger.exception(ex)
+                    bottle.abort(
+                        400,
+                        f"Could not parse dataset file at line {ex.line_number}."
+                        + " Is it a utf-8 jsonl?",
                     )
-            except Exception as ex:
-                bottle.abort(400, str(ex))
 
-            verified, message = task.verify_annotation(
-                io, mode=AnnotationVerifierMode.dataset_upload
-            )
-            if not verified:
-                bottle.abort(400, message)
-        parsed_uploads.append((parsed_upload, perturb_prefix))
+            if line_errors:
+                bottle.abort(400, util.format_line_errors(line_errors))
 
-    # Upload to s3
+        # Upload to s3
 
-    if task.is_decen_task:
-        s3_paths = []
-
-    for parsed_upload, perturb_prefix in parsed_uploads:
-        try:
-            s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=config["eval_aws_access_key_id"],
-                aws_secret_access_key=config["eval_aws_secret_access_key"],
-                region_name=config["eval_aws_region"],
-            )
-            with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-                for datum in parsed_upload:
-                    tmp.write(util.json_encode(task.convert_to_model_io(datum)) + "\n")
-                tmp.close()
+        if task.is_decen_task:
+            s3_paths = []
+
+        for spooled_upload, perturb_prefix in spooled_uploads:
+            try:
+                s3_client = boto3.client(
+                    "s3",
+                    aws_access_key_id=config["eval_aws_access_key_id"],
+                    aws_secret_access_key=config["eval_aws_secret_access_key"],
+                    region_name=config["eval_aws_region"],
+                )
                 response = s3_client.upload_file(
-                    tmp.name,
+                    spooled_upload,
                     task.s3_bucket,
                     get_data_s3_path(task.task_code, name + ".jsonl", perturb_prefix),
                 )
@@ -220,12 +223,14 @@ def create(credentials, tid, name):
                             task.task_code, name + ".jsonl", perturb_prefix
                         )
                     )
-                os.remove(tmp.name)
                 if response:
                     logger.info(response)
-        except Exception as ex:
-            logger.exception(f"Failed to load {name} to S3 due to {ex}.")
-            bottle.abort(400, "Issue loading dataset to S3")
+            except Exception as ex:
+                logger.exception(f"Failed to load {name} to S3 due to {ex}.")
+                bottle.abort(400, "Issue loading dataset to S3")
+    finally:
+        for spooled_upload, _ in spooled_uploads:
+            os.remove(spooled_upload)
 
     # Create an entry in the db for the dataset, or skip if one already exists.
     d = DatasetModel()
@@ -5,12 +5,13 @@
 from urllib.parse import parse_qs
 
 import bottle
-import yaml
 
 import common.auth as _auth
 import common.helpers as util
 from common.logging import logger
+from common.task_config import get_task_config
 from models.badge import BadgeModel
+from models.badge_progress import BadgeProgressModel
 from models.context import ContextModel
 from models.example import ExampleModel
 from models.round import RoundModel
@@ -81,6 +82,9 @@ def get_random_example(credentials, tid, rid):
             n=1,
             my_uid=credentials["id"],
             tags=tags,
+            unique_validators_for_example_tags=(
+                task.unique_validators_for_example_tags
+            ),
         )
     else:
         curr_uid = None
@@ -98,6 +102,9 @@ def get_random_example(credentials, tid, rid):
             tags=tags,
             my_uid=curr_uid,
             turk=True,
+            unique_validators_for_example_tags=(
+                task.unique_validators_for_example_tags
+            ),
         )
     if not example:
         bottle.abort(500, f"No examples available ({round.id})")
@@ -167,6 +174,7 @@ def update_example(credentials, eid):
             cm = ContextModel()
             rm = RoundModel()
             context = cm.get(example.cid)
+            cm.incrementFooledCount(context.id)
             rm.updateLastActivity(context.r_realid)
             rm.incrementFooledCount(context.r_realid)
             if credentials["id"] != "turk":
@@ -200,6 +208,16 @@ def update_example(credentials, eid):
 
         logger.info(f"Updating example {example.id} with {data}")
         em.update(example.id, data)
+        if "retracted" in data or "model_wrong" in data:
+            em.refreshValidationQueueEntry(example.id)
+            if example.uid is not None:
+                bpm = BadgeProgressModel()
+                bpm.markDirty(example.uid)
+        if "model_wrong" in data:
+            cm = ContextModel()
+            tm = TaskModel()
+            task = tm.get(example.context.round.tid)
+            cm.refreshValidationResults([example.cid], task.num_matching_validations)
 
         if credentials["id"] != "turk":
             if "retracted" in data and data["retracted"] is True:
@@ -226,12 +244,12 @@ def evaluate_model_correctness():
 
     tm = TaskModel()
     task = tm.get(data["tid"])
-    task_config = yaml.load(task.config_yaml, yaml.SafeLoader)
+    task_config = get_task_config(task)
     model_wrong_metric = model_wrong_metrics[
-        task_config.get("model_wrong_metric", {"type": "ask_user"})["type"]
+        task_config.config.get("model_wrong_metric", {"type": "ask_user"})["type"]
     ]
-    output_keys = set(map(lambda item: item["name"], task_config.get("output", [])))
-    input_keys = set(map(lambda item: item["name"], task_config.get("input", [])))
+    output_keys = set(task_config.output_names)
+    input_keys = set(task_config.input_names)
     target_keys = input_keys.intersection(output_keys)
     pruned_target = {}
     pruned_output = {}
@@ -243,7 +261,7 @@ def evaluate_model_correctness():
             pruned_output[key] = value
 
     model_wrong = model_wrong_metric(
-        pruned_output, pruned_target, task_config.get("model_wrong_metric", {})
+        pruned_output, pruned_target, task_config.config.get("model_wrong_metric", {})
     )
     missing_keys = len(pruned_target.keys()) != len(target_keys) or len(
         pruned_output.keys()
@@ -307,7 +325,10 @@ def post_example(credentials):
     rm = RoundModel()
     rm.incrementCollectedCount(data["tid"], data["rid"])
     cm = ContextModel()
-    cm.incrementCountDate(data["cid"])
+    cm.incrementCountDate(data["cid"], example.model_wrong)
+    tm = TaskModel()
+    task = tm.get(data["tid"])
+    cm.refreshValidationResults([example.cid], task.num_matching_validations)
     context = cm.get(example.cid)
     rm.updateLastActivity(context.r_realid)
     if example.model_wrong:
@@ -2,6 +2,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import secrets
 import sys
 import tempfile
@@ -11,7 +12,6 @@ import boto3
 import bottle
 import sqlalchemy as db
 import ujson
-import yaml
 from bottle import response
 
 import common.auth as _auth
@@ -19,9 +19,11 @@ import common.helpers as util
 import common.mail_service as mail
 from common.config import config
 from common.logging import logger
+from common.task_config import get_task_config
 from models.badge import BadgeModel
 from models.dataset import AccessTypeEnum, DatasetModel, LogAccessTypeEnum
 from models.model import DeploymentStatusEnum, ModelModel
+from models.model_dataset_evaluation_status import ModelDatasetEvaluationStatusModel
 from models.notification import NotificationModel
 from models.round import RoundModel
 from models.score import ScoreModel
@@ -70,13 +72,7 @@ def get_latest_job_log(credentials, mid, did):
     tm = TaskModel()
     task = tm.get(model.tid)
 
-    delta_metric_types = [
-        task_config["type"]
-        for task_config in yaml.load(task.config_yaml, yaml.SafeLoader).get(
-            "delta_metrics", []
-        )
-    ]
-    delta_metric_types.append(None)
+    delta_metric_types = get_task_config(task).delta_metric_types + [None]
 
     perturb_prefix_to_logs = {}
     for perturb_prefix in delta_metric_types:
@@ -151,7 +147,7 @@ def do_upload_via_train_files(credentials, tid, model_name):
 
     tm = TaskModel()
     task = tm.get(tid)
-    task_config = yaml.load(task.config_yaml, yaml.SafeLoader)
+    task_config = get_task_config(task).config
     if "train_file_metric" not in task_config:
         bottle.abort(
             403,
@@ -324,60 +320,66 @@ def do_upload_via_predictions(credentials, tid, model_name):
         ):
             bottle.abort(400, "Need to upload predictions for all leaderboard datasets")
 
-    parsed_uploads = {}
-    # Ensure correct format
-    for name, upload in uploads.items():
-        try:
-            parsed_upload = [
-                util.json_decode(line)
-                for line in upload.file.read().decode("utf-8").splitlines()
-            ]
-        except Exception as ex:
-            logger.exception(ex)
-            bottle.abort(400, "Could not parse prediction file. Is it a utf-8 jsonl?")
-
-        for io in parsed_upload:
-            try:
-                assert "uid" in io, "'uid' must be present for every example"
-            except Exception as ex:
-                bottle.abort(400, str(ex))
+    validator = task.get_annotation_validator(AnnotationVerifierMode.predictions_upload)
+    spooled_uploads = {}
+    try:
+        # Ensure correct format, while streaming the predictions to local files so
+        # that the uploads never have to be held in memory.
+        for name, upload in uploads.items():
+            line_errors = []
+            with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
+                spooled_uploads[name] = tmp.name
+                try:
+                    for line_number, datum in util.iter_jsonl(upload.file):
+                        if "uid" not in datum:
+                            line_errors.append(
+                                (line_number, "'uid' must be present for every example")
+                            )
+                        for message in validator.verify(datum):
+                            line_errors.append((line_number, message))
+
+                        if not line_errors:
+                            datum["id"] = datum["uid"]  # TODO: right now, dynalab
+                            # models Expect an input with "uid" but output "id" in
+                            # their predictions. Why do we use two seperate names
+                            # for the same thing? Can we make this consistent?
+                            del datum["uid"]
+                            tmp.write(util.json_encode(datum) + "\n")
+                except util.JsonlDecodeError as ex:
+                    logger.exception(ex)
+                    bottle.abort(
+                        400,
+                        f"Could not parse prediction file at line {ex.line_number}."
+                        + " Is it a utf-8 jsonl?",
+                    )
 
-            verified, message = task.verify_annotation(
-                io, mode=AnnotationVerifierMode.predictions_upload
+            if line_errors:
+                bottle.abort(400, util.format_line_errors(line_errors))
+
+        endpoint_name = f"ts{int(time.time())}-{model_name}"
+
+        status_dict = {}
+        # Create local model db object
+        model = m.create(
+            task_id=tid,
+            user_id=user_id,
+            name=model_name,
+            shortname="",
+            longdesc="",
+            desc="",
+            upload_datetime=db.sql.func.now(),
+            endpoint_name=endpoint_name,
+            deployment_status=DeploymentStatusEnum.predictions_upload,
+            secret=secrets.token_hex(),
+        )
+        for dataset_name, spooled_upload in spooled_uploads.items():
+            ret = _eval_dataset(
+                dataset_name, endpoint_name, model, task, spooled_upload
             )
-            if not verified:
-                bottle.abort(400, message)
-        parsed_uploads[name] = parsed_upload
-
-    endpoint_name = f"ts{int(time.time())}-{model_name}"
-
-    status_dict = {}
-    # Create local model db object
-    model = m.create(
-        task_id=tid,
-        user_id=user_id,
-        name=model_name,
-        shortname="",
-        longdesc="",
-        desc="",
-        upload_datetime=db.sql.func.now(),
-        endpoint_name=endpoint_name,
-        deployment_status=DeploymentStatusEnum.predictions_upload,
-        secret=secrets.token_hex(),
-    )
-    with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-        for dataset_name, parsed_upload in parsed_uploads.items():
-            with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-                for datum in parsed_upload:
-                    datum["id"] = datum["uid"]  # TODO: right now, dynalab models
-                    # Expect an input with "uid" but output "id" in their predictions.
-                    # Why do we use two seperate names for the same thing? Can we make
-                    # this consistent?
-                    del datum["uid"]
-                    tmp.write(util.json_encode(datum) + "\n")
-                tmp.close()
-                ret = _eval_dataset(dataset_name, endpoint_name, model, task, tmp.name)
-                status_dict.update(ret)
+            status_dict.update(ret)
+    finally:
+        for spooled_upload in spooled_uploads.values():
+            os.remove(spooled_upload)
 
     return util.json_encode({"success": "ok", "model_id": model.id})
 
@@ -484,12 +486,13 @@ def get_model_detail(credentials, mid):
         model["leaderboard_evaluation_statuses"] = []
         model["non_leaderboard_evaluation_statuses"] = []
         model["hidden_evaluation_statuses"] = []
+        evaluation_statuses = ModelDatasetEvaluationStatusModel().getByMid(mid)
 
         for dataset in datasets:
-            if model["evaluation_status_json"]:
-                evaluation_status = util.json_decode(
-                    model["evaluation_status_json"]
-                ).get(dataset.name, "pre_evaluation")
+            if evaluation_statuses:
+                evaluation_status = evaluation_statuses.get(
+                    dataset.id, "pre_evaluation"
+                )
                 if (
                     evaluation_status != "completed"
                     or dataset.access_type == AccessTypeEnum.hidden
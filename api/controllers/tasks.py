@@ -14,7 +14,9 @@ import common.auth as _auth
 import common.helpers as util
 import common.mail_service as mail
 from common.logging import logger
-from models.context import Context
+from common.task_config import get_task_config, invalidate_task_config
+from models.badge_progress import BadgeProgressModel
+from models.context import Context, ContextModel
 from models.dataset import Dataset, DatasetModel
 from models.leaderboard_configuration import LeaderboardConfigurationModel
 from models.leaderboard_snapshot import LeaderboardSnapshotModel
@@ -467,8 +469,8 @@ def update(credentials, tid):
             logger.exception(str(ex))
             bottle.abort(400, str(ex))
         task = tm.get(tid)
-        old_config = yaml.load(task.config_yaml, yaml.SafeLoader)
-        allowed_fields = ("aggregation_metric",)
+        old_config = get_task_config(task).config
+        allowed_fields = ("aggregation_metric", "batch_transform")
 
         # ensure only allowed_fields changed
         if {k: v for k, v in new_config.items() if k not in allowed_fields} != {
@@ -481,6 +483,15 @@ def update(credentials, tid):
             )
 
     tm.update(tid, data)
+    if "config_yaml" in data:
+        invalidate_task_config(tid)
+    if "num_matching_validations" in data:
+        cm = ContextModel()
+        rm = RoundModel()
+        for round in rm.getByTid(tid):
+            cm.rebuildValidationResults(round.id, data["num_matching_validations"])
+        bpm = BadgeProgressModel()
+        bpm.markAllDirty()
     return util.json_encode({"success": "ok"})
 
 
@@ -502,15 +513,17 @@ def activate(credentials, tid):
             already active task.""",
         )
 
+    new_config = yaml.load(data["config_yaml"], yaml.SafeLoader)
     try:
-        Task.verify_config(yaml.load(data["config_yaml"], yaml.SafeLoader))
+        Task.verify_config(new_config)
     except Exception as ex:
         logger.exception(str(ex))
         bottle.abort(400, str(ex))
 
     tm.update(tid, {"config_yaml": data["config_yaml"], "active": True})
+    invalidate_task_config(tid)
 
-    if len(yaml.load(data["config_yaml"], yaml.SafeLoader).get("context", [])) == 0:
+    if len(new_config.get("context", [])) == 0:
         # If there is no context in the config, then add an empty context.
         # The task owner should not need to do this, because we already know
         # that the context will be empty.
@@ -698,6 +711,10 @@ def get_dynaboard_info(tid):
     if "limit" in query_dict:
         limit = int(query_dict["limit"][0])
 
+    if query_dict.get("count_only", ["false"])[0] == "true":
+        # The count doesn't depend on the weights, the sorting or the page.
+        return get_dynaboard_count(tid)
+
     if "ordered_metric_weights" in query_dict:
         ordered_metric_weights = [
             float(weight)
@@ -725,6 +742,18 @@ def get_dynaboard_info(tid):
     )
 
 
+def get_dynaboard_count(tid):
+    tm = TaskModel()
+    t_dict = tm.getWithRoundAndMetricMetadata(tid)
+    sm = ScoreModel()
+    tensor = sm.getDynaboardTensor(
+        tid,
+        [dataset["id"] for dataset in t_dict["ordered_scoring_datasets"]],
+        [metric["field_name"] for metric in t_dict["ordered_metrics"]],
+    )
+    return util.json_encode({"count": len(tensor), "data": []})
+
+
 def get_dynaboard_info_for_params(
     tid,
     ordered_metric_weights,
@@ -851,8 +880,10 @@ def get_task_trends(tid):
         )
         mid_and_rid_to_perf = {}
         did_to_rid = {}
-        for dataset in sm.dbs.query(Dataset):
-            did_to_rid[dataset.id] = dataset.rid
+        for did, rid in sm.dbs.query(Dataset.id, Dataset.rid).filter(
+            Dataset.tid == tid
+        ):
+            did_to_rid[did] = rid
         rid_to_did_to_weight = {}
         for did_and_weight in ordered_did_and_weight:
             rid = did_to_rid[did_and_weight["did"]]
@@ -865,8 +896,8 @@ def get_task_trends(tid):
                     did_and_weight["did"]: did_and_weight["weight"]
                 }
         mid_to_name = {}
-        for model in sm.dbs.query(Model):
-            mid_to_name[model.id] = model.name
+        for mid, name in sm.dbs.query(Model.id, Model.name).filter(Model.tid == tid):
+            mid_to_name[mid] = name
 
         for model_results in util.json_decode(dynaboard_response)["data"]:
             for dataset_results in model_results["datasets"]:
@@ -9,11 +9,13 @@ import common.helpers as util
 from models.badge import BadgeModel
 from models.context import ContextModel
 from models.example import ExampleModel
+from models.example_tag_validator import ExampleTagValidatorModel
 from models.round import RoundModel
 from models.round_user_example_info import RoundUserExampleInfoModel
 from models.task import TaskModel
 from models.user import UserModel
 from models.validation import ValidationModel
+from models.validation_queue_entry import ValidationQueueEntryModel
 
 
 @bottle.put("/validations/<eid:int>")
@@ -91,27 +93,36 @@ def validate_example(credentials, eid):
     elif credentials["id"] == example.uid and mode != "owner":
         bottle.abort(403, "Access denied (cannot validate your own example)")
 
+    tm = TaskModel()
+    task = tm.get(context.round.task.id)
+
+    etvm = ExampleTagValidatorModel()
+    check_unique_tags = (
+        task.unique_validators_for_example_tags and example.tag is not None
+    )
+    if credentials["id"] == "turk":
+        validator = {"annotator_id": current_validation_metadata["annotator_id"]}
+    else:
+        validator = {"uid": credentials["id"]}
+    if (
+        check_unique_tags
+        and mode != "owner"
+        and etvm.exists(task.id, example.tag, **validator)
+    ):
+        bottle.abort(
+            403, "Access denied (you have already validated an example with this tag)"
+        )
+
     vm.create(credentials["id"], eid, label, mode, current_validation_metadata)
 
     em.update(example.id, {"total_verified": example.total_verified + 1})
+    vqm = ValidationQueueEntryModel()
+    vqm.recordValidation(example.id, label, mode)
+    cm.incrementValidatedCount(context.id)
+    if check_unique_tags:
+        etvm.create(task.id, example.tag, **validator)
 
-    tm = TaskModel()
-    task = tm.get(context.round.task.id)
-
-    if task.unique_validators_for_example_tags:
-        for other_example in em.getByTid(task.id):
-            if (
-                other_example.id != example.id
-                and other_example.tag is not None
-                and other_example.tag == example.tag
-            ):
-                vm.create(
-                    credentials["id"],
-                    other_example.id,
-                    "placeholder",
-                    mode,
-                    current_validation_metadata,
-                )
+    cm.refreshValidationResults([example.cid], task.num_matching_validations)
 
     rm = RoundModel()
     rm.updateLastActivity(context.r_realid)
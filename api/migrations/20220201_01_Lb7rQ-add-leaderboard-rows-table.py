@@ -0,0 +1,86 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add the leaderboard_rows table, a per-model projection of the scores table that the
+dynaboard reads from, and populate it from the existing scores.
+"""
+
+import datetime
+import json
+
+from yoyo import step
+
+
+__depends__ = {"20220120_01_XJKxY-change-task-config-to-yaml"}
+
+# Keep in sync with LEADERBOARD_SCORE_COLUMNS in models/score.py
+LEADERBOARD_SCORE_COLUMNS = (
+    "perf",
+    "perf_std",
+    "memory_utilization",
+    "examples_per_second",
+    "fairness",
+    "robustness",
+)
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE leaderboard_rows (
+            id INT NOT NULL AUTO_INCREMENT,
+            tid INT NOT NULL,
+            mid INT NOT NULL,
+            metrics_json MEDIUMTEXT NOT NULL,
+            version INT NOT NULL DEFAULT 1,
+            last_updated DATETIME DEFAULT NULL,
+            PRIMARY KEY (id),
+            UNIQUE KEY leaderboard_rows_mid (mid),
+            KEY leaderboard_rows_tid (tid),
+            CONSTRAINT leaderboard_rows_tid_fk FOREIGN KEY (tid)
+                REFERENCES tasks (id),
+            CONSTRAINT leaderboard_rows_mid_fk FOREIGN KEY (mid)
+                REFERENCES models (id) ON DELETE CASCADE
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+
+    cursor.execute(
+        "SELECT scores.mid, models.tid, scores.did, scores.metadata_json, "
+        + ", ".join("scores." + column for column in LEADERBOARD_SCORE_COLUMNS)
+        + " FROM scores JOIN models ON models.id = scores.mid ORDER BY scores.id"
+    )
+    mid_to_tid = {}
+    mid_to_did_to_metrics = {}
+    for mid, tid, did, metadata_json, *column_values in cursor.fetchall():
+        metrics = {}
+        if metadata_json is not None:
+            for name, value in json.loads(metadata_json).items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metrics[name] = value
+        for name, value in zip(LEADERBOARD_SCORE_COLUMNS, column_values):
+            if value is not None:
+                metrics[name] = value
+        mid_to_tid[mid] = tid
+        mid_to_did_to_metrics.setdefault(mid, {})[str(did)] = metrics
+
+    now = datetime.datetime.utcnow()
+    cursor.executemany(
+        "INSERT INTO leaderboard_rows (tid, mid, metrics_json, version, last_updated)"
+        + " VALUES (%s, %s, %s, 1, %s)",
+        [
+            (mid_to_tid[mid], mid, json.dumps(did_to_metrics), now)
+            for mid, did_to_metrics in mid_to_did_to_metrics.items()
+        ],
+    )
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE leaderboard_rows")
+
+
+steps = [step(apply_step, rollback_step)]
@@ -0,0 +1,82 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Move the evaluation statuses of models from models.evaluation_status_json, a
+{dataset name: status} json blob, to the model_dataset_evaluation_status table,
+with one row per model and dataset.
+"""
+
+import datetime
+import json
+
+from yoyo import step
+
+
+__depends__ = {"20220201_01_Lb7rQ-add-leaderboard-rows-table"}
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE model_dataset_evaluation_status (
+            mid INT NOT NULL,
+            did INT NOT NULL,
+            status ENUM('pre_evaluation', 'evaluating', 'completed', 'failed')
+                NOT NULL,
+            last_updated DATETIME DEFAULT NULL,
+            PRIMARY KEY (mid, did),
+            KEY model_dataset_evaluation_status_did (did),
+            CONSTRAINT model_dataset_evaluation_status_mid_fk FOREIGN KEY (mid)
+                REFERENCES models (id) ON DELETE CASCADE,
+            CONSTRAINT model_dataset_evaluation_status_did_fk FOREIGN KEY (did)
+                REFERENCES datasets (id) ON DELETE CASCADE
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+
+    cursor.execute("SELECT name, id FROM datasets")
+    dataset_name_to_did = dict(cursor.fetchall())
+    cursor.execute(
+        "SELECT id, evaluation_status_json FROM models"
+        + " WHERE evaluation_status_json IS NOT NULL"
+    )
+    now = datetime.datetime.utcnow()
+    rows = []
+    for mid, evaluation_status_json in cursor.fetchall():
+        for dataset_name, status in json.loads(evaluation_status_json).items():
+            if dataset_name in dataset_name_to_did:
+                rows.append((mid, dataset_name_to_did[dataset_name], status, now))
+    cursor.executemany(
+        "INSERT INTO model_dataset_evaluation_status (mid, did, status, last_updated)"
+        + " VALUES (%s, %s, %s, %s)",
+        rows,
+    )
+
+    cursor.execute("ALTER TABLE models DROP COLUMN evaluation_status_json")
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE models ADD COLUMN evaluation_status_json TEXT")
+
+    cursor.execute(
+        "SELECT model_dataset_evaluation_status.mid, datasets.name,"
+        + " model_dataset_evaluation_status.status"
+        + " FROM model_dataset_evaluation_status"
+        + " JOIN datasets ON datasets.id = model_dataset_evaluation_status.did"
+    )
+    mid_to_statuses = {}
+    for mid, dataset_name, status in cursor.fetchall():
+        mid_to_statuses.setdefault(mid, {})[dataset_name] = status
+    cursor.executemany(
+        "UPDATE models SET evaluation_status_json = %s WHERE id = %s",
+        [(json.dumps(statuses), mid) for mid, statuses in mid_to_statuses.items()],
+    )
+
+    cursor.execute("DROP TABLE model_dataset_evaluation_status")
+
+
+steps = [step(apply_step, rollback_step)]
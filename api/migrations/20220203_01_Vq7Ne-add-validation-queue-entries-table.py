@@ -0,0 +1,65 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add the validation_queue_entries table, which holds the examples that can still
+be validated with their validation counts, and fill it from the examples and
+validations tables.
+"""
+
+from yoyo import step
+
+
+__depends__ = {"20220202_01_Ev4Qs-add-model-dataset-evaluation-status-table"}
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE validation_queue_entries (
+            eid INT NOT NULL,
+            r_realid INT NOT NULL,
+            priority SMALLINT NOT NULL,
+            total_verified INT NOT NULL DEFAULT 0,
+            cnt_correct INT NOT NULL DEFAULT 0,
+            cnt_incorrect INT NOT NULL DEFAULT 0,
+            cnt_flagged INT NOT NULL DEFAULT 0,
+            random_key INT NOT NULL,
+            PRIMARY KEY (eid),
+            KEY validation_queue_entries_sampling
+                (r_realid, priority, total_verified, random_key),
+            CONSTRAINT validation_queue_entries_eid_fk FOREIGN KEY (eid)
+                REFERENCES examples (id) ON DELETE CASCADE,
+            CONSTRAINT validation_queue_entries_r_realid_fk FOREIGN KEY (r_realid)
+                REFERENCES rounds (id) ON DELETE CASCADE
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO validation_queue_entries (eid, r_realid, priority,
+            total_verified, cnt_correct, cnt_incorrect, cnt_flagged, random_key)
+        SELECT examples.id, contexts.r_realid, IF(examples.model_wrong, 0, 1),
+            COALESCE(examples.total_verified, 0),
+            COALESCE(SUM(validations.label = 'correct'), 0),
+            COALESCE(SUM(validations.label = 'incorrect'), 0),
+            COALESCE(SUM(validations.label = 'flagged'), 0),
+            FLOOR(RAND() * 2147483648)
+        FROM examples
+        JOIN contexts ON contexts.id = examples.cid
+        LEFT JOIN validations ON validations.eid = examples.id
+        WHERE examples.retracted = 0
+        GROUP BY examples.id, contexts.r_realid
+        HAVING COALESCE(SUM(validations.mode = 'owner'), 0) = 0
+        """
+    )
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE validation_queue_entries")
+
+
+steps = [step(apply_step, rollback_step)]
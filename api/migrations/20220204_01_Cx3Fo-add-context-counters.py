@@ -0,0 +1,78 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add per-context counters of fooling examples and of validations, and a random
+key, so that contexts can be sampled from an index by their number of examples
+or of fooling examples.
+"""
+
+from yoyo import step
+
+
+__depends__ = {"20220203_01_Vq7Ne-add-validation-queue-entries-table"}
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE contexts SET total_used = 0 WHERE total_used IS NULL")
+    cursor.execute(
+        """
+        ALTER TABLE contexts
+            MODIFY total_used INT NOT NULL DEFAULT 0,
+            ADD COLUMN total_fooled INT NOT NULL DEFAULT 0,
+            ADD COLUMN total_validated INT NOT NULL DEFAULT 0,
+            ADD COLUMN random_key INT NOT NULL DEFAULT 0
+        """
+    )
+    cursor.execute("UPDATE contexts SET random_key = FLOOR(RAND() * 2147483648)")
+    cursor.execute(
+        """
+        UPDATE contexts
+        JOIN (
+            SELECT cid, COALESCE(SUM(model_wrong = 1), 0) AS total_fooled
+            FROM examples
+            GROUP BY cid
+        ) AS fooled ON fooled.cid = contexts.id
+        SET contexts.total_fooled = fooled.total_fooled
+        """
+    )
+    cursor.execute(
+        """
+        UPDATE contexts
+        JOIN (
+            SELECT examples.cid, COUNT(*) AS total_validated
+            FROM validations
+            JOIN examples ON examples.id = validations.eid
+            WHERE validations.label != 'placeholder'
+            GROUP BY examples.cid
+        ) AS validated ON validated.cid = contexts.id
+        SET contexts.total_validated = validated.total_validated
+        """
+    )
+    cursor.execute(
+        """
+        ALTER TABLE contexts
+            ADD INDEX contexts_least_used (r_realid, total_used, random_key),
+            ADD INDEX contexts_least_fooled (r_realid, total_fooled, random_key)
+        """
+    )
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        ALTER TABLE contexts
+            DROP INDEX contexts_least_used,
+            DROP INDEX contexts_least_fooled,
+            DROP COLUMN total_fooled,
+            DROP COLUMN total_validated,
+            DROP COLUMN random_key,
+            MODIFY total_used INT DEFAULT 0
+        """
+    )
+
+
+steps = [step(apply_step, rollback_step)]
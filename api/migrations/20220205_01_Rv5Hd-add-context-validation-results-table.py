@@ -0,0 +1,93 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add the context_validation_results table, with per-context counts of the
+fooling examples that passed, failed, are being or weren't validated yet, and
+fill it from the examples and validations tables.
+"""
+
+from yoyo import step
+
+
+__depends__ = {"20220204_01_Cx3Fo-add-context-counters"}
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE context_validation_results (
+            cid INT NOT NULL,
+            r_realid INT NOT NULL,
+            num_matching_validations INT NOT NULL,
+            cnt_correct_examples INT NOT NULL DEFAULT 0,
+            cnt_failed_examples INT NOT NULL DEFAULT 0,
+            cnt_inflight_examples INT NOT NULL DEFAULT 0,
+            cnt_pre_val_examples INT NOT NULL DEFAULT 0,
+            validation_failed TINYINT(1) NOT NULL DEFAULT 0,
+            random_key INT NOT NULL,
+            PRIMARY KEY (cid),
+            KEY context_validation_results_sampling
+                (r_realid, validation_failed, random_key),
+            CONSTRAINT context_validation_results_cid_fk FOREIGN KEY (cid)
+                REFERENCES contexts (id) ON DELETE CASCADE,
+            CONSTRAINT context_validation_results_r_realid_fk FOREIGN KEY (r_realid)
+                REFERENCES rounds (id) ON DELETE CASCADE
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO context_validation_results (cid, r_realid,
+            num_matching_validations, cnt_correct_examples, cnt_failed_examples,
+            cnt_inflight_examples, cnt_pre_val_examples, validation_failed,
+            random_key)
+        SELECT cid, r_realid, n, cnt_correct_examples, cnt_failed_examples,
+            cnt_inflight_examples, cnt_pre_val_examples,
+            cnt_inflight_examples = 0 AND cnt_correct_examples = 0
+                AND cnt_failed_examples > 0 AND cnt_pre_val_examples = 0,
+            FLOOR(RAND() * 2147483648)
+        FROM (
+            SELECT example_stats.cid, contexts.r_realid,
+                tasks.num_matching_validations AS n,
+                SUM(cnt_correct >= tasks.num_matching_validations)
+                    AS cnt_correct_examples,
+                SUM(cnt_correct < tasks.num_matching_validations
+                    AND (cnt_incorrect >= tasks.num_matching_validations
+                    OR cnt_flagged >= tasks.num_matching_validations))
+                    AS cnt_failed_examples,
+                SUM(cnt_correct < tasks.num_matching_validations
+                    AND cnt_incorrect < tasks.num_matching_validations
+                    AND cnt_flagged < tasks.num_matching_validations
+                    AND cnt_total > 0) AS cnt_inflight_examples,
+                SUM(cnt_total = 0) AS cnt_pre_val_examples
+            FROM (
+                SELECT examples.cid,
+                    COALESCE(SUM(validations.label = 'correct'), 0) AS cnt_correct,
+                    COALESCE(SUM(validations.label = 'incorrect'), 0)
+                        AS cnt_incorrect,
+                    COALESCE(SUM(validations.label = 'flagged'), 0) AS cnt_flagged,
+                    COUNT(validations.id) AS cnt_total
+                FROM examples
+                LEFT JOIN validations ON validations.eid = examples.id
+                WHERE examples.model_wrong IS TRUE
+                GROUP BY examples.cid, examples.id
+            ) AS example_stats
+            JOIN contexts ON contexts.id = example_stats.cid
+            JOIN rounds ON rounds.id = contexts.r_realid
+            JOIN tasks ON tasks.id = rounds.tid
+            GROUP BY example_stats.cid, contexts.r_realid,
+                tasks.num_matching_validations
+        ) AS context_stats
+        """
+    )
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE context_validation_results")
+
+
+steps = [step(apply_step, rollback_step)]
@@ -0,0 +1,60 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add the example_tag_validators table, which records the tags each validator
+validated examples of, for tasks with unique_validators_for_example_tags. It
+replaces the placeholder validations that were added to every other example
+with the same tag, and is filled from the validations of these tasks in a
+single INSERT ... SELECT.
+"""
+
+from yoyo import step
+
+
+__depends__ = {"20220205_01_Rv5Hd-add-context-validation-results-table"}
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE example_tag_validators (
+            tid INT NOT NULL,
+            tag_hash VARCHAR(40) NOT NULL,
+            uid INT NOT NULL DEFAULT 0,
+            annotator_id VARCHAR(255) NOT NULL DEFAULT '',
+            tag TEXT,
+            PRIMARY KEY (tid, tag_hash, uid, annotator_id),
+            CONSTRAINT example_tag_validators_tid_fk FOREIGN KEY (tid)
+                REFERENCES tasks (id) ON DELETE CASCADE
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+    cursor.execute(
+        """
+        INSERT IGNORE INTO example_tag_validators (tid, tag_hash, uid,
+            annotator_id, tag)
+        SELECT DISTINCT rounds.tid, SHA1(examples.tag),
+            COALESCE(validations.uid, 0),
+            IF(validations.uid IS NULL, COALESCE(JSON_UNQUOTE(JSON_EXTRACT(
+                validations.metadata_json, '$.annotator_id')), ''), ''),
+            examples.tag
+        FROM validations
+        JOIN examples ON examples.id = validations.eid
+        JOIN contexts ON contexts.id = examples.cid
+        JOIN rounds ON rounds.id = contexts.r_realid
+        JOIN tasks ON tasks.id = rounds.tid
+        WHERE tasks.unique_validators_for_example_tags
+            AND examples.tag IS NOT NULL
+        """
+    )
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE example_tag_validators")
+
+
+steps = [step(apply_step, rollback_step)]
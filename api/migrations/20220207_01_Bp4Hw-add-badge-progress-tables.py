@@ -0,0 +1,66 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add the badge_progress and badge_engine_state tables, with which the async badge
+job only processes the examples and validations created since its previous run,
+and index examples.generated_datetime for the weekly winner count. The tables
+start empty, so the first run processes every user once.
+"""
+
+from yoyo import step
+
+
+__depends__ = {"20220206_01_Tg2Wk-add-example-tag-validators-table"}
+
+
+def apply_step(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE badge_progress (
+            uid INT NOT NULL,
+            last_eid INT NOT NULL DEFAULT 0,
+            num_examples INT NOT NULL DEFAULT 0,
+            first_example_datetime DATETIME,
+            last_example_datetime DATETIME,
+            example_streak INT NOT NULL DEFAULT 0,
+            day_streak INT NOT NULL DEFAULT 0,
+            previous_example_day DATETIME,
+            streak_badges_json TEXT,
+            dirty BOOL NOT NULL DEFAULT 0,
+            PRIMARY KEY (uid),
+            CONSTRAINT badge_progress_uid_fk FOREIGN KEY (uid)
+                REFERENCES users (id) ON DELETE CASCADE
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE badge_engine_state (
+            id INT NOT NULL AUTO_INCREMENT,
+            last_eid INT NOT NULL DEFAULT 0,
+            last_validation_id INT NOT NULL DEFAULT 0,
+            max_validation_id INT NOT NULL DEFAULT 0,
+            last_run DATETIME,
+            PRIMARY KEY (id)
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX ix_examples_generated_datetime
+        ON examples (generated_datetime)
+        """
+    )
+
+
+def rollback_step(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP INDEX ix_examples_generated_datetime ON examples")
+    cursor.execute("DROP TABLE badge_engine_state")
+    cursor.execute("DROP TABLE badge_progress")
+
+
+steps = [step(apply_step, rollback_step)]
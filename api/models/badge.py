@@ -3,20 +3,28 @@
 # LICENSE file in the root directory of this source tree.
 
 import datetime
+from collections import defaultdict
 
 import sqlalchemy as db
 
 import common.helpers as util
 from common.logging import logger
 
+from .badge_progress import BadgeEngineState, BadgeProgress
 from .base import Base, BaseModel
+from .context import Context
 from .dataset import AccessTypeEnum, DatasetModel
 from .example import Example
 from .notification import NotificationModel
-from .round import RoundModel
+from .round import Round, RoundModel
 from .score import Score, ScoreModel
+from .task import Task
 from .user import User, UserModel
-from .validation import Validation
+from .validation import LabelEnum, ModeEnum, Validation
+
+
+# How long the async badge job waits before counting an example
+EXAMPLE_COMMIT_LAG = datetime.timedelta(minutes=10)
 
 
 class Badge(Base):
@@ -217,252 +225,411 @@ class BadgeModel(BaseModel):
     def lengthOfFilteredList(self, function, iterable):
         return len(list(filter(function, iterable)))
 
-    def handleAsync(self):
-        one_week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
-        badges_to_remove = []
-        badges_to_add = []
-        users = self.dbs.query(User)
-        badges = self.dbs.query(Badge)
-        examples = self.dbs.query(Example)
-        validations = self.dbs.query(Validation)
-        validations_by_eid = {}
-        for validation in validations:
-            if validation.eid in validations_by_eid:
-                validations_by_eid[validation.eid].append(validation)
+    def bulkCreateNotificationsAndRemoveBadges(self, badges_to_remove, type):
+        """Same as createNotificationsAndRemoveBadges, in a single delete and
+        a single notification insert."""
+        if not badges_to_remove:
+            return
+        self.dbs.query(Badge).filter(
+            Badge.id.in_({badge.id for badge in badges_to_remove})
+        ).delete(synchronize_session=False)
+        nm = NotificationModel()
+        nm.bulkCreate([(badge.uid, type, badge.name) for badge in badges_to_remove])
+        self.dbs.commit()
+
+    def bulkCreateNotificationsAndAddBadges(self, badge_dicts_to_add):
+        """Same as createNotificationsAndAddBadges, in a single badge insert and
+        a single notification insert."""
+        if not badge_dicts_to_add:
+            return
+        self.dbs.execute(
+            Badge.__table__.insert().values(awarded=db.sql.func.now()),
+            [
+                {
+                    "uid": badge_dict["uid"],
+                    "name": badge_dict["name"],
+                    "metadata_json": badge_dict.get("metadata"),
+                }
+                for badge_dict in badge_dicts_to_add
+            ],
+        )
+        nm = NotificationModel()
+        nm.bulkCreate(
+            [
+                (badge_dict["uid"], "NEW_BADGE_EARNED", badge_dict["name"])
+                for badge_dict in badge_dicts_to_add
+            ]
+        )
+        self.dbs.commit()
+
+    def getExampleStreakStatuses(self, *filters):
+        """
+        Returns (uid, eid, generated_datetime, breaks_streak) for the examples
+        matching filters, in the order in which the streaks of their creators are
+        computed. An example breaks the example streak of its creator if it didn't
+        fool the model, was retracted, or was validated as flagged or incorrect.
+        """
+
+        def count(condition):
+            return db.func.sum(db.case([(condition, 1)], else_=0))
+
+        num_matching_validations = Task.num_matching_validations
+        breaks_streak = db.or_(
+            db.func.coalesce(Example.model_wrong, False).is_(False),
+            db.func.coalesce(Example.retracted, False).is_(True),
+            count(Validation.label == LabelEnum.flagged) >= num_matching_validations,
+            count(Validation.label == LabelEnum.incorrect) >= num_matching_validations,
+            count(
+                db.and_(
+                    Validation.label.in_([LabelEnum.flagged, LabelEnum.incorrect]),
+                    Validation.mode == ModeEnum.owner,
+                )
+            )
+            >= 1,
+        )
+        return (
+            self.dbs.query(
+                Example.uid, Example.id, Example.generated_datetime, breaks_streak
+            )
+            .join(Context, Context.id == Example.cid)
+            .join(Round, Round.id == Context.r_realid)
+            .join(Task, Task.id == Round.tid)
+            .outerjoin(Validation, Validation.eid == Example.id)
+            .filter(*filters)
+            .group_by(Example.id, Task.num_matching_validations)
+            .order_by(Example.uid, Example.id)
+        )
+
+    def advanceStreaks(
+        self, progress, generated_datetime, breaks_streak, streak_badge_names
+    ):
+        """
+        Updates the streaks of a user with their next example, and appends the
+        names of the streak badges that this example earns.
+        """
+        if progress.num_examples == 0:
+            progress.first_example_datetime = generated_datetime
+            progress.previous_example_day = generated_datetime
+        progress.num_examples += 1
+        progress.last_example_datetime = generated_datetime
+
+        if breaks_streak:
+            progress.example_streak = 0
+            return
+
+        progress.example_streak += 1
+        one_day_passed = progress.previous_example_day + datetime.timedelta(days=1)
+        two_days_passed = progress.previous_example_day + datetime.timedelta(days=2)
+        if generated_datetime > one_day_passed:
+            if generated_datetime <= two_days_passed:
+                progress.day_streak += 1
+                for (
+                    streak_type,
+                    num_required,
+                ) in self.day_streak_type_and_num_required_days:
+                    if progress.day_streak == num_required:
+                        streak_badge_names.append("DAY_STREAK_" + streak_type)
             else:
-                validations_by_eid[validation.eid] = [validation]
-        badges_and_examples_by_uid = {}
+                progress.day_streak = 0
+            progress.previous_example_day = generated_datetime
+
+        if progress.example_streak in self.example_streak_num_required:
+            streak_badge_names.append("EXAMPLE_STREAK_" + str(progress.example_streak))
+
+    def getUndeservedBadges(self, badges, metadata, streak_badge_names):
+        """
+        Returns the badges of a user that they no longer deserve, and removes
+        the streak badges that they already have from streak_badge_names.
+        """
+        undeserved_badges = []
+        num_created_by_task = self.getFieldsFromMetadata(
+            metadata,
+            0,
+            [
+                task_name + "_fooling_no_verified_incorrect_or_flagged"
+                for task_name in self.task_code_to_badge_name
+            ],
+        )
+        streak_names = {
+            "EXAMPLE_STREAK_" + str(num_required)
+            for num_required in self.example_streak_num_required
+        } | {
+            "DAY_STREAK_" + streak_type
+            for streak_type, _ in self.day_streak_type_and_num_required_days
+        }
         for badge in badges:
-            if badge.uid in badges_and_examples_by_uid:
-                badges_and_examples_by_uid[badge.uid]["badges"].append(badge)
-            else:
-                badges_and_examples_by_uid[badge.uid] = {
-                    "badges": [badge],
-                    "examples": [],
-                }
-        num_created_by_uid = {}
-        max_num_created = 0
-        for example in examples:
-            if example.generated_datetime > one_week_ago:
-                if example.uid in num_created_by_uid:
-                    num_created_by_uid[example.uid] += 1
+            if badge.name in streak_names:
+                if badge.name in streak_badge_names:
+                    streak_badge_names.remove(badge.name)
                 else:
-                    num_created_by_uid[example.uid] = 1
-                if num_created_by_uid[example.uid] > max_num_created:
-                    max_num_created = num_created_by_uid[example.uid]
+                    undeserved_badges.append(badge)
 
-            if example.uid in badges_and_examples_by_uid:
-                badges_and_examples_by_uid[example.uid]["examples"].append(example)
-            else:
-                badges_and_examples_by_uid[example.uid] = {
-                    "badges": [],
-                    "examples": [example],
-                }
+            for (
+                contributor_type,
+                num_required_creations,
+                _,
+            ) in self.contributor_type_num_required_creations_and_validations:
+                if badge.name == "DYNABENCH_" + contributor_type:
+                    if sum(num_created_by_task) < num_required_creations:
+                        undeserved_badges.append(badge)
 
-        weekly_winners = [
+            if badge.name == "ALL_TASKS_COVERED" and 0 in num_created_by_task:
+                undeserved_badges.append(badge)
+
+            for task_name in self.task_code_to_badge_name:
+                for (
+                    contributor_type,
+                    num_required_creations,
+                ) in self.task_contributor_type_and_num_required_creations:
+                    if (
+                        badge.name
+                        == "DYNABENCH_"
+                        + self.task_code_to_badge_name[task_name]
+                        + "_"
+                        + contributor_type
+                    ):
+                        key = task_name + "_fooling_no_verified_incorrect_or_flagged"
+                        if key not in metadata or (
+                            metadata[key] < num_required_creations
+                        ):
+                            undeserved_badges.append(badge)
+        return undeserved_badges
+
+    def getWeeklyWinners(self):
+        """The uids of the users who created the most examples in the last week."""
+        one_week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
+        num_created_by_uid = (
+            self.dbs.query(Example.uid, db.func.count(Example.id))
+            .filter(Example.generated_datetime > one_week_ago)
+            .group_by(Example.uid)
+            .all()
+        )
+        if not num_created_by_uid:
+            return set()
+        max_num_created = max(num_created for _, num_created in num_created_by_uid)
+        return {
             uid
-            for uid, num_created in num_created_by_uid.items()
-            if num_created == max_num_created
-        ]
+            for uid, num_created in num_created_by_uid
+            if num_created == max_num_created and uid is not None
+        }
 
+    def handleAsyncUsers(self, uids, dirty_uids, last_eid, weekly_winners):
+        """
+        Brings the badge progress of a batch of users up to last_eid, and awards
+        and removes the badges that are computed asynchronously for them.
+        """
+        users = self.dbs.query(User).filter(User.id.in_(uids)).all()
+        progress_by_uid = {
+            progress.uid: progress
+            for progress in self.dbs.query(BadgeProgress).filter(
+                BadgeProgress.uid.in_(uids)
+            )
+        }
+        badges_by_uid = defaultdict(list)
+        for badge in self.dbs.query(Badge).filter(Badge.uid.in_(uids)):
+            badges_by_uid[badge.uid].append(badge)
+
+        streak_badge_names_by_uid = {}
         for user in users:
-            if user.metadata_json:
-                metadata = util.json_decode(user.metadata_json)
+            progress = progress_by_uid.get(user.id)
+            if progress is None:
+                progress = BadgeProgress(
+                    uid=user.id,
+                    last_eid=0,
+                    num_examples=0,
+                    example_streak=0,
+                    day_streak=0,
+                    dirty=False,
+                )
+                self.dbs.add(progress)
+                progress_by_uid[user.id] = progress
+            if progress.dirty or user.id in dirty_uids or progress.last_eid > last_eid:
+                # Recompute the streaks from the user's first example.
+                progress.last_eid = 0
+                progress.num_examples = 0
+                progress.first_example_datetime = None
+                progress.last_example_datetime = None
+                progress.example_streak = 0
+                progress.day_streak = 0
+                progress.previous_example_day = None
+                streak_badge_names_by_uid[user.id] = []
             else:
-                metadata = {}
-
-            async_badges_to_award = []
-
-            # Recompute all example streaks for a user.
-            recomputed_example_streak_badge_names = []
-            recomputed_day_streak_badge_names = []
-            if user.id in badges_and_examples_by_uid:
-                user_examples = badges_and_examples_by_uid[user.id]["examples"]
-                if len(user_examples) > 0:
-                    example_streak_count = 0
-                    day_streak_count = 0
-                    previous_example_day = user_examples[0].generated_datetime
-                    for example in user_examples:
-                        if example.context:
-                            task = example.context.round.task
-                        if example.id in validations_by_eid:
-                            example_validations = validations_by_eid[example.id]
-                        else:
-                            example_validations = []
-
-                        if example.context and (
-                            not example.model_wrong
-                            or example.retracted
-                            or self.lengthOfFilteredList(
-                                lambda validation: validation.label.name == "flagged",
-                                example_validations,
-                            )
-                            >= task.num_matching_validations
-                            or self.lengthOfFilteredList(
-                                lambda validation: validation.label.name == "incorrect",
-                                example_validations,
-                            )
-                            >= task.num_matching_validations
-                            or self.lengthOfFilteredList(
-                                lambda validation: validation.label.name == "flagged"
-                                and validation.mode.name == "owner",
-                                example_validations,
-                            )
-                            >= 1
-                            or self.lengthOfFilteredList(
-                                lambda validation: validation.label.name == "incorrect"
-                                and validation.mode.name == "owner",
-                                example_validations,
-                            )
-                            >= 1
-                        ):
-                            example_streak_count = 0
-                        else:
-                            example_streak_count += 1
-                            one_day_passed = previous_example_day + datetime.timedelta(
-                                days=1
-                            )
-                            two_days_passed = previous_example_day + datetime.timedelta(
-                                days=2
-                            )
-                            if example.generated_datetime > one_day_passed:
-                                if example.generated_datetime <= two_days_passed:
-                                    day_streak_count += 1
-                                    for (
-                                        streak_type,
-                                        num_required,
-                                    ) in self.day_streak_type_and_num_required_days:
-                                        if day_streak_count == num_required:
-                                            recomputed_day_streak_badge_names.append(
-                                                "DAY_STREAK_" + streak_type
-                                            )
-                                elif example.generated_datetime > two_days_passed:
-                                    day_streak_count = 0
-                                previous_example_day = example.generated_datetime
-
-                            if example_streak_count in self.example_streak_num_required:
-                                recomputed_example_streak_badge_names.append(
-                                    "EXAMPLE_STREAK_" + str(example_streak_count)
-                                )
-                    user.streak_examples = example_streak_count
-                    user.streak_days = day_streak_count
-
-                # Remove a user's undeserved badges.
-                for badge in badges_and_examples_by_uid[user.id]["badges"]:
-                    for num_required in self.example_streak_num_required:
-                        if badge.name == "EXAMPLE_STREAK_" + str(num_required):
-                            if badge.name in recomputed_example_streak_badge_names:
-                                recomputed_example_streak_badge_names.remove(badge.name)
-                            else:
-                                badges_to_remove.append(badge)
-                    for (
-                        streak_type,
-                        num_required,
-                    ) in self.day_streak_type_and_num_required_days:
-                        if badge.name == "DAY_STREAK_" + streak_type:
-                            if badge.name in recomputed_day_streak_badge_names:
-                                recomputed_day_streak_badge_names.remove(badge.name)
-                            else:
-                                badges_to_remove.append(badge)
-
-                    num_created_by_task = self.getFieldsFromMetadata(
-                        metadata,
-                        0,
-                        [
-                            task_name + "_fooling_no_verified_incorrect_or_flagged"
-                            for task_name in self.task_code_to_badge_name
-                        ],
-                    )
+                streak_badge_names_by_uid[user.id] = util.json_decode(
+                    progress.streak_badges_json or "[]"
+                )
+        self.dbs.flush()
+
+        # Only the examples that each user created since their progress was saved.
+        for uid, _, generated_datetime, breaks_streak in self.getExampleStreakStatuses(
+            Example.uid.in_(uids),
+            Example.id <= last_eid,
+            Example.id
+            > db.select([BadgeProgress.last_eid])
+            .where(BadgeProgress.uid == Example.uid)
+            .as_scalar(),
+        ):
+            self.advanceStreaks(
+                progress_by_uid[uid],
+                generated_datetime,
+                breaks_streak,
+                streak_badge_names_by_uid[uid],
+            )
 
-                    for (
-                        contributor_type,
-                        num_required_creations,
-                        _,
-                    ) in self.contributor_type_num_required_creations_and_validations:
-                        if badge.name == "DYNABENCH_" + contributor_type:
-                            if sum(num_created_by_task) < num_required_creations:
-                                badges_to_remove.append(badge)
-
-                    if badge.name == "ALL_TASKS_COVERED" and 0 in num_created_by_task:
-                        badges_to_remove.append(badge)
-
-                    for task_name in self.task_code_to_badge_name:
-                        for (
-                            contributor_type,
-                            num_required_creations,
-                        ) in self.task_contributor_type_and_num_required_creations:
-                            if (
-                                badge.name
-                                == "DYNABENCH_"
-                                + self.task_code_to_badge_name[task_name]
-                                + "_"
-                                + contributor_type
-                            ):
-                                if (
-                                    task_name
-                                    + "_fooling_no_verified_incorrect_or_flagged"
-                                    in metadata
-                                ):
-                                    if (
-                                        metadata[
-                                            task_name
-                                            + "_fooling_no_verified_incorrect_"
-                                            + "or_flagged"
-                                        ]
-                                        < num_required_creations
-                                    ):
-                                        badges_to_remove.append(badge)
-                                else:
-                                    badges_to_remove.append(badge)
+        badges_to_remove = []
+        badges_to_add = []
+        for user in users:
+            progress = progress_by_uid[user.id]
+            streak_badge_names = streak_badge_names_by_uid[user.id]
+            progress.last_eid = last_eid
+            progress.streak_badges_json = util.json_encode(streak_badge_names)
+            progress.dirty = False
+            if progress.num_examples > 0:
+                user.streak_examples = progress.example_streak
+                user.streak_days = progress.day_streak
 
+            if user.metadata_json:
+                metadata = util.json_decode(user.metadata_json)
             else:
-                badges_and_examples_by_uid[user.id] = {"badges": [], "examples": []}
-
-            # Award streak badges that result from the removal of other streak badges.
-            # (e.g., if a 20 example streak is undeserved, a 5 example streak might
-            # be deserved instead)
-            for badge_name in recomputed_example_streak_badge_names:
-                async_badges_to_award.append(badge_name)
-            for badge_name in recomputed_day_streak_badge_names:
-                async_badges_to_award.append(badge_name)
+                metadata = {}
+            badges = badges_by_uid[user.id]
+
+            # Remove a user's undeserved badges, and award the streak badges that
+            # result from the removal of other streak badges (e.g., if a 20
+            # example streak is undeserved, a 5 example streak might be deserved
+            # instead).
+            async_badges_to_award = list(streak_badge_names)
+            badges_to_remove += self.getUndeservedBadges(
+                badges, metadata, async_badges_to_award
+            )
 
             # Award badges that must be computed asynchronously.
-            if user.total_verified_fooled > 0 and "FIRST_VALIDATED_FOOLING" not in [
-                badge.name for badge in badges_and_examples_by_uid[user.id]["badges"]
-            ]:
+            badge_names = {badge.name for badge in badges}
+            if (
+                user.total_verified_fooled > 0
+                and "FIRST_VALIDATED_FOOLING" not in badge_names
+            ):
                 async_badges_to_award.append("FIRST_VALIDATED_FOOLING")
 
             if (
-                len(badges_and_examples_by_uid[user.id]["examples"]) > 1
-                and badges_and_examples_by_uid[user.id]["examples"][
-                    -1
-                ].generated_datetime
-                - badges_and_examples_by_uid[user.id]["examples"][0].generated_datetime
+                progress.num_examples > 1
+                and progress.last_example_datetime - progress.first_example_datetime
                 > datetime.timedelta(days=1)
-                and "FIRST_STEPS"
-                not in [
-                    badge.name
-                    for badge in badges_and_examples_by_uid[user.id]["badges"]
-                ]
+                and "FIRST_STEPS" not in badge_names
             ):
                 async_badges_to_award.append("FIRST_STEPS")
 
-            if user.id in weekly_winners and datetime.date.today().weekday() == 0:
+            if user.id in weekly_winners:
                 async_badges_to_award.append("WEEKLY_WINNER")
 
-            for name in async_badges_to_award:
-                badges_to_add.append(self._badgeobj(user.id, name))
-
-            if "async_badges_to_award" not in metadata:
-                metadata["async_badges_to_award"] = async_badges_to_award
-            else:
-                metadata["async_badges_to_award"] += async_badges_to_award
-            user.metadata_json = util.json_encode(metadata)
+            if async_badges_to_award:
+                for name in async_badges_to_award:
+                    badges_to_add.append(self._badgeobj(user.id, name))
+                if "async_badges_to_award" not in metadata:
+                    metadata["async_badges_to_award"] = async_badges_to_award
+                else:
+                    metadata["async_badges_to_award"] += async_badges_to_award
+                user.metadata_json = util.json_encode(metadata)
 
-        self.createNotificationsAndRemoveBadges(
+        self.dbs.commit()
+        self.bulkCreateNotificationsAndRemoveBadges(
             badges_to_remove, "BADGE_REMOVED_STREAK"
         )
-        self.createNotificationsAndAddBadges(badges_to_add)
+        self.bulkCreateNotificationsAndAddBadges(badges_to_add)
+
+    def handleAsync(self, batch_size=1000):
+        """
+        Awards and removes the badges that are computed asynchronously. Only the
+        users with examples or validations created since the previous run, and
+        the users marked dirty, are processed, in batches of batch_size users;
+        the streaks of the others can't have changed.
+        """
+        state = self.dbs.query(BadgeEngineState).get(1)
+        if state is None:
+            state = BadgeEngineState(
+                id=1, last_eid=0, last_validation_id=0, max_validation_id=0
+            )
+            self.dbs.add(state)
+            self.dbs.commit()
+        # The session is closed by the models used in handleAsyncUsers, so the
+        # state is read here and written back with an update at the end.
+        previous_last_eid = state.last_eid
+        last_validation_id = state.last_validation_id
+        previous_max_validation_id = state.max_validation_id
+
+        # Examples are only counted once they are old enough that no example
+        # with a lower id can still be committed, since users' progress doesn't
+        # go back to the examples below their last_eid.
+        last_eid = (
+            self.dbs.query(Example.id)
+            .filter(
+                Example.generated_datetime
+                <= datetime.datetime.now() - EXAMPLE_COMMIT_LAG
+            )
+            .order_by(Example.generated_datetime.desc(), Example.id.desc())
+            .limit(1)
+            .scalar()
+        )
+        last_eid = max(last_eid or 0, previous_last_eid)
+        # Validations have no creation time, so they are read again by the next
+        # run, which sees the ones that were committed late with lower ids.
+        max_validation_id = self.dbs.query(db.func.max(Validation.id)).scalar() or 0
+
+        uids = {
+            uid
+            for uid, in self.dbs.query(Example.uid)
+            .filter(Example.id > previous_last_eid, Example.id <= last_eid)
+            .distinct()
+        }
+        new_validations = self.dbs.query(Example.uid).join(
+            Validation, Validation.eid == Example.id
+        )
+        new_validations = new_validations.filter(
+            Validation.id > last_validation_id,
+            Validation.id <= max_validation_id,
+        )
+        uids |= {uid for uid, in new_validations.distinct()}
+        # Flags and incorrect validations can break the streaks of examples that
+        # were already counted, so their creators' streaks are recomputed.
+        dirty_uids = {
+            uid
+            for uid, in new_validations.join(
+                BadgeProgress, BadgeProgress.uid == Example.uid
+            )
+            .filter(
+                Example.id <= BadgeProgress.last_eid,
+                Validation.label.in_([LabelEnum.flagged, LabelEnum.incorrect]),
+            )
+            .distinct()
+        }
+        dirty_uids |= {
+            uid
+            for uid, in self.dbs.query(BadgeProgress.uid).filter(
+                BadgeProgress.dirty.is_(True)
+            )
+        }
+        uids |= dirty_uids
+        weekly_winners = set()
+        if datetime.date.today().weekday() == 0:
+            weekly_winners = self.getWeeklyWinners()
+            uids |= weekly_winners
+        uids.discard(None)
+
+        uids = sorted(uids)
+        for start in range(0, len(uids), batch_size):
+            self.handleAsyncUsers(
+                uids[start : start + batch_size], dirty_uids, last_eid, weekly_winners
+            )
+
+        self.dbs.query(BadgeEngineState).filter(BadgeEngineState.id == 1).update(
+            {
+                BadgeEngineState.last_eid: last_eid,
+                BadgeEngineState.last_validation_id: previous_max_validation_id,
+                BadgeEngineState.max_validation_id: max_validation_id,
+                BadgeEngineState.last_run: db.sql.func.now(),
+            },
+            synchronize_session=False,
+        )
+        self.dbs.commit()
         print("Completed job")
 
     def handleUnpublishModel(self, user, model):
@@ -0,0 +1,87 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import sqlalchemy as db
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from .base import Base, BaseModel
+
+
+class BadgeProgress(Base):
+    """
+    Where the async badge job left off for a user: the state of their example
+    and day streaks after their examples up to last_eid, and the streak badges
+    that these examples earn. Rows marked dirty are recomputed from the user's
+    first example on the next run, eg after one of their examples was retracted.
+    """
+
+    __tablename__ = "badge_progress"
+    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+
+    uid = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    last_eid = db.Column(db.Integer, nullable=False, default=0)
+    num_examples = db.Column(db.Integer, nullable=False, default=0)
+    first_example_datetime = db.Column(db.DateTime, nullable=True)
+    last_example_datetime = db.Column(db.DateTime, nullable=True)
+    example_streak = db.Column(db.Integer, nullable=False, default=0)
+    day_streak = db.Column(db.Integer, nullable=False, default=0)
+    previous_example_day = db.Column(db.DateTime, nullable=True)
+    streak_badges_json = db.Column(db.Text)
+    dirty = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f"<BadgeProgress uid {self.uid}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            d[column.name] = getattr(self, column.name)
+        return d
+
+
+class BadgeEngineState(Base):
+    """
+    Where the async badge job left off: the last example it counted, and the
+    validations it read, which it reads again on its next run, from
+    last_validation_id to max_validation_id, in case some were committed late.
+    """
+
+    __tablename__ = "badge_engine_state"
+    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+
+    id = db.Column(db.Integer, primary_key=True)
+    last_eid = db.Column(db.Integer, nullable=False, default=0)
+    last_validation_id = db.Column(db.Integer, nullable=False, default=0)
+    max_validation_id = db.Column(db.Integer, nullable=False, default=0)
+    last_run = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<BadgeEngineState {self.last_eid} {self.max_validation_id}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            d[column.name] = getattr(self, column.name)
+        return d
+
+
+class BadgeProgressModel(BaseModel):
+    def __init__(self):
+        super().__init__(BadgeProgress)
+
+    def markDirty(self, uid):
+        """Makes the next async badge job recompute the streaks of a user."""
+        statement = mysql_insert(BadgeProgress.__table__).values(
+            uid=uid, streak_badges_json="[]", dirty=True
+        )
+        self.dbs.execute(statement.on_duplicate_key_update(dirty=True))
+        self.dbs.commit()
+
+    def markAllDirty(self):
+        self.dbs.query(BadgeProgress).update(
+            {BadgeProgress.dirty: True}, synchronize_session=False
+        )
+        self.dbs.commit()
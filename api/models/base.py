@@ -2,6 +2,8 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import random
+
 import sqlalchemy as db
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -11,6 +13,14 @@ from common.config import config
 
 Base = declarative_base()
 
+RANDOM_KEY_MAX = 2**31 - 1
+
+
+def new_random_key():
+    """Default of the random_key columns used by BaseModel.sampleByRandomKey."""
+    return random.randint(0, RANDOM_KEY_MAX)
+
+
 # now this is very ugly..
 
 
@@ -56,6 +66,48 @@ class BaseModel:
             except db.orm.exc.NoResultFound:
                 return False
 
+    def sampleByRandomKey(self, query, bucket_columns, random_key_column, n=1):
+        """
+        Returns n rows of a query in the order of ORDER BY *bucket_columns,
+        RAND(), without sorting every row: this finds the first bucket that has
+        rows, then reads the rows of that bucket from a random point of
+        random_key_column, wrapping around. With an index on the filtered
+        columns, then bucket_columns, then random_key_column, these are index
+        range scans. bucket_columns can be empty, to sample uniformly.
+        """
+        results = []
+        random_key = new_random_key()
+        while len(results) < n:
+            remaining = query
+            if results:
+                remaining = remaining.filter(
+                    self.model.id.notin_([result.id for result in results])
+                )
+            in_bucket = remaining
+            if bucket_columns:
+                bucket = (
+                    remaining.with_entities(*bucket_columns)
+                    .order_by(*bucket_columns)
+                    .first()
+                )
+                if bucket is None:
+                    break
+                in_bucket = remaining.filter(
+                    *[column == value for column, value in zip(bucket_columns, bucket)]
+                )
+            num_results = len(results)
+            for part in (
+                in_bucket.filter(random_key_column >= random_key),
+                in_bucket.filter(random_key_column < random_key),
+            ):
+                if len(results) < n:
+                    results += (
+                        part.order_by(random_key_column).limit(n - len(results)).all()
+                    )
+            if len(results) == num_results:
+                break
+        return results
+
     def list(self):
         if self.dbs:
             rows = self.dbs.query(self.model).all()
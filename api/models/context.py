@@ -4,13 +4,19 @@
 
 import sqlalchemy as db
 from sqlalchemy import case
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 
-from .base import Base, BaseModel
+from .base import Base, BaseModel, new_random_key
+from .context_validation_result import ContextValidationResult
 
 
 class Context(Base):
     __tablename__ = "contexts"
-    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+    __table_args__ = (
+        db.Index("contexts_least_used", "r_realid", "total_used", "random_key"),
+        db.Index("contexts_least_fooled", "r_realid", "total_fooled", "random_key"),
+        {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -23,10 +29,16 @@ class Context(Base):
 
     metadata_json = db.Column(db.Text)  # e.g. source, or whatever
 
-    total_used = db.Column(db.Integer, default=0)
+    # Counts of the examples of this context, of those that fooled the model,
+    # and of their validations
+    total_used = db.Column(db.Integer, nullable=False, default=0)
+    total_fooled = db.Column(db.Integer, nullable=False, default=0)
+    total_validated = db.Column(db.Integer, nullable=False, default=0)
 
     last_used = db.Column(db.DateTime, nullable=True)
 
+    random_key = db.Column(db.Integer, nullable=False, default=new_random_key)
+
     def __repr__(self):
         return f"<Context {self.context_json}>"
 
@@ -64,51 +76,31 @@ class ContextModel(BaseModel):
         )
 
     def getRandomMin(self, rid, n=1, tags=None):
-        result = self.dbs.query(Context)
+        result = self.dbs.query(Context).filter(Context.r_realid == rid)
 
         if tags:
             result = result.filter(Context.tag.in_(tags))  # noqa
 
-        return (
-            result.filter(Context.r_realid == rid)
-            .order_by(Context.total_used.asc(), db.sql.func.rand())
-            .limit(n)
-            .all()
+        return self.sampleByRandomKey(
+            result, (Context.total_used,), Context.random_key, n
         )
 
     def getRandomLeastFooled(self, rid, n=1, tags=None):
-        from models.example import Example
-
         result = self.dbs.query(Context).filter(Context.r_realid == rid)
+
         if tags:
             result = result.filter(Context.tag.in_(tags))  # noqa
 
-        least_fooled_examples_sub_query = (
-            self.dbs.query(
-                Example.cid,
-                db.sql.func.sum(
-                    db.case(value=Example.model_wrong, whens={1: 1}, else_=0)
-                ).label("num_fooled"),
-            )
-            .group_by(Example.cid)
-            .subquery()
-        )
-
-        return (
-            result.join(
-                least_fooled_examples_sub_query,
-                Context.id == least_fooled_examples_sub_query.c.cid,
-                isouter=True,
-            )
-            .order_by(
-                least_fooled_examples_sub_query.c.num_fooled.asc(), db.sql.func.rand()
-            )
-            .limit(n)
-            .all()
+        return self.sampleByRandomKey(
+            result, (Context.total_fooled,), Context.random_key, n
         )
 
     def getContextValidationResults(
-        self, num_matching_validations, validate_non_fooling=False, example_tags=None
+        self,
+        num_matching_validations,
+        validate_non_fooling=False,
+        example_tags=None,
+        cids=None,
     ):
         from models.example import Example
         from models.validation import Validation, LabelEnum
@@ -150,6 +142,11 @@ class ContextModel(BaseModel):
                 Example.tag.in_(example_tags)
             )
 
+        if cids is not None:
+            example_with_validation = example_with_validation.filter(
+                Example.cid.in_(cids)
+            )
+
         example_with_validation_data = example_with_validation.subquery()
 
         cnt_correct_examples = db.sql.func.sum(
@@ -227,37 +224,117 @@ class ContextModel(BaseModel):
             (cnt_correct_val, cnt_incorrect_val, cnt_flagged_val, cnt_total_val),
         )
 
-    def getRandomValidationFailed(self, rid, num_matching_validations, n=1, tags=None):
-        result = self.dbs.query(Context).filter(Context.r_realid == rid)
-        if tags:
-            result = result.filter(Context.tag.in_(tags))  # noqa
-
+    def refreshValidationResults(self, cids, num_matching_validations):
+        """
+        Recomputes the context_validation_results rows of the given contexts,
+        a list or a query of context ids, reading only their examples and
+        validations.
+        """
         contexts_with_example_stats, _, _, _ = self.getContextValidationResults(
-            num_matching_validations
+            num_matching_validations, cids=cids
         )
-        contexts_with_example_stats = contexts_with_example_stats.subquery()
-        return_result = (
-            result.join(
-                contexts_with_example_stats,
-                contexts_with_example_stats.c.cid == Context.id,
+        cid_to_stats = {
+            cid: [int(count or 0) for count in counts]
+            for cid, *counts in contexts_with_example_stats
+        }
+        rows = []
+        cids_without_stats = []
+        for cid, r_realid in self.dbs.query(Context.id, Context.r_realid).filter(
+            Context.id.in_(cids)
+        ):
+            if cid not in cid_to_stats:
+                # No example of this context fooled the model
+                cids_without_stats.append(cid)
+                continue
+            correct, failed, inflight, pre_val = cid_to_stats[cid]
+            rows.append(
+                {
+                    "cid": cid,
+                    "r_realid": r_realid,
+                    "num_matching_validations": num_matching_validations,
+                    "cnt_correct_examples": correct,
+                    "cnt_failed_examples": failed,
+                    "cnt_inflight_examples": inflight,
+                    "cnt_pre_val_examples": pre_val,
+                    "validation_failed": inflight == 0
+                    and correct == 0
+                    and failed > 0
+                    and pre_val == 0,
+                    "random_key": new_random_key(),
+                }
+            )
+
+        if cids_without_stats:
+            self.dbs.query(ContextValidationResult).filter(
+                ContextValidationResult.cid.in_(cids_without_stats)
+            ).delete(synchronize_session=False)
+        if rows:
+            statement = mysql_insert(ContextValidationResult.__table__).values(rows)
+            statement = statement.on_duplicate_key_update(
+                **{
+                    name: statement.inserted[name]
+                    for name in rows[0]
+                    if name not in ("cid", "random_key")
+                }
+            )
+            self.dbs.execute(statement)
+        self.dbs.commit()
+
+    def rebuildValidationResults(self, rid, num_matching_validations, batch_size=1000):
+        """Recomputes the context_validation_results rows of a whole round."""
+        cids = [
+            cid
+            for cid, in self.dbs.query(Context.id)
+            .filter(Context.r_realid == rid)
+            .order_by(Context.id)
+        ]
+        for start in range(0, len(cids), batch_size):
+            self.refreshValidationResults(
+                cids[start : start + batch_size], num_matching_validations
             )
+
+    def getRandomValidationFailed(self, rid, num_matching_validations, n=1, tags=None):
+        result = (
+            self.dbs.query(Context)
+            .join(ContextValidationResult, ContextValidationResult.cid == Context.id)
+            .filter(ContextValidationResult.r_realid == rid)
+            .filter(ContextValidationResult.validation_failed.is_(True))
             .filter(
-                db.and_(
-                    contexts_with_example_stats.c.cnt_inflight_examples == 0,
-                    contexts_with_example_stats.c.cnt_correct_examples == 0,
-                    contexts_with_example_stats.c.cnt_failed_examples > 0,
-                    contexts_with_example_stats.c.cnt_pre_val_examples == 0,
-                )
+                ContextValidationResult.num_matching_validations
+                == num_matching_validations
             )
-            .order_by(db.sql.func.rand())
-            .limit(n)
         )
+        if tags:
+            result = result.filter(Context.tag.in_(tags))  # noqa
+
+        return self.sampleByRandomKey(result, (), ContextValidationResult.random_key, n)
+
+    def incrementCountDate(self, cid, model_wrong=False):
+        """
+        Counts a new example of the context. Counters are incremented in the
+        database, so that concurrent annotators don't lose each other's counts.
+        """
+        values = {
+            Context.total_used: Context.total_used + 1,
+            Context.last_used: db.sql.func.now(),
+        }
+        if model_wrong:
+            values[Context.total_fooled] = Context.total_fooled + 1
+        self.dbs.query(Context).filter(Context.id == cid).update(
+            values, synchronize_session=False
+        )
+        self.dbs.commit()
 
-        return return_result.all()
+    def incrementFooledCount(self, cid):
+        self.dbs.query(Context).filter(Context.id == cid).update(
+            {Context.total_fooled: Context.total_fooled + 1},
+            synchronize_session=False,
+        )
+        self.dbs.commit()
 
-    def incrementCountDate(self, cid):
-        c = self.get(cid)
-        if c:
-            c.total_used = (c.total_used + 1) if c.total_used is not None else 1
-            c.last_used = db.sql.func.now()
-            self.dbs.commit()
+    def incrementValidatedCount(self, cid):
+        self.dbs.query(Context).filter(Context.id == cid).update(
+            {Context.total_validated: Context.total_validated + 1},
+            synchronize_session=False,
+        )
+        self.dbs.commit()
@@ -0,0 +1,58 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import sqlalchemy as db
+
+from .base import Base, BaseModel, new_random_key
+
+
+class ContextValidationResult(Base):
+    """
+    How the examples that fooled the model in a context fared in validation, as
+    computed by ContextModel.getContextValidationResults with the task's
+    num_matching_validations. Rows are recomputed by
+    ContextModel.refreshValidationResults whenever the examples or validations
+    of their context change, so that contexts whose examples all failed
+    validation can be sampled through the (r_realid, validation_failed,
+    random_key) index.
+    """
+
+    __tablename__ = "context_validation_results"
+    __table_args__ = (
+        db.Index(
+            "context_validation_results_sampling",
+            "r_realid",
+            "validation_failed",
+            "random_key",
+        ),
+        {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"},
+    )
+
+    cid = db.Column(
+        db.Integer, db.ForeignKey("contexts.id", ondelete="CASCADE"), primary_key=True
+    )
+    r_realid = db.Column(
+        db.Integer, db.ForeignKey("rounds.id", ondelete="CASCADE"), nullable=False
+    )
+    num_matching_validations = db.Column(db.Integer, nullable=False)
+    cnt_correct_examples = db.Column(db.Integer, nullable=False, default=0)
+    cnt_failed_examples = db.Column(db.Integer, nullable=False, default=0)
+    cnt_inflight_examples = db.Column(db.Integer, nullable=False, default=0)
+    cnt_pre_val_examples = db.Column(db.Integer, nullable=False, default=0)
+    validation_failed = db.Column(db.Boolean, nullable=False, default=False)
+    random_key = db.Column(db.Integer, nullable=False, default=new_random_key)
+
+    def __repr__(self):
+        return f"<ContextValidationResult cid {self.cid}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            d[column.name] = getattr(self, column.name)
+        return d
+
+
+class ContextValidationResultModel(BaseModel):
+    def __init__(self):
+        super().__init__(ContextValidationResult)
@@ -6,6 +6,7 @@ import enum
 import sqlalchemy as db
 
 from .base import Base, BaseModel
+from .leaderboard_row import LeaderboardRowModel
 
 
 class AccessTypeEnum(enum.Enum):
@@ -72,10 +73,19 @@ class DatasetModel(BaseModel):
             return False
 
     def delete(self, dataset):
+        tid = dataset.tid
         self.dbs.delete(dataset)
         self.dbs.commit()
+        LeaderboardRowModel().bumpVersionsByTid(tid)
         return True
 
+    def update(self, id, kwargs):
+        super().update(id, kwargs)
+        # Dataset names are shown on the dynaboard.
+        if "name" in kwargs:
+            tid = self.dbs.query(Dataset.tid).filter(Dataset.id == id).scalar()
+            LeaderboardRowModel().bumpVersionsByTid(tid)
+
     def getByTid(self, task_id):
         try:
             return self.dbs.query(Dataset).filter(Dataset.tid == task_id).all()
@@ -99,6 +109,17 @@ class DatasetModel(BaseModel):
         except db.orm.exc.NoResultFound:
             return False
 
+    def getIdsByNames(self, names):
+        names = list(names)
+        if not names:
+            return {}
+        return {
+            name: did
+            for name, did in self.dbs.query(Dataset.name, Dataset.id).filter(
+                Dataset.name.in_(names)
+            )
+        }
+
     def to_dict(self, dataset):
         model_dict = {}
         for c in dataset.__table__.columns:
@@ -2,20 +2,23 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
 import hashlib
 import tempfile
 
 import sqlalchemy as db
-import yaml
 from dynalab.tasks.task_io import TaskIO
 from sqlalchemy import case
 
 import common.helpers as util
 from common.logging import logger
+from common.task_config import get_task_config
 from models.context import Context
+from models.example_tag_validator import ExampleTagValidator
 from models.model import Model
 from models.round import Round
 from models.validation import LabelEnum, ModeEnum, Validation
+from models.validation_queue_entry import ValidationQueueEntry, get_priority
 
 from .base import Base, BaseModel
 from .context import ContextModel
@@ -48,7 +51,7 @@ class Example(Base):
     retracted = db.Column(db.Boolean, default=False)
     flagged = db.Column(db.Boolean, default=False)
 
-    generated_datetime = db.Column(db.DateTime)
+    generated_datetime = db.Column(db.DateTime, index=True)
 
     # time context shown - time example provided
     time_elapsed = db.Column(db.Time)
@@ -141,7 +144,7 @@ class ExampleModel(BaseModel):
                 )
 
                 with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-                    task_config = yaml.load(task.config_yaml, yaml.SafeLoader)
+                    task_config = get_task_config(task).config
                     tmp.write(
                         util.json_encode(
                             {
@@ -155,7 +158,7 @@ class ExampleModel(BaseModel):
 
                 # This is to check if we have a pre-dynatask dynalab model
                 with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-                    task_config = yaml.load(task.config_yaml, yaml.SafeLoader)
+                    task_config = copy.deepcopy(get_task_config(task).config)
                     if task.task_code in ("hs", "sentiment"):
                         task_config["context"] = []
                     name_to_config_obj = get_name_to_full_annotation_config_obj(
@@ -304,6 +307,11 @@ class ExampleModel(BaseModel):
 
             self.dbs.add(e)
             self.dbs.flush()
+            self.dbs.add(
+                ValidationQueueEntry(
+                    eid=e.id, r_realid=c.r_realid, priority=get_priority(model_wrong)
+                )
+            )
             self.dbs.commit()
             logger.info("Added example (%s)" % (e.id))
         except Exception as error_message:
@@ -400,6 +408,47 @@ class ExampleModel(BaseModel):
         except db.orm.exc.NoResultFound:
             return False
 
+    def refreshValidationQueueEntry(self, eid):
+        """
+        Recomputes the validation queue entry of an example from its
+        validations, eg after it was retracted or its model_wrong changed.
+        """
+        example = self.get(eid)
+        self.dbs.query(ValidationQueueEntry).filter(
+            ValidationQueueEntry.eid == eid
+        ).delete(synchronize_session=False)
+        cnt_correct, cnt_incorrect, cnt_flagged, cnt_owner_validated = (
+            self.dbs.query(
+                db.sql.func.sum(
+                    case([(Validation.label == LabelEnum.correct, 1)], else_=0)
+                ),
+                db.sql.func.sum(
+                    case([(Validation.label == LabelEnum.incorrect, 1)], else_=0)
+                ),
+                db.sql.func.sum(
+                    case([(Validation.label == LabelEnum.flagged, 1)], else_=0)
+                ),
+                db.sql.func.sum(
+                    case([(Validation.mode == ModeEnum.owner, 1)], else_=0)
+                ),
+            )
+            .filter(Validation.eid == eid)
+            .one()
+        )
+        if not example.retracted and not cnt_owner_validated:
+            self.dbs.add(
+                ValidationQueueEntry(
+                    eid=eid,
+                    r_realid=example.context.r_realid,
+                    priority=get_priority(example.model_wrong),
+                    total_verified=example.total_verified or 0,
+                    cnt_correct=cnt_correct or 0,
+                    cnt_incorrect=cnt_incorrect or 0,
+                    cnt_flagged=cnt_flagged or 0,
+                )
+            )
+        self.dbs.commit()
+
     def getRandom(
         self,
         rid,
@@ -409,96 +458,73 @@ class ExampleModel(BaseModel):
         my_uid=None,
         tags=None,
         turk=False,
+        unique_validators_for_example_tags=False,
     ):
-        cnt_correct = db.sql.func.sum(
-            case([(Validation.label == LabelEnum.correct, 1)], else_=0)
-        ).label("cnt_correct")
-        cnt_flagged = db.sql.func.sum(
-            case([(Validation.label == LabelEnum.flagged, 1)], else_=0)
-        ).label("cnt_flagged")
-        cnt_incorrect = db.sql.func.sum(
-            case([(Validation.label == LabelEnum.incorrect, 1)], else_=0)
-        ).label("cnt_incorrect")
-        cnt_owner_validated = db.sql.func.sum(
-            case([(Validation.mode == ModeEnum.owner, 1)], else_=0)
-        ).label("cnt_owner_validated")
         result = (
             self.dbs.query(Example)
-            .join(Context, Example.cid == Context.id)
-            .filter(Context.r_realid == rid)
-            .filter(Example.retracted == False)  # noqa
+            .join(ValidationQueueEntry, ValidationQueueEntry.eid == Example.id)
+            .filter(ValidationQueueEntry.r_realid == rid)
+            .filter(ValidationQueueEntry.cnt_correct < num_matching_validations)
+            .filter(ValidationQueueEntry.cnt_flagged < num_matching_validations)
+            .filter(ValidationQueueEntry.cnt_incorrect < num_matching_validations)
         )
 
         if tags:
             result = result.filter(Example.tag.in_(tags))  # noqa
 
         if not validate_non_fooling:
-            result = result.filter(Example.model_wrong == True)  # noqa
-
-        result_partially_validated = (
-            result.join(Validation, Example.id == Validation.eid)
-            .group_by(Validation.eid)
-            .having(
-                db.and_(
-                    cnt_correct < num_matching_validations,
-                    cnt_flagged < num_matching_validations,
-                    cnt_incorrect < num_matching_validations,
-                    cnt_owner_validated == 0,
-                )
-            )
-        )
+            result = result.filter(ValidationQueueEntry.priority == get_priority(True))
+
         if my_uid is not None:
             if turk:
-                c = case(
-                    [
-                        (
-                            db.text(
-                                "validations.metadata_json is not NULL and "
-                                + "JSON_EXTRACT(validations.metadata_json, "
-                                + "'$.annotator_id') = "
-                                + '"'
-                                + my_uid
-                                + '"'
-                            ),
-                            1,
-                        )
-                    ],
-                    else_=0,
+                validated_by_me = Validation.metadata_json.isnot(None) & (
+                    db.sql.func.json_extract(Validation.metadata_json, "$.annotator_id")
+                    == my_uid
                 )
-            else:
-                c = case([(Validation.uid == my_uid, 1)], else_=0)
-            cnt_uid = db.sql.func.sum(c).label("cnt_uid")
-            result_partially_validated = result_partially_validated.group_by(
-                Validation.eid
-            ).having(cnt_uid == 0)
-        result_not_validated = result.filter(
-            db.not_(db.exists().where(Validation.eid == Example.id))
-        )
-        result = result_partially_validated.union(result_not_validated)
-        if my_uid is not None:
-            if turk:
                 result = result.filter(
-                    db.text(
-                        "examples_metadata_json is NULL "
-                        + "or JSON_EXTRACT(examples_metadata_json, "
-                        + "'$.annotator_id') != "
-                        + '"'
-                        + my_uid
-                        + '"'
+                    Example.metadata_json.is_(None)
+                    | (
+                        db.sql.func.json_extract(
+                            Example.metadata_json, "$.annotator_id"
+                        )
+                        != my_uid
                     )
                 )
             else:
+                validated_by_me = Validation.uid == my_uid
                 result = result.filter(Example.uid != my_uid)
-        result = (
-            result.order_by(
-                db.not_(Example.model_wrong),
-                Example.total_verified.asc(),
-                db.sql.func.rand(),
+            result = result.filter(
+                db.not_(
+                    db.exists().where(
+                        db.and_(Validation.eid == Example.id, validated_by_me)
+                    )
+                )
             )
-            .limit(n)
-            .all()
+
+            if unique_validators_for_example_tags:
+                # Validators can validate only one example per tag of the task
+                tid = self.dbs.query(Round.tid).filter(Round.id == rid).scalar()
+                result = result.filter(
+                    db.not_(
+                        db.exists().where(
+                            db.and_(
+                                ExampleTagValidator.tid == tid,
+                                ExampleTagValidator.tag_hash
+                                == db.sql.func.sha1(Example.tag),
+                                ExampleTagValidator.uid == (0 if turk else my_uid),
+                                ExampleTagValidator.annotator_id
+                                == (my_uid if turk else ""),
+                            )
+                        )
+                    )
+                )
+
+        return self.sampleByRandomKey(
+            result,
+            (ValidationQueueEntry.priority, ValidationQueueEntry.total_verified),
+            ValidationQueueEntry.random_key,
+            n,
         )
-        return result
 
     def getRandomFiltered(
         self,
@@ -511,70 +537,39 @@ class ExampleModel(BaseModel):
         n=1,
         tags=None,
     ):
-        cnt_owner_validated = db.sql.func.sum(
-            case([(Validation.mode == ModeEnum.owner, 1)], else_=0)
-        ).label("cnt_owner_validated")
+        cnt_correct = ValidationQueueEntry.cnt_correct
+        cnt_incorrect = ValidationQueueEntry.cnt_incorrect
+        cnt_flagged = ValidationQueueEntry.cnt_flagged
         result = (
             self.dbs.query(Example)
-            .join(Context, Example.cid == Context.id)
-            .filter(Context.r_realid == rid)
-            .filter(Example.retracted == False)  # noqa
+            .join(ValidationQueueEntry, ValidationQueueEntry.eid == Example.id)
+            .filter(ValidationQueueEntry.r_realid == rid)
+            .filter(cnt_flagged <= max_num_flags, cnt_flagged >= min_num_flags)
+            .filter(
+                db.or_(
+                    db.and_(
+                        cnt_incorrect > cnt_correct,
+                        cnt_correct >= min_num_disagreements,
+                        cnt_correct <= max_num_disagreements,
+                    ),
+                    db.and_(
+                        cnt_correct >= cnt_incorrect,
+                        cnt_incorrect >= min_num_disagreements,
+                        cnt_incorrect <= max_num_disagreements,
+                    ),
+                )
+            )
         )
 
         if tags:
             result = result.filter(Example.tag.in_(tags))  # noqa
 
         if not validate_non_fooling:
-            result = result.filter(Example.model_wrong == True)  # noqa
+            result = result.filter(ValidationQueueEntry.priority == get_priority(True))
 
-        result_not_validated = result.filter(
-            db.not_(db.exists().where(Validation.eid == Example.id))
-        )
-
-        result = (
-            result.join(Validation, Example.id == Validation.eid)
-            .group_by(Validation.eid)
-            .having(cnt_owner_validated == 0)
-        )
-
-        cnt_flagged = db.sql.func.sum(
-            case([(Validation.label == LabelEnum.flagged, 1)], else_=0)
-        ).label("cnt_flagged")
-        result = result.having(
-            db.and_(cnt_flagged <= max_num_flags, cnt_flagged >= min_num_flags)
-        )
-
-        cnt_correct = db.sql.func.sum(
-            case([(Validation.label == LabelEnum.correct, 1)], else_=0)
-        ).label("cnt_correct")
-        cnt_incorrect = db.sql.func.sum(
-            case([(Validation.label == LabelEnum.incorrect, 1)], else_=0)
-        ).label("cnt_incorrect")
-        result = result.having(
-            db.or_(
-                db.and_(
-                    cnt_incorrect > cnt_correct,
-                    cnt_correct >= min_num_disagreements,
-                    cnt_correct <= max_num_disagreements,
-                ),
-                db.and_(
-                    cnt_correct >= cnt_incorrect,
-                    cnt_incorrect >= min_num_disagreements,
-                    cnt_incorrect <= max_num_disagreements,
-                ),
-            )
-        )
-
-        if min_num_disagreements == 0 and min_num_flags == 0:
-            result = result.union(result_not_validated)
-
-        result = (
-            result.order_by(
-                db.not_(Example.model_wrong),
-                Example.total_verified.asc(),
-                db.sql.func.rand(),
-            )
-            .limit(n)
-            .all()
+        return self.sampleByRandomKey(
+            result,
+            (ValidationQueueEntry.priority, ValidationQueueEntry.total_verified),
+            ValidationQueueEntry.random_key,
+            n,
         )
-        return result
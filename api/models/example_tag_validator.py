@@ -0,0 +1,94 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+
+import sqlalchemy as db
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from .base import Base, BaseModel
+
+
+def get_tag_hash(tag):
+    """Same as MySQL's SHA1(tag), so that it can be compared with examples.tag."""
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()
+
+
+class ExampleTagValidator(Base):
+    """
+    Records that a validator validated an example with a given tag, for tasks
+    with unique_validators_for_example_tags, where each validator may validate
+    only one example per tag. Validators are either users, with their uid, or
+    turkers, with uid 0 and their annotator_id, so that the whole row can be the
+    primary key and serve the lookups.
+    """
+
+    __tablename__ = "example_tag_validators"
+    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+
+    tid = db.Column(
+        db.Integer, db.ForeignKey("tasks.id", ondelete="CASCADE"), primary_key=True
+    )
+    tag_hash = db.Column(db.String(length=40), primary_key=True)
+    uid = db.Column(db.Integer, primary_key=True, default=0)
+    annotator_id = db.Column(db.String(length=255), primary_key=True, default="")
+    tag = db.Column(db.Text)
+
+    def __repr__(self):
+        return f"<ExampleTagValidator tid {self.tid} uid {self.uid}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            d[column.name] = getattr(self, column.name)
+        return d
+
+
+class ExampleTagValidatorModel(BaseModel):
+    def __init__(self):
+        super().__init__(ExampleTagValidator)
+
+    def bulkCreate(self, rows):
+        """
+        Records validators given as dicts with tid, tag and either uid or
+        annotator_id, in a single statement, ignoring the ones already recorded.
+        """
+        if not rows:
+            return
+        statement = (
+            mysql_insert(ExampleTagValidator.__table__)
+            .prefix_with("IGNORE")
+            .values(
+                [
+                    {
+                        "tid": row["tid"],
+                        "tag_hash": get_tag_hash(row["tag"]),
+                        "uid": row.get("uid") or 0,
+                        "annotator_id": row.get("annotator_id") or "",
+                        "tag": row["tag"],
+                    }
+                    for row in rows
+                ]
+            )
+        )
+        self.dbs.execute(statement)
+        self.dbs.commit()
+
+    def create(self, tid, tag, uid=None, annotator_id=None):
+        self.bulkCreate(
+            [{"tid": tid, "tag": tag, "uid": uid, "annotator_id": annotator_id}]
+        )
+
+    def exists(self, tid, tag, uid=None, annotator_id=None):
+        """Whether the validator already validated an example with this tag."""
+        return self.dbs.query(
+            db.exists().where(
+                db.and_(
+                    ExampleTagValidator.tid == tid,
+                    ExampleTagValidator.tag_hash == get_tag_hash(tag),
+                    ExampleTagValidator.uid == (uid or 0),
+                    ExampleTagValidator.annotator_id == (annotator_id or ""),
+                )
+            )
+        ).scalar()
@@ -0,0 +1,131 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import datetime
+
+import sqlalchemy as db
+
+from common import helpers as util
+from models.user import User
+
+from .base import Base, BaseModel
+from .model import Model
+
+
+class LeaderboardRow(Base):
+    """
+    Materialized projection of the scores table, with one row per model. The
+    metrics of every dataset that the model was scored on are extracted from the
+    score columns and metadata_json, and stored as {did: {metric: value}}.
+    """
+
+    __tablename__ = "leaderboard_rows"
+    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+
+    id = db.Column(db.Integer, primary_key=True)
+    tid = db.Column(db.Integer, db.ForeignKey("tasks.id"), nullable=False, index=True)
+    mid = db.Column(db.Integer, db.ForeignKey("models.id"), nullable=False, unique=True)
+
+    metrics_json = db.Column(db.Text, nullable=False)
+    version = db.Column(db.Integer, default=1, nullable=False)
+    last_updated = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<LeaderboardRow tid {self.tid} mid {self.mid}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            d[column.name] = getattr(self, column.name)
+        return d
+
+    def get_did_to_metrics(self):
+        return {
+            int(did): metrics
+            for did, metrics in util.json_decode(self.metrics_json).items()
+        }
+
+
+class LeaderboardRowModel(BaseModel):
+    def __init__(self):
+        super().__init__(LeaderboardRow)
+
+    def upsert(self, tid, mid, did_to_metrics):
+        row = self.dbs.query(LeaderboardRow).filter(LeaderboardRow.mid == mid).first()
+        if not did_to_metrics:
+            if row:
+                self.dbs.delete(row)
+                self.dbs.commit()
+            return
+
+        metrics_json = util.json_encode(
+            {str(did): metrics for did, metrics in did_to_metrics.items()}
+        )
+        if row:
+            row.tid = tid
+            row.metrics_json = metrics_json
+            row.version = row.version + 1
+            row.last_updated = datetime.datetime.utcnow()
+        else:
+            self.dbs.add(
+                LeaderboardRow(
+                    tid=tid,
+                    mid=mid,
+                    metrics_json=metrics_json,
+                    version=1,
+                    last_updated=datetime.datetime.utcnow(),
+                )
+            )
+        self.dbs.commit()
+
+    def bumpVersionByMid(self, mid):
+        """For changes to the model fields that are shown with the row."""
+        self.bumpVersions(LeaderboardRow.mid == mid)
+
+    def bumpVersionsByTid(self, tid):
+        """For changes to the datasets that the rows of the task are shown with."""
+        self.bumpVersions(LeaderboardRow.tid == tid)
+
+    def bumpVersions(self, *filters):
+        self.dbs.query(LeaderboardRow).filter(*filters).update(
+            {
+                LeaderboardRow.version: LeaderboardRow.version + 1,
+                LeaderboardRow.last_updated: datetime.datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        self.dbs.commit()
+
+    def getVersionByTid(self, tid):
+        """
+        Changes whenever a row of the task is inserted, updated, deleted or
+        bumped, from any process.
+        """
+        return tuple(
+            self.dbs.query(
+                db.func.count(LeaderboardRow.id),
+                db.func.sum(LeaderboardRow.version),
+                db.func.max(LeaderboardRow.last_updated),
+            )
+            .filter(LeaderboardRow.tid == tid)
+            .one()
+        )
+
+    def getByTidWithModelAndUser(self, tid, include_unpublished_models=True):
+        query = (
+            self.dbs.query(
+                LeaderboardRow,
+                Model.name,
+                Model.uid,
+                Model.is_published,
+                Model.is_anonymous,
+                User.username,
+            )
+            .join(Model, Model.id == LeaderboardRow.mid)
+            .join(User, User.id == Model.uid)
+            .filter(LeaderboardRow.tid == tid)
+        )
+        if not include_unpublished_models:
+            query = query.filter(Model.is_published)
+        return query.all()
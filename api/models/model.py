@@ -6,6 +6,7 @@ import enum
 import sqlalchemy as db
 
 from common import helpers as util
+from common.dynaboard import dynaboard_cache
 from models.round import Round
 from models.user import User
 
@@ -41,9 +42,6 @@ class Model(Base):
     longdesc = db.Column(db.Text)
     papers = db.Column(db.Text)
 
-    # Dataset eval info
-    evaluation_status_json = db.Column(db.Text)
-
     # Model cards
     params = db.Column(db.BigInteger)
     languages = db.Column(db.Text)
@@ -88,14 +86,24 @@ class ModelModel(BaseModel):
         return m
 
     def delete(self, model):
+        tid = model.tid
         self.dbs.delete(model)
         self.dbs.commit()
+        dynaboard_cache.invalidate(tid)
         return True
 
     def update(self, id, **kwargs):
         u = self.dbs.query(Model).filter(Model.id == id)
         u.update(kwargs)
         self.dbs.commit()
+        # These fields are shown on the dynaboard. The leaderboard row is bumped
+        # so that the other processes drop their cached dynaboards too.
+        if {"name", "is_published", "is_anonymous"} & set(kwargs):
+            from .leaderboard_row import LeaderboardRowModel
+
+            tid = self.dbs.query(Model.tid).filter(Model.id == id).scalar()
+            LeaderboardRowModel().bumpVersionByMid(id)
+            dynaboard_cache.invalidate(tid)
 
     def getUnpublishedModelByMid(self, id):
         # Model owner to fetch by id
@@ -0,0 +1,93 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import datetime
+import enum
+
+import sqlalchemy as db
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from .base import Base, BaseModel
+
+
+class EvaluationStatusEnum(enum.Enum):
+    pre_evaluation = "pre_evaluation"
+    evaluating = "evaluating"
+    completed = "completed"
+    failed = "failed"
+
+
+class ModelDatasetEvaluationStatus(Base):
+    """The status of the evaluation of a model on a dataset."""
+
+    __tablename__ = "model_dataset_evaluation_status"
+    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+
+    mid = db.Column(
+        db.Integer, db.ForeignKey("models.id", ondelete="CASCADE"), primary_key=True
+    )
+    did = db.Column(
+        db.Integer,
+        db.ForeignKey("datasets.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    status = db.Column(db.Enum(EvaluationStatusEnum), nullable=False)
+    last_updated = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<ModelDatasetEvaluationStatus mid {self.mid} did {self.did}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            if column.name == "status":
+                d[column.name] = self.status.name
+            else:
+                d[column.name] = getattr(self, column.name)
+        return d
+
+
+class ModelDatasetEvaluationStatusModel(BaseModel):
+    def __init__(self):
+        super().__init__(ModelDatasetEvaluationStatus)
+
+    def bulkUpsert(self, mid_did_to_status):
+        """
+        Sets the statuses given as {(mid, did): status name}, in a single
+        statement. Rows are only ever written whole, so concurrent writers can't
+        lose each other's updates.
+        """
+        if not mid_did_to_status:
+            return
+        now = datetime.datetime.utcnow()
+        statement = mysql_insert(ModelDatasetEvaluationStatus.__table__).values(
+            [
+                {
+                    "mid": mid,
+                    "did": did,
+                    "status": EvaluationStatusEnum[status],
+                    "last_updated": now,
+                }
+                for (mid, did), status in mid_did_to_status.items()
+            ]
+        )
+        statement = statement.on_duplicate_key_update(
+            status=statement.inserted.status,
+            last_updated=statement.inserted.last_updated,
+        )
+        self.dbs.execute(statement)
+        self.dbs.commit()
+
+    def upsert(self, mid, did, status):
+        self.bulkUpsert({(mid, did): status})
+
+    def getByMid(self, mid):
+        """Returns {did: status name} for the datasets the model has a status on."""
+        return {
+            did: status.name
+            for did, status in self.dbs.query(
+                ModelDatasetEvaluationStatus.did, ModelDatasetEvaluationStatus.status
+            ).filter(ModelDatasetEvaluationStatus.mid == mid)
+        }
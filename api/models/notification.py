@@ -2,11 +2,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from collections import Counter, defaultdict
+
 import sqlalchemy as db
 
 from common import helpers as util
 from common.logging import logger
-from models.user import UserModel
+from models.user import User, UserModel
 
 from .base import Base, BaseModel
 
@@ -88,3 +90,29 @@ class NotificationModel(BaseModel):
             return False
 
         return n.id
+
+    def bulkCreate(self, notifications):
+        """
+        Creates notifications given as (uid, type, message) tuples with a single
+        insert, and increments the unseen notification counts of their users
+        with one update per distinct number of new notifications.
+        """
+        if not notifications:
+            return
+        self.dbs.execute(
+            Notification.__table__.insert().values(created=db.sql.func.now()),
+            [
+                {"uid": uid, "type": type, "message": message, "seen": False}
+                for uid, type, message in notifications
+            ],
+        )
+        uids_by_count = defaultdict(list)
+        for uid, count in Counter(uid for uid, _, _ in notifications).items():
+            uids_by_count[count].append(uid)
+        for count, uids in uids_by_count.items():
+            self.dbs.query(User).filter(User.id.in_(uids)).update(
+                {User.unseen_notifications: User.unseen_notifications + count},
+                synchronize_session=False,
+            )
+        self.dbs.commit()
+        logger.info("Added %s notifications" % len(notifications))
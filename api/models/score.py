@@ -2,21 +2,37 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import math
-
-import pandas as pd
+import numpy as np
 import sqlalchemy as db
 
 import common.helpers as util
+from common.dynaboard import (
+    DynaboardTensor,
+    dynaboard_cache,
+    dynascore,
+    nan_to_zero,
+    top_k_order,
+)
 from models.dataset import AccessTypeEnum, Dataset
 from models.round import Round
 from models.task import TaskModel
 from models.user import User
 
 from .base import Base, BaseModel
+from .leaderboard_row import LeaderboardRowModel
 from .model import Model
 
 
+LEADERBOARD_SCORE_COLUMNS = (
+    "perf",
+    "perf_std",
+    "memory_utilization",
+    "examples_per_second",
+    "fairness",
+    "robustness",
+)
+
+
 class Score(Base):
     __tablename__ = "scores"
     __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
@@ -53,24 +69,58 @@ class Score(Base):
             d[column.name] = getattr(self, column.name)
         return d
 
+    def get_leaderboard_metrics(self):
+        # Columns take precedence over metadata_json, unless they are null.
+        metrics = {}
+        if self.metadata_json is not None:
+            for name, value in util.json_decode(self.metadata_json).items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metrics[name] = value
+        for name in LEADERBOARD_SCORE_COLUMNS:
+            value = getattr(self, name)
+            if value is not None:
+                metrics[name] = value
+        return metrics
+
 
 class ScoreModel(BaseModel):
     def __init__(self):
         super().__init__(Score)
+        self.lrm = LeaderboardRowModel()
+
+    def refreshLeaderboardRow(self, mid):
+        """
+        Rebuilds the leaderboard row of a model from its scores. This needs to be
+        called after every write to the scores of the model.
+        """
+        tid = self.dbs.query(Model.tid).filter(Model.id == mid).scalar()
+        did_to_metrics = {}
+        for score in (
+            self.dbs.query(Score).filter(Score.mid == mid).order_by(Score.id.asc())
+        ):
+            did_to_metrics[score.did] = score.get_leaderboard_metrics()
+        self.lrm.upsert(tid, mid, did_to_metrics)
+        dynaboard_cache.invalidate(tid)
 
     def create(self, r_realid, model_id, **kwargs):
         m = Score(r_realid=r_realid, mid=model_id, **kwargs)
         self.dbs.add(m)
-        return self.dbs.commit()
+        result = self.dbs.commit()
+        self.refreshLeaderboardRow(model_id)
+        return result
 
     def update(self, id, **kwargs):
         u = self.dbs.query(Score).filter(Score.id == id)
         u.update(kwargs)
         self.dbs.commit()
+        mid = self.dbs.query(Score.mid).filter(Score.id == id).scalar()
+        self.refreshLeaderboardRow(mid)
 
     def delete(self, score):
+        mid = score.mid
         self.dbs.delete(score)
         self.dbs.commit()
+        self.refreshLeaderboardRow(mid)
         return True
 
     def bulk_create(self, model_id, score_objs=[], raw_upload_data=""):
@@ -94,7 +144,9 @@ class ScoreModel(BaseModel):
                 for score_obj in score_objs
             ]
         )
-        return self.dbs.commit()
+        result = self.dbs.commit()
+        self.refreshLeaderboardRow(model_id)
+        return result
 
     def getLeaderboardTopPerformingTags(
         self, tid, limit=5, offset=0, specific_tag=None
@@ -187,56 +239,76 @@ class ScoreModel(BaseModel):
             }
         return util.json_encode(dataset_name_to_top_tag_performances_cutoff)
 
-    # calculate the dynascore
-    # normalization is automatically done via AMRS
-    # e.g., raw FLOPs are on the scale of 10e7 but the AMRS-converted compute is
-    # at approximately the same scale as all the other metrics (not necessarily
-    # in a fixed range like [0, 100], though)
-    def dynascore(
-        self,
-        perf_metric_field_name,
-        data,
-        weights,
-        direction_multipliers,
-        offsets,
-        delta_cutoff_proportion=0.0001,
+    def _loadDynaboardTensor(
+        self, tid, ordered_dids, field_names, include_unpublished_models
     ):
-
-        converted_data = data.copy(deep=True)
-        converted_data.sort_values(perf_metric_field_name, inplace=True)
-        for metric in list(data):
-            converted_data[metric] = (
-                direction_multipliers[metric] * converted_data[metric] + offsets[metric]
+        rows = self.lrm.getByTidWithModelAndUser(tid, include_unpublished_models)
+
+        # Only models with a complete set of scores go on the leaderboard. Unclear
+        # what the "null" values should be if we wanted to complete them.
+        model_infos = []
+        values = []
+        for row, name, uid, is_published, is_anonymous, username in rows:
+            did_to_metrics = row.get_did_to_metrics()
+            model_values = [
+                [
+                    did_to_metrics.get(did, {}).get(field_name)
+                    for field_name in field_names
+                ]
+                for did in ordered_dids
+            ]
+            if any(None in dataset_values for dataset_values in model_values):
+                continue
+            model_infos.append(
+                {
+                    "id": row.mid,
+                    "name": name,
+                    "uid": uid,
+                    "username": username,
+                    "is_published": is_published,
+                    "is_anonymous": is_anonymous,
+                }
             )
+            values.append(model_values)
+        if not model_infos:
+            return DynaboardTensor.empty(field_names)
 
-        converted_data["dynascore"] = 0
+        did_to_name = dict(
+            self.dbs.query(Dataset.id, Dataset.name).filter(
+                Dataset.id.in_(ordered_dids)
+            )
+        )
+        order = sorted(range(len(model_infos)), key=lambda i: model_infos[i]["id"])
+        return DynaboardTensor(
+            [model_infos[i] for i in order],
+            [{"id": did, "name": did_to_name.get(did)} for did in ordered_dids],
+            field_names,
+            np.array([values[i] for i in order], dtype=float),
+        )
 
-        denominator = sum(weights.values())
-        for key in weights:
-            weights[key] /= denominator
+    def getDynaboardTensor(self, tid, ordered_dids, field_names):
+        """
+        Returns the (model x dataset x metric) scores of a task, from the cache when
+        it is still up to date with the leaderboard rows of the task.
+        """
+        tm = TaskModel()
+        task = tm.get(tid)
+        include_unpublished_models = task.unpublished_models_in_leaderboard
 
-        # We don't want small denominators to make AMRS super sensitive to noise in
-        # the model submissions.
-        delta = converted_data.diff()
-        delta_threshold = (
-            converted_data[perf_metric_field_name].max() * delta_cutoff_proportion
+        key = (
+            tid,
+            tuple(ordered_dids),
+            tuple(field_names),
+            include_unpublished_models,
         )
-        satisfied_indices = []
-        for index in range(len(delta[perf_metric_field_name])):
-            if abs(delta[perf_metric_field_name][index]) > delta_threshold:
-                satisfied_indices.append(index)
-
-        for metric in list(data):
-            AMRS = (
-                delta[metric][satisfied_indices].abs()
-                / delta[perf_metric_field_name][satisfied_indices]
-            ).mean(skipna=True)
-            converted_data[metric] = converted_data[metric] / abs(AMRS)
-            converted_data["dynascore"] += converted_data[metric] * weights.get(
-                metric, 0
+        version = self.lrm.getVersionByTid(tid)
+        tensor = dynaboard_cache.get(key, version)
+        if tensor is None:
+            tensor = self._loadDynaboardTensor(
+                tid, ordered_dids, field_names, include_unpublished_models
             )
-
-        return converted_data
+            dynaboard_cache.set(key, version, tensor)
+        return tensor
 
     def getDynaboardByTask(
         self,
@@ -249,207 +321,105 @@ class ScoreModel(BaseModel):
         limit=5,
         offset=0,
     ):
-        tm = TaskModel()
-        task = tm.get(tid)
-        include_unpublished_models = task.unpublished_models_in_leaderboard
-
         ordered_dids = [
             did_and_weight["did"] for did_and_weight in ordered_dids_with_weight
         ]
-        try:
-            scores_users_datasets_models = (
-                self.dbs.query(Score, User, Dataset, Model)
-                .join(Dataset, Dataset.id == Score.did)
-                .join(Model, Score.mid == Model.id)
-                .join(User, User.id == Model.uid)
-                .filter(Model.tid == tid)
-                .filter(Score.did.in_(ordered_dids))
-            )
-            if not include_unpublished_models:
-                scores_users_datasets_models = scores_users_datasets_models.filter(
-                    Model.is_published
-                )
-
-            scores, users, datasets, models = zip(*scores_users_datasets_models)
-        except Exception:
-            return util.json_encode({"count": 0, "data": []})
-
-        scores, users, datasets, models = (
-            set(scores),
-            set(users),
-            set(datasets),
-            set(models),
+        ordered_metric_field_names = [
+            metric_info["field_name"]
+            for metric_info in ordered_metrics_with_weight_and_conversion
+        ]
+        tensor = self.getDynaboardTensor(tid, ordered_dids, ordered_metric_field_names)
+        count = len(tensor)
+        if count == 0 or limit <= 0 or offset >= count:
+            return util.json_encode({"count": count, "data": []})
+
+        # Average the results accross datasets, then compute the dynascore. These
+        # are the only steps that depend on the weights.
+        averaged_dataset_results = tensor.average_over_datasets(
+            [did_and_weight["weight"] for did_and_weight in ordered_dids_with_weight]
         )
-
-        # Order datasets as in ordered_dids, for display purposes
-        ordered_datasets = []
-        did_to_dataset = {}
-        for dataset in datasets:
-            did_to_dataset[dataset.id] = dataset
-        for dataset in datasets:
-            ordered_datasets.append(did_to_dataset[ordered_dids[len(ordered_datasets)]])
-        datasets = ordered_datasets
-
-        # Filter models and scores so that we have complete sets of scores.
-        # Unclear what the "null" values should be if we wanted to complete them.
-        mid_to_unique_dids = {}
-        all_unique_dids = set(ordered_dids)
-        for score in scores:
-            complete_score_for_dataset = True
-            for metric_info in ordered_metrics_with_weight_and_conversion:
-                if (score.to_dict().get(metric_info["field_name"], None) is None) and (
-                    score.metadata_json is None
-                    or util.json_decode(score.metadata_json).get(
-                        metric_info["field_name"], None
-                    )
-                    is None
-                ):
-                    complete_score_for_dataset = False
-            if complete_score_for_dataset:
-                if score.mid in mid_to_unique_dids:
-                    mid_to_unique_dids[score.mid].add(score.did)
-                else:
-                    mid_to_unique_dids[score.mid] = {score.did}
-        filtered_scores = []
-        for score in scores:
-            if mid_to_unique_dids.get(score.mid, set()) == all_unique_dids:
-                filtered_scores.append(score)
-        scores = filtered_scores
-        filtered_models = []
-        for model in models:
-            if mid_to_unique_dids.get(model.id, set()) == all_unique_dids:
-                filtered_models.append(model)
-        models = filtered_models
-
-        # Format the score data so that we can put it in Pandas data frames.
-        mid_and_did_to_scores = {}
-        for score in scores:
-            mid_and_did_to_scores[(score.mid, score.did)] = score
-        dataset_results_dict = {}
-        for dataset in datasets:
-            dataset_results_dict[dataset.id] = {
-                metric_info["field_name"]: []
-                for metric_info in ordered_metrics_with_weight_and_conversion
-            }
-            for model in models:
-                score = mid_and_did_to_scores[(model.id, dataset.id)]
-                for field_name in dataset_results_dict[dataset.id]:
-                    result = score.to_dict().get(field_name, None)
-                    if result is None:
-                        result = util.json_decode(score.metadata_json)[field_name]
-                    dataset_results_dict[dataset.id][field_name].append(result)
-
-        # Average the results accross datasets.
-        averaged_dataset_results = None
-        did_to_weight = {
-            did_and_weight["did"]: did_and_weight["weight"]
-            for did_and_weight in ordered_dids_with_weight
-        }
-        for key, value in dataset_results_dict.items():
-            df = pd.DataFrame.from_dict(value)
-            dataset_results_dict[key] = df
-            if averaged_dataset_results is None:
-                averaged_dataset_results = did_to_weight[key] * df
-            else:
-                averaged_dataset_results += did_to_weight[key] * df
-
-        # Compute the dynascore.
-        converted_dataset_results = self.dynascore(
-            perf_metric_field_name,
+        _, dynascores = dynascore(
+            ordered_metric_field_names.index(perf_metric_field_name),
             averaged_dataset_results,
-            weights={
-                metric_info["field_name"]: metric_info["weight"]
+            weights=[
+                metric_info["weight"]
                 for metric_info in ordered_metrics_with_weight_and_conversion
-            },
-            direction_multipliers={
-                metric_info["field_name"]: metric_info["utility_direction"]
+            ],
+            direction_multipliers=[
+                metric_info["utility_direction"]
                 for metric_info in ordered_metrics_with_weight_and_conversion
-            },
-            offsets={
-                metric_info["field_name"]: metric_info["offset"]
+            ],
+            offsets=[
+                metric_info["offset"]
                 for metric_info in ordered_metrics_with_weight_and_conversion
-            },
+            ],
         )
+        dynascores = np.array([nan_to_zero(value) for value in dynascores])
 
-        # Convert the Pandas results into an output json.
-        uid_to_username = {}
-        for user in users:
-            uid_to_username[user.id] = user.username
-        data_list = []
-        model_index = 0
-        ordered_metric_field_names = [
-            metric_info["field_name"]
+        # Only the models on the requested page are sorted and serialized.
+        ordered_metric_pretty_names = [
+            metric_info["pretty_name"]
             for metric_info in ordered_metrics_with_weight_and_conversion
         ]
-        for model in models:
+        if sort_by == "dynascore":
+            order = top_k_order(dynascores, offset + limit, reverse_sort)
+        elif sort_by in ordered_metric_pretty_names:
+            order = top_k_order(
+                averaged_dataset_results[:, ordered_metric_pretty_names.index(sort_by)],
+                offset + limit,
+                reverse_sort,
+            )
+        elif sort_by == "model_name":
+            # Unpublished models don't show their names, so they go last.
+            names = [
+                model["name"] if model["is_published"] else None
+                for model in tensor.model_infos
+            ]
+            order = sorted(
+                range(count),
+                key=lambda index: (names[index] is None, names[index] or ""),
+                reverse=reverse_sort,
+            )
+        else:
+            order = range(count)
+
+        data_list = []
+        for model_index in order[offset : offset + limit]:
+            model = tensor.model_infos[model_index]
             datasets_list = []
-            for dataset in datasets:
-                scores = []
-                for field_name in ordered_metric_field_names:
-                    scores.append(
-                        dataset_results_dict[dataset.id][field_name][model_index]
-                    )
+            for dataset_index, dataset in enumerate(tensor.dataset_infos):
+                scores = tensor.values[model_index, dataset_index].tolist()
                 variances = [0] * len(scores)  # TODO
                 datasets_list.append(
                     {
-                        "id": dataset.id,
-                        "name": dataset.name,
+                        "id": dataset["id"],
+                        "name": dataset["name"],
                         "scores": scores,
                         "variances": variances,
                     }
                 )
-            averaged_scores = []
-            for field_name in ordered_metric_field_names:
-                averaged_scores.append(
-                    averaged_dataset_results[field_name][model_index]
-                )
+            averaged_scores = averaged_dataset_results[model_index].tolist()
             averaged_variances = [0] * len(averaged_scores)  # TODO
-            dynascore = converted_dataset_results["dynascore"][model_index]
             data_list.append(
                 {
-                    "model_id": model.id,
-                    "model_name": model.name if model.is_published else None,
+                    "model_id": model["id"],
+                    "model_name": model["name"] if model["is_published"] else None,
                     # Don't give away the users for unpublished models.
-                    "uid": model.uid
-                    if model.is_published and not model.is_anonymous
+                    "uid": model["uid"]
+                    if model["is_published"] and not model["is_anonymous"]
                     else None,
-                    "username": uid_to_username[model.uid]
-                    if model.is_published and not model.is_anonymous
+                    "username": model["username"]
+                    if model["is_published"] and not model["is_anonymous"]
                     else None,
                     "averaged_scores": averaged_scores,
                     "averaged_variances": averaged_variances,
-                    "dynascore": dynascore
-                    if not math.isnan(dynascore)
-                    else 0,  # It is possible for the dynascore to be nan if
-                    # the leaderboard is uninteresting. For example, if,
-                    # for any metric, all models on the leaderboard have that
-                    # metric as 0. In these cases, dynascores for all models
-                    # will be nan.
+                    "dynascore": float(dynascores[model_index]),
                     "dynavariance": 0,  # TODO
                     "datasets": datasets_list,
                 }
             )
-            model_index += 1
-
-        ordered_metric_pretty_names = [
-            metric_info["pretty_name"]
-            for metric_info in ordered_metrics_with_weight_and_conversion
-        ]
-        if sort_by == "dynascore":
-            data_list.sort(reverse=reverse_sort, key=lambda model: model["dynascore"])
-        elif sort_by in ordered_metric_pretty_names:
-            data_list.sort(
-                reverse=reverse_sort,
-                key=lambda model: model["averaged_scores"][
-                    ordered_metric_pretty_names.index(sort_by)
-                ],
-            )
-        elif sort_by == "model_name":
-            data_list.sort(reverse=reverse_sort, key=lambda model: model["model_name"])
 
-        return util.json_encode(
-            {"count": len(data_list), "data": data_list[offset : offset + limit]}
-        )
+        return util.json_encode({"count": count, "data": data_list})
 
     def getByTid(self, tid):
         # Main query to fetch the model details
@@ -519,6 +489,18 @@ class ScoreModel(BaseModel):
         except db.orm.exc.NoResultFound:
             return False
 
+    def getScoredModelIdAndDatasetIds(self, mid_did_pairs):
+        """Returns the subset of the (mid, did) pairs that have a score."""
+        mid_did_pairs = list(mid_did_pairs)
+        if not mid_did_pairs:
+            return set()
+        return {
+            (mid, did)
+            for mid, did in self.dbs.query(Score.mid, Score.did)
+            .filter(db.tuple_(Score.mid, Score.did).in_(mid_did_pairs))
+            .distinct()
+        }
+
     def getByMid(self, mid):
         return (
             self.dbs.query(
@@ -8,10 +8,10 @@ import sys
 import enum
 import requests
 import sqlalchemy as db
-import yaml
 
 import common.helpers as util
 from common.logging import logger
+from common.task_config import get_name_to_full_annotation_config_obj, get_task_config
 
 from .base import Base, BaseModel
 from .dataset import AccessTypeEnum, DatasetModel
@@ -146,6 +146,40 @@ aggregation_metric_config_verifiers = {
 }
 
 
+class BatchStrategyEnum(enum.Enum):
+    SingleRecord = "SingleRecord"
+    MultiRecord = "MultiRecord"
+
+
+def verify_batch_transform_config(config_obj):
+    # Every field can also be "auto", in which case the evaluation server picks a
+    # value based on the size of the dataset and the instance type.
+    prefixed_message = "in batch_transform config: "
+    assert isinstance(config_obj, dict), prefixed_message + "must be a dict"
+    for key, value in config_obj.items():
+        assert key in (
+            "batch_strategy",
+            "max_payload_in_mb",
+            "max_concurrent_transforms",
+            "instance_count",
+        ), (
+            prefixed_message + f"{key} is not a recognized field"
+        )
+        if value == "auto":
+            continue
+        if key == "batch_strategy":
+            assert value in BatchStrategyEnum.__members__, (
+                prefixed_message + "batch_strategy must be SingleRecord or MultiRecord"
+            )
+        else:
+            assert (
+                isinstance(value, int) and not isinstance(value, bool) and value > 0
+            ), (prefixed_message + f"{key} must be a positive integer")
+        if key == "max_payload_in_mb":
+            # This is the limit of SageMaker
+            assert value <= 100, prefixed_message + "max_payload_in_mb must be <= 100"
+
+
 class DeltaMetricEnum(enum.Enum):
     fairness = "fairness"
     robustness = "robustness"
@@ -276,37 +310,31 @@ class AnnotationComponent:
     def convert_to_model_io(obj):
         return obj
 
+    # Returns a function that takes the annotation data and raises if the value for
+    # name is invalid. Everything that only depends on the config is looked up here,
+    # once, so that the returned function is cheap to call for every line of an
+    # upload.
     @staticmethod
-    def verify(name, config, data):
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
         raise NotImplementedError
 
+    @classmethod
+    def verify(
+        cls,
+        name,
+        config,
+        data,
+        mode=AnnotationVerifierMode.default,
+    ):
+        cls.compile_verifier(
+            name, get_name_to_full_annotation_config_obj(config), mode
+        )(data)
+
     @staticmethod
     def verify_config(name, config):
         raise NotImplementedError
 
 
-def get_name_to_full_annotation_config_obj(config):
-    name_to_config_obj = {}
-
-    # It is important that output is first in this list, so that objects with the same
-    # name in input and context overwrite those from output in name_to_config_obj.
-    # This is because config objects in output can be abbreviated to only contain
-    # the name and none of the other arguments, as long as the name is from
-    # a config object in input or context. We need to get the full information from
-    # the input or context.
-    annotation_config_objs = (
-        config.get("output", [])
-        + config.get("input", [])
-        + config.get("context", [])
-        + config.get("metadata", {}).get("create", [])
-        + config.get("metadata", {}).get("validate", [])
-    )
-
-    for obj in annotation_config_objs:
-        name_to_config_obj[obj["name"]] = obj
-    return name_to_config_obj
-
-
 class Image(AnnotationComponent):
     @staticmethod
     def convert_to_model_io(url):
@@ -315,17 +343,16 @@ class Image(AnnotationComponent):
         )
 
     @staticmethod
-    def verify(
-        name,
-        config,
-        data,
-        mode=AnnotationVerifierMode.default,
-    ):
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
         prefixed_message = "in image: "
-        assert isinstance(data[name], str), (
-            prefixed_message
-            + "the value must be a string that is a url pointing to an image"
-        )
+
+        def verify(data):
+            assert isinstance(data[name], str), (
+                prefixed_message
+                + "the value must be a string that is a url pointing to an image"
+            )
+
+        return verify
 
     @staticmethod
     def verify_config(name, config):
@@ -334,14 +361,10 @@ class Image(AnnotationComponent):
 
 class String(AnnotationComponent):
     @staticmethod
-    def verify(
-        name,
-        config,
-        data,
-        mode=AnnotationVerifierMode.default,
-    ):
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
         prefixed_message = "in string: "
-        if mode == AnnotationVerifierMode.dataset_upload:
+
+        def verify_dataset_upload(data):
             if isinstance(data[name], str):
                 pass
             elif isinstance(data[name], list):
@@ -352,11 +375,16 @@ class String(AnnotationComponent):
                     )
             else:
                 raise ValueError("Wrong type")
-        else:
+
+        def verify(data):
             assert isinstance(data[name], str), (
                 prefixed_message + "the value must be a string"
             )
 
+        if mode == AnnotationVerifierMode.dataset_upload:
+            return verify_dataset_upload
+        return verify
+
     @staticmethod
     def verify_config(config_obj, config):
         pass
@@ -364,17 +392,13 @@ class String(AnnotationComponent):
 
 class ContextStringSelection(AnnotationComponent):
     @staticmethod
-    def verify(
-        name,
-        config,
-        data,
-        mode=AnnotationVerifierMode.default,
-    ):
-        name_to_config_obj = get_name_to_full_annotation_config_obj(config)
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
+        reference_name = name_to_config_obj[name].get("reference_name")
         prefixed_message = "in context_string_selection: "
-        if mode == AnnotationVerifierMode.dataset_upload:
+
+        def verify_dataset_upload(data):
             if isinstance(data[name], str):
-                assert data[name] in data[name_to_config_obj[name]["reference_name"]], (
+                assert data[name] in data[reference_name], (
                     prefixed_message + "the selected string is not in the context"
                 )
             elif isinstance(data[name], list):
@@ -382,23 +406,31 @@ class ContextStringSelection(AnnotationComponent):
                     assert isinstance(sub_obj, str), (
                         prefixed_message + "the value must be a string"
                     )
-                    assert (
-                        sub_obj in data[name_to_config_obj[name]["reference_name"]]
-                    ), (prefixed_message + "the selected string is not in the context")
+                    assert sub_obj in data[reference_name], (
+                        prefixed_message + "the selected string is not in the context"
+                    )
             else:
                 raise ValueError("Wrong type")
-        elif mode == AnnotationVerifierMode.predictions_upload:
+
+        def verify_predictions_upload(data):
             assert isinstance(data[name], str), (
                 prefixed_message + "the value must be a string"
             )
-        else:
+
+        def verify(data):
             assert isinstance(data[name], str), (
                 prefixed_message + "the value must be a string"
             )
-            assert data[name] in data[name_to_config_obj[name]["reference_name"]], (
+            assert data[name] in data[reference_name], (
                 prefixed_message + "the selected string is not in the context"
             )
 
+        if mode == AnnotationVerifierMode.dataset_upload:
+            return verify_dataset_upload
+        elif mode == AnnotationVerifierMode.predictions_upload:
+            return verify_predictions_upload
+        return verify
+
     @staticmethod
     def verify_config(config_obj, config):
         prefixed_message = "in context_string_selection config: "
@@ -418,15 +450,10 @@ class ContextStringSelection(AnnotationComponent):
 
 class Prob(AnnotationComponent):
     @staticmethod
-    def verify(
-        name,
-        config,
-        data,
-        mode=AnnotationVerifierMode.default,
-    ):
-        name_to_config_obj = get_name_to_full_annotation_config_obj(config)
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
         prefixed_message = "in prob: "
-        if name_to_config_obj[name].get("single_prob", False):
+
+        def verify_single_prob(data):
             assert isinstance(data[name], float), (
                 prefixed_message + "the value must be a float"
             )
@@ -436,27 +463,36 @@ class Prob(AnnotationComponent):
             assert data[name] < 1 + EPSILON_PREC, (
                 prefixed_message + "the value must be less than 1"
             )
-        else:
+
+        if name_to_config_obj[name].get("single_prob", False):
+            return verify_single_prob
+
+        check_labels = mode != AnnotationVerifierMode.predictions_upload
+        reference_obj = name_to_config_obj.get(
+            name_to_config_obj[name].get("reference_name")
+        )
+        labels = set(reference_obj["labels"]) if reference_obj else None
+
+        def verify(data):
             assert isinstance(data[name], dict), (
                 prefixed_message + "the value must be a dict"
             )
-            if mode != AnnotationVerifierMode.predictions_upload:
-                assert set(data[name].keys()) == set(
-                    name_to_config_obj[name_to_config_obj[name]["reference_name"]][
-                        "labels"
-                    ]
-                ), (
+            if check_labels:
+                assert labels is not None and data[name].keys() == labels, (
                     prefixed_message
                     + "the set of keys in the probability dict must match the set of"
                     + " labels"
                 )
-            assert sum(data[name].values()) < 1 + EPSILON_PREC, (
+            prob_sum = sum(data[name].values())
+            assert prob_sum < 1 + EPSILON_PREC, (
                 prefixed_message + "the probabilities must sum to 1"
             )
-            assert sum(data[name].values()) > 1 - EPSILON_PREC, (
+            assert prob_sum > 1 - EPSILON_PREC, (
                 prefixed_message + "the probabilities must sum to 1"
             )
 
+        return verify
+
     @staticmethod
     def verify_config(config_obj, config):
         if config_obj.get("single_prob", False):
@@ -480,21 +516,23 @@ class Prob(AnnotationComponent):
 
 class Multilabel(AnnotationComponent):
     @staticmethod
-    def verify(
-        name,
-        config,
-        data,
-        mode=AnnotationVerifierMode.default,
-    ):
-        name_to_config_obj = get_name_to_full_annotation_config_obj(config)
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
+        # Labels are strings (see verify_config), so anything that isn't a string
+        # can't be one of them.
+        labels = frozenset(name_to_config_obj[name]["labels"])
         prefixed_message = "in multilabel: "
-        assert isinstance(data[name], list), (
-            prefixed_message + "the value must be a list"
-        )
-        for item in data[name]:
-            assert item in name_to_config_obj[name]["labels"], (
-                prefixed_message + "labels must match those defined in config object"
+
+        def verify(data):
+            assert isinstance(data[name], list), (
+                prefixed_message + "the value must be a list"
             )
+            for item in data[name]:
+                assert isinstance(item, str) and item in labels, (
+                    prefixed_message
+                    + "labels must match those defined in config object"
+                )
+
+        return verify
 
     @staticmethod
     def verify_config(config_obj, config):
@@ -513,17 +551,13 @@ class Multilabel(AnnotationComponent):
 
 class Multiclass(AnnotationComponent):
     @staticmethod
-    def verify(
-        name,
-        config,
-        data,
-        mode=AnnotationVerifierMode.default,
-    ):
-        name_to_config_obj = get_name_to_full_annotation_config_obj(config)
+    def compile_verifier(name, name_to_config_obj, mode=AnnotationVerifierMode.default):
+        labels = frozenset(name_to_config_obj[name]["labels"])
         prefixed_message = "in multiclass: "
-        if mode == AnnotationVerifierMode.dataset_upload:
+
+        def verify_dataset_upload(data):
             if isinstance(data[name], str):
-                assert data[name] in name_to_config_obj[name]["labels"], (
+                assert data[name] in labels, (
                     prefixed_message
                     + "labels must match those defined in config object"
                 )
@@ -533,20 +567,25 @@ class Multiclass(AnnotationComponent):
                         prefixed_message
                         + "labels must match those defined in config object"
                     )
-                    assert sub_obj in name_to_config_obj[name]["labels"], (
+                    assert sub_obj in labels, (
                         prefixed_message
                         + "labels must match those defined in config object"
                     )
             else:
                 raise ValueError("Wrong type")
-        else:
+
+        def verify(data):
             assert isinstance(data[name], str), (
                 prefixed_message + "value must be a string"
             )
-            assert data[name] in name_to_config_obj[name]["labels"], (
+            assert data[name] in labels, (
                 prefixed_message + "labels must match those defined in config object"
             )
 
+        if mode == AnnotationVerifierMode.dataset_upload:
+            return verify_dataset_upload
+        return verify
+
     @staticmethod
     def verify_config(config_obj, config):
         prefixed_message = "in multiclass config: "
@@ -570,6 +609,39 @@ annotation_components = {
 }
 
 
+class AnnotationValidator:
+    """
+    Verifies annotation data against a task config, with the per-field checks of
+    the annotation components compiled once up front. Built once per task config
+    and mode (see Task.get_annotation_validator), so that uploads with many lines
+    can be verified in a single tight loop, collecting every error instead of
+    stopping at the first one.
+    """
+
+    def __init__(self, name_to_config_obj, mode=AnnotationVerifierMode.default):
+        self.mode = mode
+        self.name_to_verifier = {
+            name: annotation_components[config_obj["type"]].compile_verifier(
+                name, name_to_config_obj, mode
+            )
+            for name, config_obj in name_to_config_obj.items()
+        }
+
+    def verify(self, data):
+        """Returns the error messages for data, which are empty if it is valid."""
+        messages = []
+        for name in data.keys():
+            verifier = self.name_to_verifier.get(name)
+            # TODO The check for None is necessary for non-dynalab models.
+            # Can be removed when dynatask-dynalab integration is complete.
+            if verifier is not None:
+                try:
+                    verifier(data)
+                except Exception as ex:
+                    messages.append(str(ex))
+        return messages
+
+
 class Task(Base):
     __tablename__ = "tasks"
     __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
@@ -685,6 +757,9 @@ class Task(Base):
     @staticmethod
     def verify_config(config):
         prefixed_message = "in config: "
+        if "batch_transform" in config:
+            verify_batch_transform_config(config["batch_transform"])
+
         if "aggregation_metric" in config:
             Task.verify_aggregation_metric_config(config["aggregation_metric"])
 
@@ -718,34 +793,25 @@ class Task(Base):
             )
             annotation_components[obj["type"]].verify_config(obj, config)
 
-    def verify_annotation(self, data, mode=AnnotationVerifierMode.default):
-        config = yaml.load(self.config_yaml, yaml.SafeLoader)
-        name_to_config_obj = get_name_to_full_annotation_config_obj(config)
+    def get_annotation_validator(self, mode=AnnotationVerifierMode.default):
+        task_config = get_task_config(self)
+        validator = task_config.annotation_validators.get(mode)
+        if validator is None:
+            validator = AnnotationValidator(
+                task_config.name_to_full_annotation_config_obj, mode
+            )
+            task_config.annotation_validators[mode] = validator
+        return validator
 
-        for name in data.keys():
-            if (
-                name in name_to_config_obj
-            ):  # TODO This check is necessary for non-dynalab models.
-                # Can be removed when dynatask-dynalab integration is complete.
-                try:
-                    annotation_components[name_to_config_obj[name]["type"]].verify(
-                        name,
-                        config,
-                        data,
-                        mode,
-                    )
-                except Exception as e:
-                    logger.error(e)
-                    return False, str(e)
+    def verify_annotation(self, data, mode=AnnotationVerifierMode.default):
+        messages = self.get_annotation_validator(mode).verify(data)
+        if messages:
+            logger.error(messages[0])
+            return False, messages[0]
         return True, "no problems detected"
 
     def convert_to_model_io(self, data):
-        name_to_type = {}
-        config = yaml.load(self.config_yaml, yaml.SafeLoader)
-        annotation_config_objs = get_name_to_full_annotation_config_obj(config).values()
-
-        for obj in annotation_config_objs:
-            name_to_type[obj["name"]] = obj["type"]
+        name_to_type = get_task_config(self).name_to_type
 
         converted_data = util.json_decode(util.json_encode(data))
         for key, value in data.items():
@@ -850,7 +916,7 @@ class TaskModel(BaseModel):
             r_dict = r.to_dict()
             t_dict["ordered_scoring_datasets"] = scoring_dataset_list
             t_dict["ordered_datasets"] = dataset_list
-            config = yaml.load(t_dict["config_yaml"], yaml.SafeLoader)
+            config = get_task_config(t).config
             # TODO: make the frontend use perf_metric instead of perf_metric_field_name?
             if "perf_metric" in config:
                 t_dict["perf_metric_field_name"] = config["perf_metric"]["type"]
@@ -0,0 +1,86 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import sqlalchemy as db
+
+from .base import Base, BaseModel, new_random_key
+
+
+# Labels with a counter column on the queue entries
+COUNTED_LABELS = ("correct", "incorrect", "flagged")
+
+
+def get_priority(model_wrong):
+    """Examples that fooled the model are validated first."""
+    return 0 if model_wrong else 1
+
+
+class ValidationQueueEntry(Base):
+    """
+    An example that can still be validated, ie that is neither retracted nor
+    validated by an owner, with the validation counts that decide whether it is
+    served to validators. Examples to validate are sampled from this table
+    through its (r_realid, priority, total_verified, random_key) index, instead
+    of aggregating the validations of the whole round and sorting by RAND().
+    """
+
+    __tablename__ = "validation_queue_entries"
+    __table_args__ = (
+        db.Index(
+            "validation_queue_entries_sampling",
+            "r_realid",
+            "priority",
+            "total_verified",
+            "random_key",
+        ),
+        {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"},
+    )
+
+    eid = db.Column(
+        db.Integer, db.ForeignKey("examples.id", ondelete="CASCADE"), primary_key=True
+    )
+    r_realid = db.Column(
+        db.Integer, db.ForeignKey("rounds.id", ondelete="CASCADE"), nullable=False
+    )
+    priority = db.Column(db.SmallInteger, nullable=False)
+    total_verified = db.Column(db.Integer, nullable=False, default=0)
+    cnt_correct = db.Column(db.Integer, nullable=False, default=0)
+    cnt_incorrect = db.Column(db.Integer, nullable=False, default=0)
+    cnt_flagged = db.Column(db.Integer, nullable=False, default=0)
+    random_key = db.Column(db.Integer, nullable=False, default=new_random_key)
+
+    def __repr__(self):
+        return f"<ValidationQueueEntry eid {self.eid}>"
+
+    def to_dict(self, safe=True):
+        d = {}
+        for column in self.__table__.columns:
+            d[column.name] = getattr(self, column.name)
+        return d
+
+
+class ValidationQueueEntryModel(BaseModel):
+    def __init__(self):
+        super().__init__(ValidationQueueEntry)
+
+    def recordValidation(self, eid, label, mode):
+        """
+        Updates the entry of an example after it got a new validation. Owner
+        validations are final, so they remove the example from the queue.
+        """
+        entry = self.dbs.query(ValidationQueueEntry).filter(
+            ValidationQueueEntry.eid == eid
+        )
+        if mode == "owner":
+            entry.delete(synchronize_session=False)
+        else:
+            values = {
+                ValidationQueueEntry.total_verified: ValidationQueueEntry.total_verified
+                + 1
+            }
+            if label in COUNTED_LABELS:
+                column = getattr(ValidationQueueEntry, "cnt_" + label)
+                values[column] = column + 1
+            entry.update(values, synchronize_session=False)
+        self.dbs.commit()
@@ -0,0 +1,86 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Recomputes the context_validation_results rows of the rounds of a task from
+# their examples and validations, or with --check, only reports the contexts
+# whose stored counters differ from the recomputed ones.
+# example usage:
+# python rebuild_context_validation_results.py --tid 1 --rid 2 --check
+
+import argparse
+import sys
+
+
+sys.path.append("..")  # noqa
+sys.path.append("../../evaluation")  # noqa
+from models.context import Context, ContextModel  # noqa isort:skip
+from models.context_validation_result import ContextValidationResult  # noqa isort:skip
+from models.round import RoundModel  # noqa isort:skip
+from models.task import TaskModel  # noqa isort:skip
+
+
+def check_round(cm, rid, num_matching_validations):
+    """Returns the number of contexts whose stored counters are wrong."""
+    round_cids = cm.dbs.query(Context.id).filter(Context.r_realid == rid)
+    contexts_with_example_stats, _, _, _ = cm.getContextValidationResults(
+        num_matching_validations, cids=round_cids
+    )
+    expected = {
+        cid: tuple(int(count or 0) for count in counts)
+        for cid, *counts in contexts_with_example_stats
+    }
+    stored = {
+        result.cid: (
+            result.cnt_correct_examples,
+            result.cnt_failed_examples,
+            result.cnt_inflight_examples,
+            result.cnt_pre_val_examples,
+        )
+        for result in cm.dbs.query(ContextValidationResult).filter(
+            ContextValidationResult.r_realid == rid,
+            ContextValidationResult.num_matching_validations
+            == num_matching_validations,
+        )
+    }
+    num_wrong = 0
+    for cid in sorted(set(expected) | set(stored)):
+        if expected.get(cid) != stored.get(cid):
+            print(
+                f"context {cid}: stored {stored.get(cid)}, expected {expected.get(cid)}"
+            )
+            num_wrong += 1
+    return num_wrong
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tid", type=int, required=True)
+    parser.add_argument("--rid", type=int, help="only this round of the task")
+    parser.add_argument(
+        "--check", action="store_true", help="only compare, don't write anything"
+    )
+    args = parser.parse_args()
+
+    tm = TaskModel()
+    task = tm.get(args.tid)
+    rm = RoundModel()
+    rounds = rm.getByTid(args.tid)
+    if args.rid is not None:
+        rounds = [round for round in rounds if round.rid == args.rid]
+    cm = ContextModel()
+
+    num_wrong = 0
+    for round in rounds:
+        if args.check:
+            num_wrong += check_round(cm, round.id, task.num_matching_validations)
+        else:
+            cm.rebuildValidationResults(round.id, task.num_matching_validations)
+            print(f"Rebuilt round {round.rid}")
+    if args.check:
+        print(f"{num_wrong} contexts with wrong counters")
+        sys.exit(1 if num_wrong else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,24 +8,35 @@ import os
 import tempfile
 
 import boto3
-import yaml
 
+from common.task_config import get_task_config
 from eval_config import eval_config
-from metrics.metric_getters import get_delta_metrics, get_eval_metrics
+from metrics.metric_getters import get_delta_metrics, get_eval_metrics_by_tag
 from models.dataset import AccessTypeEnum, LogAccessTypeEnum
 from models.task import TaskModel
 from utils.helpers import (
     dotdict,
+    get_auto_batch_transform_params,
     get_data_s3_path,
     get_perturbed_filename,
-    parse_s3_outfile,
+    iter_s3_outfile,
+    parse_s3_uri,
     path_available_on_s3,
     upload_predictions,
 )
+from utils.columnar import columnar_available, records_from_bytes, records_to_bytes
+from utils.label_cache import LabelCache
 
 
 logger = logging.getLogger("datasets")
 
+label_cache = LabelCache(
+    eval_config.get(
+        "label_cache_dir", os.path.join(tempfile.gettempdir(), "dynabench_labels")
+    ),
+    eval_config.get("label_cache_size", 8),
+)
+
 
 class BaseDataset:
     def __init__(
@@ -130,33 +141,20 @@ class BaseDataset:
     def get_batch_transform_config(
         self, sagemaker_client, endpoint_name, job_name, perturb_prefix=None
     ) -> dict:
-        input_names = [
-            obj["name"]
-            for obj in yaml.load(self.task.config_yaml, yaml.SafeLoader).get(
-                "input", []
-            )
-        ]
-        output_names = [
-            obj["name"]
-            for obj in yaml.load(self.task.config_yaml, yaml.SafeLoader).get(
-                "output", []
-            )
-        ]
+        task_config = get_task_config(self.task)
         input_names_without_target_names = list(
-            set(input_names).difference(set(output_names))
+            set(task_config.input_names).difference(set(task_config.output_names))
+        )
+        model_input_names = input_names_without_target_names + list(
+            task_config.context_names
         )
-        model_input_names = input_names_without_target_names + [
-            obj["name"]
-            for obj in yaml.load(self.task.config_yaml, yaml.SafeLoader).get(
-                "context", []
-            )
-        ]
         model_input_names.append("uid")  # unique example identifier
-        return dict(
+        params = self.get_batch_transform_params(perturb_prefix)
+        batch_transform_config = dict(
             ModelName=endpoint_name,
             TransformJobName=job_name,
-            MaxConcurrentTransforms=1,
-            BatchStrategy="SingleRecord",
+            MaxConcurrentTransforms=params["max_concurrent_transforms"],
+            BatchStrategy=params["batch_strategy"],
             TransformInput={
                 "DataSource": {
                     "S3DataSource": {
@@ -175,7 +173,7 @@ class BaseDataset:
             },
             TransformResources={
                 "InstanceType": self.task.instance_type,
-                "InstanceCount": self.task.instance_count,
+                "InstanceCount": params["instance_count"],
             },
             DataProcessing={"InputFilter": f"${model_input_names}"},
             ModelClientConfig={
@@ -183,18 +181,46 @@ class BaseDataset:
                 "InvocationsTimeoutInSeconds": 3600
             },
         )
+        if params["max_payload_in_mb"] is not None:
+            batch_transform_config["MaxPayloadInMB"] = params["max_payload_in_mb"]
+        return batch_transform_config
+
+    def get_batch_transform_params(self, perturb_prefix=None) -> dict:
+        """Returns the batch strategy, max payload, concurrency and instance count
+        of the transform jobs, from the batch_transform field of the task config.
+        Fields that aren't set keep SageMaker's one record at a time defaults, and
+        fields set to "auto" are picked from the size of the dataset.
+        """
+        configured = get_task_config(self.task).batch_transform
+        params = {
+            "batch_strategy": "SingleRecord",
+            "max_payload_in_mb": None,
+            "max_concurrent_transforms": 1,
+            "instance_count": self.task.instance_count,
+        }
+        if "auto" in configured.values():
+            auto_params = get_auto_batch_transform_params(
+                self.get_n_examples(perturb_prefix), self.task.instance_type
+            )
+        for key, value in configured.items():
+            if value == "auto":
+                params[key] = auto_params[key]
+            elif value is not None:
+                params[key] = value
+        return params
 
     def read_labels(self, perturb_prefix=None):
-        tf = tempfile.mkstemp(prefix=self.name)[1]
-        self.s3_client.download_file(
-            self.task.s3_bucket, self._get_data_s3_path(perturb_prefix), tf
-        )
-        data = [json.loads(l) for l in open(tf).readlines()]
         if perturb_prefix:
-            labels = [self.perturb_label_field_converter(example) for example in data]
+            converter = self.perturb_label_field_converter
         else:
-            labels = [self.label_field_converter(example) for example in data]
-        os.remove(tf)
+            converter = self.label_field_converter
+        labels = label_cache.get(
+            self.s3_client,
+            self.task.s3_bucket,
+            self._get_data_s3_path(perturb_prefix),
+            converter,
+            converter_config=self.task.config_yaml or "",
+        )
         if not self._n_examples.get(perturb_prefix, None):
             self._n_examples[perturb_prefix] = len(labels)
         return labels
@@ -218,7 +244,7 @@ class BaseDataset:
         if job.perturb_prefix:
             targets = [
                 self.pred_to_target_converter(self.pred_field_converter(prediction))
-                for prediction in self.parse_outfile_and_upload(job, original=True)
+                for prediction in self.read_predictions(job, original=True)
             ]
 
             delta_metrics_dict = self.eval(
@@ -283,29 +309,16 @@ class BaseDataset:
             except Exception as ex:
                 logger.exception(f"Unknown exception {ex}")
             else:
-                # Get performance
-                perf, perf_dict = get_eval_metrics(
-                    self.task, predictions, target_labels
+                # Get performance, and its breakdown for this round across tags
+                (perf, perf_dict), perf_by_tag_tuple_dict = get_eval_metrics_by_tag(
+                    self.task, predictions, target_labels, target_tags
                 )
                 score_obj["perf"] = perf
                 score_obj["perf_std"] = perf_dict.get("perf_std", None)
                 score_obj["pretty_perf"] = str(perf) + " %"
                 score_obj["metadata_json"] = perf_dict
 
-                # Get performance breakdown for this round across tags
                 if target_tags:
-                    examples_by_tag = {}
-                    for pred, target_label, target_tags in zip(
-                        predictions, target_labels, target_tags
-                    ):
-                        for tag in target_tags:
-                            examples_by_tag.setdefault(tag, []).append(
-                                (pred, target_label)
-                            )
-                    perf_by_tag_tuple_dict = {
-                        k: get_eval_metrics(self.task, *list(zip(*examples)))
-                        for k, examples in examples_by_tag.items()
-                    }
                     score_obj["metadata_json"]["perf_by_tag"] = score_obj[
                         "metadata_json"
                     ].get("perf_by_tag", []) + [
@@ -330,11 +343,27 @@ class BaseDataset:
             raw_output_s3_uri = self.get_output_s3_url(
                 job.endpoint_name, raw=True, perturb_prefix=perturb_prefix
             )
-            predictions = parse_s3_outfile(self.s3_client, raw_output_s3_uri)
             output_s3_uri = self.get_output_s3_url(
                 job.endpoint_name, raw=False, perturb_prefix=perturb_prefix
             )
-            upload_predictions(self.s3_client, output_s3_uri, predictions)
+            predictions = []
+
+            def collect(records):
+                for record in records:
+                    predictions.append(record)
+                    yield record
+
+            # Predictions are uploaded while the raw output is being parsed
+            upload_predictions(
+                self.s3_client,
+                output_s3_uri,
+                collect(iter_s3_outfile(self.s3_client, raw_output_s3_uri)),
+            )
+            if columnar_available():
+                bucket, path = parse_s3_uri(output_s3_uri + ".parquet")
+                self.s3_client.put_object(
+                    Bucket=bucket, Key=path, Body=records_to_bytes(predictions)
+                )
         except Exception as e:
             logger.exception(
                 f"Exception in parsing output file for {job.job_name}: {e}"
@@ -342,6 +371,20 @@ class BaseDataset:
             raise e
         return predictions
 
+    def read_predictions(self, job, original=False):
+        """Returns the predictions of a job that were already parsed by
+        parse_outfile_and_upload, from their parquet copy if there is one."""
+        perturb_prefix = None if original else job.perturb_prefix
+        if columnar_available():
+            output_s3_uri = self.get_output_s3_url(
+                job.endpoint_name, raw=False, perturb_prefix=perturb_prefix
+            )
+            bucket, path = parse_s3_uri(output_s3_uri + ".parquet")
+            if path_available_on_s3(self.s3_client, bucket, path):
+                body = self.s3_client.get_object(Bucket=bucket, Key=path)["Body"]
+                return records_from_bytes(body.read())
+        return self.parse_outfile_and_upload(job, original)
+
     def perturb_label_field_converter(self, example):
         return {"input_id": example["input_id"], **self.label_field_converter(example)}
 
@@ -368,11 +411,7 @@ class BaseDataset:
         """
         return {
             "id": example["uid"],
-            "answer": example[
-                yaml.load(self.task.config_yaml, yaml.SafeLoader)["perf_metric"][
-                    "reference_name"
-                ]
-            ],
+            "answer": example[get_task_config(self.task).perf_metric_reference_name],
             "tags": example.get("tags", []),
         }  # NOTE: For now, the perf_metric defines the output to look for
 
@@ -389,11 +428,7 @@ class BaseDataset:
         """
         return {
             "id": example["id"],
-            "pred": example[
-                yaml.load(self.task.config_yaml, yaml.SafeLoader)["perf_metric"][
-                    "reference_name"
-                ]
-            ],
+            "pred": example[get_task_config(self.task).perf_metric_reference_name],
         }  # NOTE: For now, the perf_metric defines the output to look for
 
     def to_dict(self, endpoint_name):
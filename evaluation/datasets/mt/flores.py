@@ -2,10 +2,12 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import concurrent.futures
 import functools
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import subprocess
 import sys
@@ -13,9 +15,9 @@ import time
 from pathlib import Path
 from typing import Dict, List, TextIO, Tuple
 
-import yaml
-from datasets.common import BaseDataset
+from datasets.common import BaseDataset, label_cache
 
+from common.task_config import get_task_config
 from utils import helpers
 from utils.evaluator import Job
 
@@ -92,6 +94,31 @@ class Flores101Base(BaseDataset):
 
         return not missing_paths
 
+    def get_n_examples(self, perturb_prefix=None):
+        if not self.shard_by_lang:
+            return super().get_n_examples(perturb_prefix)
+        # The data path is only a prefix of the shards, so they are counted one by
+        # one
+        if not self._n_examples.get(perturb_prefix, None):
+            if perturb_prefix:
+                converter = self.perturb_label_field_converter
+            else:
+                converter = self.label_field_converter
+            basepath = self._get_data_s3_path(perturb_prefix)
+            self._n_examples[perturb_prefix] = sum(
+                len(
+                    label_cache.get(
+                        self.s3_client,
+                        self.task.s3_bucket,
+                        basepath + f"{lang}.jsonl",
+                        converter,
+                        converter_config=self.task.config_yaml or "",
+                    )
+                )
+                for lang in self.languages
+            )
+        return self._n_examples[perturb_prefix]
+
     def get_batch_transform_config(
         self, sagemaker_client, endpoint_name, job_name, perturb_prefix=None
     ) -> dict:
@@ -128,16 +155,45 @@ class Flores101Base(BaseDataset):
             metadata_json = json.loads(eval_metrics["metadata_json"])
             perf_by_tag: List[dict] = metadata_json["perf_by_tag"]
         else:
-            perf_by_tag = []
-            for src in self.languages:
-                src_perfs = self.eval_src_lang(job, src)
-                perf_by_tag.extend(src_perfs)
-
-        perf_metric_type = yaml.load(self.task.config_yaml, yaml.SafeLoader)[
-            "perf_metric"
-        ]["type"]
+            perf_by_tag = self.eval_src_langs(job)
+
+        perf_metric_type = get_task_config(self.task).perf_metric_type
         return compute_averages(perf_metric_type, perf_by_tag), {}
 
+    def eval_src_langs(self, job: Job) -> List[dict]:
+        """Evaluates the directions of all the source languages, several at a time.
+
+        In the eval server, this runs in a process of the metrics computer pool.
+        These processes can't have children, so the workers are threads: only the
+        downloads of some languages overlap with the scoring of others, which the
+        GIL keeps serial. Each pool process gets its share of the CPUs as threads,
+        so that the pool doesn't oversubscribe the host. Outside of the pool, the
+        workers are processes and the scoring is parallel too.
+        """
+        n_workers = self._config.get("flores_eval_workers")
+        in_pool = multiprocessing.current_process().daemon
+        if not n_workers:
+            n_workers = os.cpu_count() or 1
+            if in_pool:
+                n_workers //= self._config.get("compute_metric_processes", 2)
+        n_workers = max(1, min(len(self.languages), n_workers))
+        if in_pool:
+            executor = concurrent.futures.ThreadPoolExecutor(n_workers)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+        start = time.time()
+        with executor:
+            src_perfs = executor.map(
+                functools.partial(self.eval_src_lang, job), self.languages
+            )
+            perf_by_tag = [perf for perfs in src_perfs for perf in perfs]
+        duration = (time.time() - start) / 60
+        logger.info(
+            f"evaluated {len(self.languages)} source languages with {n_workers} "
+            + f"workers, took {duration:.1f} minutes"
+        )
+        return perf_by_tag
+
     def eval_src_lang(self, job: Job, src: str) -> dict:
         # Flores out file are correct .jsonl format,
         # so we don't need to call `parse_outfile_and_upload`
@@ -149,15 +205,16 @@ class Flores101Base(BaseDataset):
                 + f"{self.task.task_code}/{self.name}-{src}.jsonl.out"
             ),
         )
-        targets = helpers.parse_s3_outfile(
+        # The targets are the same for all the models, so they are cached
+        targets = label_cache.get(
             self.s3_client,
-            self.s3_path(
-                f"datasets/flores/{self.task.task_code}/{self.name}-{src}.jsonl"
-            ),
+            self.task.s3_bucket,
+            self._get_data_s3_path() + f"{src}.jsonl",
+            self.label_field_converter,
+            converter_config=self.task.config_yaml or "",
         )
         duration = (time.time() - start) / 60
         logger.debug(f"downloaded {src}-xx predictions, took {duration:.1f} minutes")
-        targets = [self.label_field_converter(target) for target in targets]
         # Reuse the base eval method,
         # but we are only interested in the per-directions results
         raw_src_perfs = self.eval(predictions, targets)
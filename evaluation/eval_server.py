@@ -5,13 +5,15 @@
 import json
 import logging
 import multiprocessing
+import queue
+import threading
 import time
 
 import boto3
-import uuid
 from datasets import load_datasets
 
 from eval_config import eval_config
+from utils.helpers import buffer_evaluation_statuses, flush_evaluation_statuses
 from utils.logging import init_logger
 from utils.requester import Requester
 
@@ -19,69 +21,198 @@ from utils.requester import Requester
 # TODO: [BE] strong typing on all interfce methods
 
 sleep_interval = 5
+submit_interval = 5
+dispatch_interval = 5
 scheduler_update_interval = 300
+queue_depths_interval = 60
+# SQS allows at most 10 messages per receive and 20 seconds of long polling
+sqs_max_messages = 10
+sqs_wait_time = 20
 logger = logging.getLogger("evaluation")
 
+MESSAGE_EVENT = "message"
+JOB_DONE_EVENT = "job_done"
+
+
+class Task:
+    """A step of the main loop that runs every `interval` seconds, or sooner
+    when it's triggered by an event."""
+
+    def __init__(self, name, interval, run):
+        self.name = name
+        self.interval = interval
+        self.run = run
+        self.next_run = 0  # run as soon as the loop starts
+
+    def trigger(self):
+        self.next_run = 0
+
+    def run_if_due(self, now):
+        if now < self.next_run:
+            return
+        self.next_run = now + self.interval
+        try:
+            self.run()
+        except Exception as ex:
+            logger.exception(f"Exception in {self.name}: {ex}")
+
+
+def receive_messages(sqs, queue_url, server_id, events, messages_handled):
+    """Long polls the SQS queue and forwards the messages for this server. It
+    doesn't poll again until the main loop has handled and deleted the messages
+    it forwarded, so that they aren't redelivered while they wait in events."""
+    while True:
+        try:
+            response = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=sqs_max_messages,
+                WaitTimeSeconds=sqs_wait_time,
+            )
+        except Exception as ex:
+            logger.exception(f"Exception in receiving SQS messages: {ex}")
+            time.sleep(sleep_interval)
+            continue
+
+        messages_handled.clear()
+        forwarded = False
+        for message in response.get("Messages", []):
+            try:
+                msg = json.loads(message["Body"])
+                if msg.get("eval_server_id", "default") != server_id:
+                    logger.info(f"Evaluation server {server_id} ignored message {msg}")
+                    continue
+                events.put((MESSAGE_EVENT, (msg, message["ReceiptHandle"])))
+                forwarded = True
+            except Exception as ex:
+                logger.exception(f"Exception in reading SQS message {message}: {ex}")
+                try:
+                    delete_messages(sqs, queue_url, [message["ReceiptHandle"]])
+                except Exception as ex:
+                    logger.exception(f"Exception in deleting SQS messages: {ex}")
+        if forwarded:
+            messages_handled.wait()
+
+
+def delete_messages(sqs, queue_url, receipt_handles):
+    for start in range(0, len(receipt_handles), sqs_max_messages):
+        batch = receipt_handles[start : start + sqs_max_messages]
+        sqs.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(i), "ReceiptHandle": receipt_handle}
+                for i, receipt_handle in enumerate(batch)
+            ],
+        )
+
+
+def wait_for_datasets():
+    dataset_dict = load_datasets()
+    while not dataset_dict:
+        logger.info("Haven't got dataset_dict. Sleep.")
+        time.sleep(sleep_interval)
+        dataset_dict = load_datasets()
+    return dataset_dict
+
 
 def main():
     init_logger("evaluation")
     server_id = eval_config["eval_server_id"]
     logger.info(f"Start evaluation server '{server_id}'")
 
-    sqs = boto3.resource(
+    sqs = boto3.client(
         "sqs",
         aws_access_key_id=eval_config["aws_access_key_id"],
         aws_secret_access_key=eval_config["aws_secret_access_key"],
         region_name=eval_config["aws_region"],
     )
-    queue = sqs.get_queue_by_name(QueueName=eval_config["evaluation_sqs_queue"])
-    dataset_dict = load_datasets()
-    while not dataset_dict:
-        logger.info("Haven't got dataset_dict. Sleep.")
-        time.sleep(sleep_interval)
-    requester = Requester(eval_config, dataset_dict)
+    queue_url = sqs.get_queue_url(QueueName=eval_config["evaluation_sqs_queue"])[
+        "QueueUrl"
+    ]
+    requester = Requester(eval_config, wait_for_datasets())
+    # Status changes are written once per iteration of the main loop
+    buffer_evaluation_statuses()
+
+    # Everything that touches the requester runs on this thread. Other threads
+    # only wake it up by putting events in this queue.
+    events = queue.Queue()
+    messages_handled = threading.Event()
+    requester.computer.on_job_done = lambda job: events.put((JOB_DONE_EVENT, job))
+    threading.Thread(
+        target=receive_messages,
+        args=(sqs, queue_url, server_id, events, messages_handled),
+        name="sqs-receiver",
+        daemon=True,
+    ).start()
 
     cpus = eval_config.get("compute_metric_processes", 2)
     with multiprocessing.pool.Pool(cpus) as pool:
-        timer = scheduler_update_interval
-        while True:
-            # On each iteration, submit all requested jobs
-            for message in queue.receive_messages():
-                msg = json.loads(message.body)
-                if msg.get("eval_server_id", "default") != server_id:
-                    logger.info(f"Evaluation server {server_id} ignored message {msg}")
-                    continue
 
-                logger.info(f"Evaluation server {server_id} received SQS message {msg}")
-
-                if msg.get("reload_datasets", False):
-                    dataset_dict = load_datasets()
-                    while not dataset_dict:
-                        logger.info("Haven't got dataset_dict. Sleep.")
-                        time.sleep(sleep_interval)
-                    requester = Requester(eval_config, dataset_dict)
-
-                requester.request(msg)
-                queue.delete_messages(
-                    Entries=[
-                        {
-                            "Id": str(uuid.uuid4()),
-                            "ReceiptHandle": message.receipt_handle,
-                        }
-                    ]
-                )
-            requester.submit()
-
-            # Update job status on scheduler interval
-            if timer >= scheduler_update_interval:
-                requester.update_status()
-                timer = 0
-            # Evaluate one job
-            job = requester.computer.find_next_ready_job()
-            if job:
-                requester.computer.compute_one_async(pool, job)
-            time.sleep(sleep_interval)
-            timer += sleep_interval
+        def dispatch():
+            # Start as many jobs as there are free processes in the pool
+            started = requester.computer.dispatch(pool, cpus)
+            if started:
+                logger.info(f"Started computing metrics of {started} jobs")
+
+        def update_status():
+            requester.update_status()
+            # Completed jobs are now waiting for their metrics to be computed
+            dispatch_task.trigger()
+
+        def log_queue_depths():
+            depths = requester.get_queue_depths()
+            depths["messages"] = events.qsize()
+            logger.info(f"Queue depths: {json.dumps(depths)}")
+
+        submit_task = Task("submission", submit_interval, requester.submit)
+        status_task = Task("status update", scheduler_update_interval, update_status)
+        dispatch_task = Task("compute dispatch", dispatch_interval, dispatch)
+        depths_task = Task("queue depths", queue_depths_interval, log_queue_depths)
+        tasks = [submit_task, status_task, dispatch_task, depths_task]
+
+        while True:
+            timeout = max(0, min(task.next_run for task in tasks) - time.monotonic())
+            try:
+                pending = [events.get(timeout=timeout)]
+            except queue.Empty:
+                pending = []
+            # Handle everything that arrived in the meantime in one go
+            while True:
+                try:
+                    pending.append(events.get_nowait())
+                except queue.Empty:
+                    break
+
+            receipt_handles = []
+            for kind, payload in pending:
+                if kind == MESSAGE_EVENT:
+                    msg, receipt_handle = payload
+                    logger.info(
+                        f"Evaluation server {server_id} received SQS message {msg}"
+                    )
+                    try:
+                        if msg.get("reload_datasets", False):
+                            requester.set_datasets(wait_for_datasets())
+                        requester.request(msg)
+                    except Exception as ex:
+                        logger.exception(f"Exception in handling {msg}: {ex}")
+                    receipt_handles.append(receipt_handle)
+                    submit_task.trigger()
+                elif kind == JOB_DONE_EVENT:
+                    dispatch_task.trigger()
+            if receipt_handles:
+                try:
+                    delete_messages(sqs, queue_url, receipt_handles)
+                except Exception as ex:
+                    logger.exception(f"Exception in deleting SQS messages: {ex}")
+                messages_handled.set()
+
+            now = time.monotonic()
+            for task in tasks:
+                task.run_if_due(now)
+            try:
+                flush_evaluation_statuses()
+            except Exception as ex:
+                logger.exception(f"Exception in writing evaluation statuses: {ex}")
 
 
 if __name__ == "__main__":
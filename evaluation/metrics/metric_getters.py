@@ -1,21 +1,27 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
-import yaml
+import numpy as np
 
 from metrics.instance_property import instance_property
 from metrics.metrics_dicts import (
     delta_metrics_dict,
     eval_metrics_dict,
+    grouped_eval_metrics_dict,
     job_metrics_dict,
     metrics_meta_dict,
 )
 
 
+def _get_task_config(task):
+    # Imported here because the api's models import this module.
+    from common.task_config import get_task_config
+
+    return get_task_config(task)
+
+
 def get_eval_metrics(task, predictions: list, targets: list) -> tuple:
-    perf_metric_type = yaml.load(task.config_yaml, yaml.SafeLoader)["perf_metric"][
-        "type"
-    ]
+    perf_metric_type = _get_task_config(task).perf_metric_type
     # NOTE:
     # right now, the returned eval metric scores are just the perf metric, but we
     # could add a feature that allows for the display of multiple eval metrics
@@ -27,6 +33,49 @@ def get_eval_metrics(task, predictions: list, targets: list) -> tuple:
     return score_dict[perf_metric_type], score_dict
 
 
+def get_eval_metrics_by_tag(
+    task, predictions: list, targets: list, tags: list
+) -> tuple:
+    """
+    Returns the metrics over all the examples, as returned by get_eval_metrics, and
+    the metrics over the examples of each tag, as {tag: (perf, perf_dict)}.
+    tags[i] is the list of tags of the i-th example.
+
+    Metrics of grouped_eval_metrics_dict are computed for all the tags in a single
+    pass over the examples, other metrics are computed separately for each tag.
+    """
+    perf_metric_type = _get_task_config(task).perf_metric_type
+    if perf_metric_type not in grouped_eval_metrics_dict:
+        examples_by_tag = {}
+        for pred, target, example_tags in zip(predictions, targets, tags):
+            for tag in example_tags:
+                examples_by_tag.setdefault(tag, []).append((pred, target))
+        return get_eval_metrics(task, predictions, targets), {
+            tag: get_eval_metrics(task, *list(zip(*examples)))
+            for tag, examples in examples_by_tag.items()
+        }
+
+    # Group 0 contains all the examples, and group i > 0 the examples of a tag
+    group_by_tag = {}
+    example_ids = list(range(len(predictions)))
+    group_ids = [0] * len(predictions)
+    for i, example_tags in enumerate(tags):
+        for tag in example_tags:
+            example_ids.append(i)
+            group_ids.append(group_by_tag.setdefault(tag, len(group_by_tag) + 1))
+    scores = grouped_eval_metrics_dict[perf_metric_type](
+        predictions,
+        targets,
+        np.array(example_ids, dtype=np.int64),
+        np.array(group_ids, dtype=np.int64),
+        len(group_by_tag) + 1,
+    )
+    return (scores[0], {perf_metric_type: scores[0]}), {
+        tag: (scores[group], {perf_metric_type: scores[group]})
+        for tag, group in group_by_tag.items()
+    }
+
+
 def get_job_metrics(job, dataset, decen=False) -> dict:
     if not job.aws_metrics:
         return {}
@@ -50,9 +99,7 @@ def get_delta_metrics(
     predictions: a list of list of predictions
     targets: a list of labels
     """
-    perf_metric_type = yaml.load(task.config_yaml, yaml.SafeLoader)["perf_metric"][
-        "type"
-    ]
+    perf_metric_type = _get_task_config(task).perf_metric_type
     perf_metric = eval_metrics_dict[perf_metric_type]
     delta_metrics_scores = {
         perturb_prefix: delta_metrics_dict[perturb_prefix](
@@ -64,9 +111,10 @@ def get_delta_metrics(
 
 def get_task_metrics_meta(task):
     instance_config = instance_property[task.instance_type]
-    task_config = yaml.load(task.config_yaml, yaml.SafeLoader)
-    perf_metric_type = task_config["perf_metric"]["type"]
-    delta_metric_types = [obj["type"] for obj in task_config.get("delta_metrics", [])]
+    parsed_task_config = _get_task_config(task)
+    task_config = parsed_task_config.config
+    perf_metric_type = parsed_task_config.perf_metric_type
+    delta_metric_types = parsed_task_config.delta_metric_types
     aws_metric_names = instance_config["aws_metrics"]
 
     # TODO: make it possible to display some modes with aws metrics and some
@@ -10,7 +10,7 @@ from pathlib import Path
 import numpy as np
 import sacrebleu
 import sentencepiece
-from sklearn.metrics import f1_score
+from sacrebleu.metrics import BLEU
 
 from metrics.instance_property import instance_property
 
@@ -20,6 +20,32 @@ from .vqa_accuracy import VQAEval
 # perf functions. propose to move to dynalab
 
 
+def _group_sums(values, example_ids, group_ids, n_groups: int) -> np.ndarray:
+    """
+    Sums the values of the examples of each group. Examples can be in several
+    groups: group_ids[i] is a group of example example_ids[i]. Values are summed
+    in the order of the examples, like a sum() over the examples of a group would.
+    """
+    return np.bincount(
+        group_ids, weights=np.asarray(values)[example_ids], minlength=n_groups
+    )
+
+
+def _multilabel_pairs(label_sets: list, tag_index: dict) -> np.ndarray:
+    """Encodes which tags each example has as sorted unique `example * n_tags + tag`
+    integers, i.e. the positions of the ones in the flattened example x tag matrix.
+    """
+    n_tags = len(tag_index)
+    pairs = []
+    for i, labels in enumerate(label_sets):
+        if isinstance(labels, (list, tuple, set)):
+            js = [tag_index[tag] for tag in labels if tag in tag_index]
+        else:
+            js = [j for tag, j in tag_index.items() if tag in labels]
+        pairs.extend(i * n_tags + j for j in js)
+    return np.unique(np.array(pairs, dtype=np.int64))
+
+
 # eval_metrics, take predictions and targets as input
 def get_dataperf_f1(predictions: list, targets: list):
     """
@@ -31,37 +57,33 @@ def get_dataperf_f1(predictions: list, targets: list):
     if not isinstance(predictions[0], list):
         predictions = [[pred] for pred in predictions]
 
-    tag_f1_scores = {}
-    tag_results = {}
-
+    tag_index = {}
     for tags in targets:
         for tag in tags:
-            tag_results[tag] = {"t": [], "p": []}
-            tag_f1_scores[tag] = []
+            tag_index.setdefault(tag, len(tag_index))
+    tag_f1_scores = {tag: [] for tag in tag_index}
+    n_tags = len(tag_index)
+    n = min(len(predictions), len(targets))
+
+    # The f1 of each tag is a micro f1 over the binary "has the tag" labels,
+    # which is the fraction of examples on which the prediction and target agree.
+    target_pairs = _multilabel_pairs(targets[:n], tag_index)
+    target_counts = np.bincount(target_pairs % n_tags, minlength=n_tags)
 
     iterations = len(predictions[0])
     mean_f1s = []
     for iteration in range(iterations):
-        for tag in tag_results:
-            tag_results[tag] = {"t": [], "p": []}
-        for p, t in zip([pred[iteration] for pred in predictions], targets):
-            for tag in tag_results.keys():
-                if tag in p:
-                    tag_results[tag]["p"].append(1)
-                else:
-                    tag_results[tag]["p"].append(0)
-
-                if tag in t:
-                    tag_results[tag]["t"].append(1)
-                else:
-                    tag_results[tag]["t"].append(0)
-        f1_sum = 0
-        for tag in tag_results.keys():
-            f1 = f1_score(tag_results[tag]["t"], tag_results[tag]["p"], average="micro")
-            f1_sum += f1
+        pred_pairs = _multilabel_pairs(
+            [pred[iteration] for pred in predictions[:n]], tag_index
+        )
+        pred_counts = np.bincount(pred_pairs % n_tags, minlength=n_tags)
+        both = np.intersect1d(target_pairs, pred_pairs, assume_unique=True)
+        both_counts = np.bincount(both % n_tags, minlength=n_tags)
+        agreements = n - (target_counts + pred_counts - 2 * both_counts)
+        f1s = (agreements / n).tolist()
+        for tag, f1 in zip(tag_index, f1s):
             tag_f1_scores[tag].append(f1)
-
-        mean_f1s.append(f1_sum / len(tag_results.keys()))
+        mean_f1s.append(sum(f1s) / n_tags)
 
     perf_by_tag = []
     for tag, f1s in tag_f1_scores.items():
@@ -104,18 +126,56 @@ def get_accuracy(predictions: list, targets: list):
     neutral labels to be evaluated on a dataset with entailment, not-entailment labels.
     """
 
-    def equality(p, t):
-        if isinstance(t, list):
-            return p in t
-        elif isinstance(t, str):
-            return p == t
-        else:
-            raise TypeError("t must be a list of strings or a string")
-
-    acc = sum([equality(p, t) for p, t in zip(predictions, targets)]) / len(targets)
+    n_correct = int(np.count_nonzero(_accuracy_correct(predictions, targets)))
+    acc = n_correct / len(targets)
     return round(acc * 100, 2)
 
 
+def _accuracy_equality(p, t):
+    if isinstance(t, list):
+        return p in t
+    elif isinstance(t, str):
+        return p == t
+    else:
+        raise TypeError("t must be a list of strings or a string")
+
+
+def _accuracy_correct(predictions: list, targets: list) -> np.ndarray:
+    """Whether each prediction is correct, as a boolean array."""
+    equal = _str_equality(predictions, targets)
+    if equal is None:
+        equal = np.array(
+            [_accuracy_equality(p, t) for p, t in zip(predictions, targets)],
+            dtype=bool,
+        )
+    return equal
+
+
+def get_accuracy_by_group(
+    predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    correct = _accuracy_correct(predictions, targets)
+    n_correct = _group_sums(correct, example_ids, group_ids, n_groups)
+    n_examples = np.bincount(group_ids, minlength=n_groups)
+    return [
+        round(c / n * 100, 2) for c, n in zip(n_correct.tolist(), n_examples.tolist())
+    ]
+
+
+def _str_equality(predictions: list, targets: list):
+    """
+    Compares predictions and targets in one vectorized operation, when all of them
+    are strings. Returns None otherwise, eg when targets are lists of acceptable
+    labels.
+    """
+    n = min(len(predictions), len(targets))
+    predictions, targets = predictions[:n], targets[:n]
+    if set(map(type, targets)) != {str} or set(map(type, predictions)) != {str}:
+        return None
+    # Object arrays compare the python strings themselves
+    return np.array(predictions, dtype=object) == np.array(targets, dtype=object)
+
+
 def get_accuracy_meta(task=None):
     return {"unit": "%", "pretty_name": "Accuracy", "utility_direction": 1, "offset": 0}
 
@@ -139,11 +199,48 @@ def get_vqa_accuracy(predictions: list, targets: list):
     assumed that there is only one answer, not a list of answers)
     """
     vqa_eval = VQAEval()
-    acc_vqa = [
-        vqa_eval(list(t) if isinstance(t, str) else t, p)
+    acc_vqa = _vqa_accuracies(vqa_eval, predictions, targets)
+    return round(100 * float(sum(acc_vqa)) / len(acc_vqa), vqa_eval.n)
+
+
+def _vqa_accuracies(vqa_eval: VQAEval, predictions: list, targets: list) -> list:
+    # Answers repeat a lot, so each distinct answer is only normalized once, and
+    # the accuracy only depends on which ground truth answers match the result.
+    processed_answers = {}
+    processed_results = {}
+    accuracies = {}
+
+    def process_answer(ans):
+        if ans not in processed_answers:
+            processed_answers[ans] = vqa_eval.processAnswer(ans)
+        return processed_answers[ans]
+
+    def accuracy(t, p):
+        if p not in processed_results:
+            processed_results[p] = vqa_eval.processResult(p)
+        res = processed_results[p]
+        matches = tuple(process_answer(ans) == res for ans in t)
+        if matches not in accuracies:
+            accuracies[matches] = vqa_eval.accuracyFromMatches(list(matches))
+        return accuracies[matches]
+
+    return [
+        accuracy(list(t) if isinstance(t, str) else t, p)
         for p, t in zip(predictions, targets)
     ]
-    return round(100 * float(sum(acc_vqa)) / len(acc_vqa), vqa_eval.n)
+
+
+def get_vqa_accuracy_by_group(
+    predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    vqa_eval = VQAEval()
+    acc_vqa = np.array(_vqa_accuracies(vqa_eval, predictions, targets))
+    acc_sums = _group_sums(acc_vqa, example_ids, group_ids, n_groups)
+    n_examples = np.bincount(group_ids, minlength=n_groups)
+    return [
+        round(100 * s / n, vqa_eval.n)
+        for s, n in zip(acc_sums.tolist(), n_examples.tolist())
+    ]
 
 
 def get_vqa_accuracy_meta(task=None):
@@ -156,8 +253,46 @@ def get_vqa_accuracy_meta(task=None):
 
 
 def get_macro_f1(predictions: list, targets: list):
-    macro_f1 = f1_score(targets, predictions, average="macro")
-    return round(float(macro_f1) * 100, 2)
+    """
+    Same as sklearn's f1_score(targets, predictions, average="macro"), but computed
+    from label counts after encoding the labels once.
+    """
+    if len(predictions) != len(targets):
+        raise ValueError(
+            f"Found {len(targets)} targets but {len(predictions)} predictions"
+        )
+    all_examples = np.arange(len(targets))
+    return get_macro_f1_by_group(
+        predictions, targets, all_examples, np.zeros_like(all_examples), 1
+    )[0]
+
+
+def get_macro_f1_by_group(
+    predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    targets_array, predictions_array = np.asarray(targets), np.asarray(predictions)
+    if (targets_array.dtype.kind in "US") != (predictions_array.dtype.kind in "US"):
+        raise ValueError("Mix of string and non string labels")
+    labels, codes = np.unique(
+        np.concatenate([targets_array, predictions_array]), return_inverse=True
+    )
+    codes = codes.reshape(-1)
+    target_codes = codes[: len(targets)][example_ids]
+    pred_codes = codes[len(targets) :][example_ids]
+    n_labels = len(labels)
+    # Counts of each (group, label) pair
+    target_keys = group_ids * n_labels + target_codes
+    pred_keys = group_ids * n_labels + pred_codes
+    shape = (n_groups, n_labels)
+    size = n_groups * n_labels
+    tp = np.bincount(target_keys[target_codes == pred_codes], minlength=size)
+    true_sum = np.bincount(target_keys, minlength=size).reshape(shape)
+    pred_sum = np.bincount(pred_keys, minlength=size).reshape(shape)
+    # Like sklearn, only the labels that appear in a group are averaged
+    present = (true_sum + pred_sum) > 0
+    with np.errstate(invalid="ignore"):
+        f1 = 2 * tp.reshape(shape).astype(np.float64) / (true_sum + pred_sum)
+    return [round(float(np.mean(f1[g][present[g]])) * 100, 2) for g in range(n_groups)]
 
 
 def get_macro_f1_meta(task=None):
@@ -172,6 +307,11 @@ def get_squad_f1(predictions: list, targets: list):
     the f1 of p and each item in t is computed, and the max f1 is used, per the
     squad evaluation standard.
     """
+    f1 = sum(_squad_f1_scores(predictions, targets)) / len(targets)
+    return round(f1 * 100, 2)
+
+
+def _squad_f1_scores(predictions: list, targets: list) -> list:
     from transformers.data.metrics.squad_metrics import compute_f1
 
     def squad_f1_loop(t, p):
@@ -185,8 +325,18 @@ def get_squad_f1(predictions: list, targets: list):
         else:
             raise TypeError("t must be a list of strings or a string")
 
-    f1 = sum([squad_f1_loop(t, p) for p, t in zip(predictions, targets)]) / len(targets)
-    return round(f1 * 100, 2)
+    return [squad_f1_loop(t, p) for p, t in zip(predictions, targets)]
+
+
+def get_squad_f1_by_group(
+    predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    f1s = np.array(_squad_f1_scores(predictions, targets), dtype=np.float64)
+    f1_sums = _group_sums(f1s, example_ids, group_ids, n_groups)
+    n_examples = np.bincount(group_ids, minlength=n_groups)
+    return [
+        round(s / n * 100, 2) for s, n in zip(f1_sums.tolist(), n_examples.tolist())
+    ]
 
 
 def get_squad_f1_meta(task=None):
@@ -195,6 +345,10 @@ def get_squad_f1_meta(task=None):
 
 # TODO: split into different functions for fairness and robustness.
 def get_unperturbed_percent(predictions: list, targets: list, metric_func):
+    if metric_func is get_accuracy:
+        weights = _group_accuracies(predictions, targets)
+        if weights is not None:
+            return round(sum(weights) / len(weights), 2)
     total_unperturbed_weights, total = 0, 0
     for pl, t in zip(predictions, targets):
         if pl:
@@ -203,6 +357,27 @@ def get_unperturbed_percent(predictions: list, targets: list, metric_func):
     return round(total_unperturbed_weights / total, 2)
 
 
+def _group_accuracies(predictions: list, targets: list):
+    """
+    Returns get_accuracy(pl, [t] * len(pl)) for each non empty list of predictions
+    pl and its target t, computed in one vectorized pass. Returns None if the
+    predictions and targets can't be compared as strings.
+    """
+    groups = [(pl, t) for pl, t in zip(predictions, targets) if pl]
+    lengths = [len(pl) for pl, _ in groups]
+    equal = _str_equality(
+        [p for pl, _ in groups for p in pl],
+        [t for pl, t in groups for _ in pl],
+    )
+    if equal is None:
+        return None
+    if not groups:
+        return []
+    starts = np.cumsum([0] + lengths[:-1])
+    n_correct = np.add.reduceat(equal.astype(np.int64), starts).tolist()
+    return [round(c / m * 100, 2) for c, m in zip(n_correct, lengths)]
+
+
 def get_fairness_meta(task=None):
     return {"unit": "%", "pretty_name": "Fairness", "utility_direction": 1, "offset": 0}
 
@@ -222,6 +397,48 @@ def get_bleu(predictions: list, targets: list):
     return bleu.score
 
 
+def _bleu_by_group(
+    bleu, predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    """
+    Computes the sentence level n-gram statistics once, and the corpus BLEU of
+    each group from the sums of the statistics of its sentences. The statistics
+    are private to sacrebleu, so without them the BLEU of each group is computed
+    separately.
+    """
+    if not (
+        hasattr(bleu, "_extract_corpus_statistics")
+        and hasattr(bleu, "_compute_score_from_stats")
+    ):
+        group_example_ids = [[] for _ in range(n_groups)]
+        for example_id, group_id in zip(example_ids, group_ids):
+            group_example_ids[group_id].append(example_id)
+        return [
+            bleu.corpus_score(
+                [predictions[i] for i in ids], [[targets[i] for i in ids]]
+            ).score
+            if ids
+            else 0.0
+            for ids in group_example_ids
+        ]
+    stats = np.array(
+        bleu._extract_corpus_statistics(predictions, [targets]), dtype=np.int64
+    )
+    group_stats = np.zeros((n_groups, stats.shape[1]), dtype=np.int64)
+    np.add.at(group_stats, group_ids, stats[example_ids])
+    return [
+        bleu._compute_score_from_stats(stats.tolist()).score for stats in group_stats
+    ]
+
+
+def get_bleu_by_group(
+    predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    return _bleu_by_group(
+        BLEU(), predictions, targets, example_ids, group_ids, n_groups
+    )
+
+
 def get_bleu_meta(task=None):
     return {"unit": "", "pretty_name": "BLEU", "utility_direction": 1, "offset": 0}
 
@@ -254,6 +471,17 @@ def get_sp_bleu(predictions: list, targets: list):
     return bleu.score
 
 
+def get_sp_bleu_by_group(
+    predictions: list, targets: list, example_ids, group_ids, n_groups: int
+):
+    spm = get_spm_model()
+    spm_pred = [sp_tokenize(spm, pred) for pred in predictions]
+    spm_targets = [sp_tokenize(spm, tgt) for tgt in targets]
+    return _bleu_by_group(
+        BLEU(force=True), spm_pred, spm_targets, example_ids, group_ids, n_groups
+    )
+
+
 def get_sp_bleu_meta(task=None):
     return {"unit": "", "pretty_name": "sp-BLEU", "utility_direction": 1, "offset": 0}
 
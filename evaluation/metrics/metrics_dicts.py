@@ -16,6 +16,17 @@ eval_metrics_dict = {
     "dataperf_f1": metrics.get_dataperf_f1,
 }
 
+# grouped eval_metrics take predictions, targets and groups of examples as input,
+# and output the metric of each group, computed in a single pass over the examples
+grouped_eval_metrics_dict = {
+    "accuracy": metrics.get_accuracy_by_group,
+    "macro_f1": metrics.get_macro_f1_by_group,
+    "squad_f1": metrics.get_squad_f1_by_group,
+    "bleu": metrics.get_bleu_by_group,
+    "sp_bleu": metrics.get_sp_bleu_by_group,
+    "vqa_accuracy": metrics.get_vqa_accuracy_by_group,
+}
+
 delta_metrics_dict = {
     "fairness": metrics.get_unperturbed_percent,
     "robustness": metrics.get_unperturbed_percent,
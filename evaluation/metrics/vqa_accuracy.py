@@ -196,25 +196,31 @@ class VQAEval(ABC):
         self.answer_type = answer_type
 
     def __call__(self, gt: list, res: str):
+        resAns = self.processResult(res)
+        processed_gt = [self.processAnswer(ans) for ans in gt]
+        return self.accuracyFromMatches([ans == resAns for ans in processed_gt])
+
+    def processResult(self, res: str) -> str:
         resAns = res
         resAns = resAns.replace("\n", " ")
         resAns = resAns.replace("\t", " ")
         resAns = resAns.strip()
-        resAns = self.processPunctuation(resAns)
-        resAns = self.processDigitArticle(resAns)
-        processed_gt = []
-        for ans in gt:
-            ans = self.processPunctuation(ans)
-            ans = self.processDigitArticle(ans)
-            processed_gt.append(ans)
+        return self.processAnswer(resAns)
+
+    def processAnswer(self, ans: str) -> str:
+        ans = self.processPunctuation(ans)
+        ans = self.processDigitArticle(ans)
+        return ans
+
+    def accuracyFromMatches(self, matches: list) -> float:
+        """Accuracy given whether each ground truth answer matches the result."""
         gtAcc = []
         #######################################################
-        for idx, gtAnsDatum in enumerate(processed_gt):
-            otherGTAns = [
-                item for item_idx, item in enumerate(processed_gt) if item_idx != idx
+        for idx in range(len(matches)):
+            otherMatches = [
+                match for match_idx, match in enumerate(matches) if match_idx != idx
             ]
-            matchingAns = [item for item in otherGTAns if item == resAns]
-            acc = min(1, float(len(matchingAns)) / 3)
+            acc = min(1, float(sum(otherMatches)) / 3)
             gtAcc.append(acc)
         #######################################################
         avgGTAcc = float(sum(gtAcc)) / len(gtAcc)
@@ -0,0 +1,221 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Compares the metrics of metrics/metrics.py with their previous, per example,
+# implementations on synthetic data: checks that both return the same values and
+# prints how long each took.
+# example usage:
+# python benchmark_metrics.py --n 1000000
+
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+from sklearn.metrics import f1_score
+
+
+sys.path.append("..")  # noqa
+from metrics import metrics  # noqa isort:skip
+from metrics.vqa_accuracy import VQAEval  # noqa isort:skip
+
+
+def reference_accuracy(predictions: list, targets: list):
+    def equality(p, t):
+        if isinstance(t, list):
+            return p in t
+        elif isinstance(t, str):
+            return p == t
+        else:
+            raise TypeError("t must be a list of strings or a string")
+
+    acc = sum([equality(p, t) for p, t in zip(predictions, targets)]) / len(targets)
+    return round(acc * 100, 2)
+
+
+def reference_macro_f1(predictions: list, targets: list):
+    macro_f1 = f1_score(targets, predictions, average="macro")
+    return round(float(macro_f1) * 100, 2)
+
+
+def reference_unperturbed_percent(predictions: list, targets: list, metric_func):
+    total_unperturbed_weights, total = 0, 0
+    for pl, t in zip(predictions, targets):
+        if pl:
+            total_unperturbed_weights += metric_func(pl, [t] * len(pl))
+            total += 1
+    return round(total_unperturbed_weights / total, 2)
+
+
+def reference_vqa_accuracy(predictions: list, targets: list):
+    vqa_eval = VQAEval()
+
+    def vqa(gt, res):
+        resAns = res.replace("\n", " ").replace("\t", " ").strip()
+        resAns = vqa_eval.processDigitArticle(vqa_eval.processPunctuation(resAns))
+        processed_gt = [
+            vqa_eval.processDigitArticle(vqa_eval.processPunctuation(ans)) for ans in gt
+        ]
+        gtAcc = []
+        for idx, _ in enumerate(processed_gt):
+            otherGTAns = [
+                item for item_idx, item in enumerate(processed_gt) if item_idx != idx
+            ]
+            matchingAns = [item for item in otherGTAns if item == resAns]
+            gtAcc.append(min(1, float(len(matchingAns)) / 3))
+        return float(sum(gtAcc)) / len(gtAcc)
+
+    acc_vqa = [
+        vqa(list(t) if isinstance(t, str) else t, p)
+        for p, t in zip(predictions, targets)
+    ]
+    return round(100 * float(sum(acc_vqa)) / len(acc_vqa), vqa_eval.n)
+
+
+def reference_dataperf_f1(predictions: list, targets: list):
+    if not isinstance(predictions[0], list):
+        predictions = [[pred] for pred in predictions]
+
+    tag_f1_scores = {}
+    tag_results = {}
+    for tags in targets:
+        for tag in tags:
+            tag_results[tag] = {"t": [], "p": []}
+            tag_f1_scores[tag] = []
+
+    iterations = len(predictions[0])
+    mean_f1s = []
+    for iteration in range(iterations):
+        for tag in tag_results:
+            tag_results[tag] = {"t": [], "p": []}
+        for p, t in zip([pred[iteration] for pred in predictions], targets):
+            for tag in tag_results.keys():
+                tag_results[tag]["p"].append(1 if tag in p else 0)
+                tag_results[tag]["t"].append(1 if tag in t else 0)
+        f1_sum = 0
+        for tag in tag_results.keys():
+            f1 = f1_score(tag_results[tag]["t"], tag_results[tag]["p"], average="micro")
+            f1_sum += f1
+            tag_f1_scores[tag].append(f1)
+        mean_f1s.append(f1_sum / len(tag_results.keys()))
+
+    perf_by_tag = []
+    for tag, f1s in tag_f1_scores.items():
+        mean = float(np.mean(f1s)) * 100
+        std = float(np.std(f1s * 100))
+        perf_by_tag.append(
+            {
+                "tag": tag,
+                "pretty_perf": str(round(mean, 2)) + " %",
+                "perf": round(mean, 2),
+                "perf_std": round(std, 2) if len(predictions[0]) > 1 else None,
+                "perf_dict": {"dataperf_f1": round(mean, 2)},
+            }
+        )
+    mean_mean_f1s = float(np.mean(mean_f1s)) * 100
+    return {
+        "dataperf_f1": round(mean_mean_f1s, 2),
+        "perf": round(mean_mean_f1s, 2),
+        "perf_std": round(float(np.std(mean_f1s * 100)), 2)
+        if len(predictions[0]) > 1
+        else None,
+        "perf_by_tag": perf_by_tag,
+    }
+
+
+def make_cases(n: int, seed: int) -> dict:
+    """Synthetic inputs of n examples for each metric."""
+    rng = random.Random(seed)
+    classes = ["entailed", "neutral", "contradictory", "other"]
+    targets = [rng.choice(classes) for _ in range(n)]
+    predictions = [t if rng.random() < 0.7 else rng.choice(classes) for t in targets]
+
+    # ~5 perturbed predictions per example
+    perturbed = [
+        [t if rng.random() < 0.8 else rng.choice(classes) for _ in range(5)]
+        for t in targets[: n // 5]
+    ]
+    for i in range(0, len(perturbed), 10):
+        perturbed[i] = []
+
+    answers = ["yes", "no", "two", "2", "a dog", "the cat", "red", "blue."]
+    vqa_targets = [[rng.choice(answers) for _ in range(10)] for _ in range(n // 10)]
+    vqa_predictions = [rng.choice(answers) for _ in vqa_targets]
+
+    # Dataperf tasks are scored on few examples, with many labels
+    tags = [f"tag{i}" for i in range(50)]
+    dataperf_targets = [rng.sample(tags, rng.randint(1, 3)) for _ in range(n // 100)]
+    dataperf_predictions = [
+        [
+            [tag for tag in t if rng.random() < 0.8] + rng.sample(tags, 1)
+            for _ in range(3)
+        ]
+        for t in dataperf_targets
+    ]
+
+    return {
+        "accuracy": (
+            metrics.get_accuracy,
+            reference_accuracy,
+            (predictions, targets),
+        ),
+        "macro_f1": (
+            metrics.get_macro_f1,
+            reference_macro_f1,
+            (predictions, targets),
+        ),
+        "unperturbed_percent": (
+            metrics.get_unperturbed_percent,
+            reference_unperturbed_percent,
+            (perturbed, targets[: n // 5], metrics.get_accuracy),
+        ),
+        "vqa_accuracy": (
+            metrics.get_vqa_accuracy,
+            reference_vqa_accuracy,
+            (vqa_predictions, vqa_targets),
+        ),
+        "dataperf_f1": (
+            metrics.get_dataperf_f1,
+            reference_dataperf_f1,
+            (dataperf_predictions, dataperf_targets),
+        ),
+    }
+
+
+def timed(func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the metrics with their previous implementations"
+    )
+    parser.add_argument("--n", type=int, default=1000000, help="number of examples")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--metrics", nargs="*", help="only run these metrics")
+    args = parser.parse_args()
+
+    failed = False
+    for name, (new, reference, inputs) in make_cases(args.n, args.seed).items():
+        if args.metrics and name not in args.metrics:
+            continue
+        new_result, new_time = timed(new, inputs)
+        reference_result, reference_time = timed(reference, inputs)
+        same = new_result == reference_result
+        failed = failed or not same
+        print(
+            f"{name}: {reference_time:.2f}s -> {new_time:.2f}s "
+            + f"(x{reference_time / max(new_time, 1e-9):.1f}), "
+            + ("same results" if same else "DIFFERENT RESULTS")
+        )
+        if not same:
+            print(f"  reference: {reference_result}\n  new: {new_result}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,6 @@ in order to release failed jobs
 """
 
 import logging
-import pickle
 import sys
 
 
@@ -19,33 +18,28 @@ logger = logging.getLogger("request_evaluation")
 sys.path.append(".")  # noqa
 from eval_config import eval_config  # noqa isort:skip
 from utils.helpers import send_takedown_model_request  # noqa isort:skip
+from utils.job_store import JobStore  # noqa isort:skip
 
 sys.path.append("../api")  # noqa
 from common.config import config  # noqa isort:skip
 from models.model import DeploymentStatusEnum, ModelModel  # noqa isort:skip
 
 
-def get_failed_endpoints(eval_config):
-    endpoints, failed_jobs = {}, set()
-    try:
-        s = pickle.load(open(eval_config["scheduler_status_dump"], "rb"))
-        for j in s["failed"]:
-            if j.status and j.status.get("FailureReason", "").startswith(
-                "AlgorithmError"
-            ):
-                endpoints[j.model_id] = j.endpoint_name
-                failed_jobs.add(j.job_name)
-    except FileNotFoundError:
-        s = None
+def get_failed_endpoints(store):
+    endpoints, failed_jobs = {}, []
+    for j in store.get("failed"):
+        if j.status and j.status.get("FailureReason", "").startswith("AlgorithmError"):
+            endpoints[j.model_id] = j.endpoint_name
+            failed_jobs.append(j)
     mm = ModelModel()
     models = mm.getByDeploymentStatus(deployment_status=DeploymentStatusEnum.failed)
+    new_mids = set()
     for m in models:
         if m.id not in endpoints:
             endpoints[m.id] = m.endpoint_name
-            if s:
-                for j in s["failed"]:
-                    if j.model_id == m.id:
-                        failed_jobs.add(j.job_name)
+            new_mids.add(m.id)
+    if new_mids:
+        failed_jobs.extend(store.get("failed", model_ids=new_mids))
     return endpoints, failed_jobs
 
 
@@ -58,17 +52,16 @@ def update_db_and_request_cleanup(endpoints):
             send_takedown_model_request(mid, config, logger=logger)
 
 
-def release_failed_jobs(eval_config, failed_job_names):
-    try:
-        s = pickle.load(open(eval_config["scheduler_status_dump"], "rb"))
-        s["failed"] = [j for j in s["failed"] if j.job_name not in failed_job_names]
-        pickle.dump(s, open(eval_config["scheduler_status_dump"], "wb"))
-        print(f"Released failed jobs {failed_job_names}")
-    except FileNotFoundError:
-        pass
+def release_failed_jobs(store, failed_jobs):
+    for j in failed_jobs:
+        store.remove(j)
+    print(f"Released failed jobs {[j.job_name for j in failed_jobs]}")
 
 
 if __name__ == "__main__":
-    endpoints, failed_job_names = get_failed_endpoints(eval_config)
+    store = JobStore(
+        eval_config["scheduler_job_store"], eval_config.get("scheduler_status_dump")
+    )
+    endpoints, failed_jobs = get_failed_endpoints(store)
     update_db_and_request_cleanup(endpoints)
-    release_failed_jobs(eval_config, failed_job_names)
+    release_failed_jobs(store, failed_jobs)
@@ -16,6 +16,8 @@ test_config = {
     "dataset_s3_bucket": "nope",
     "sagemaker_role": "nope",
     "evaluation_sqs_queue": "nope",
+    "scheduler_job_store": "tests/scheduler.sqlite",
+    "computer_job_store": "tests/computer.sqlite",
     "scheduler_status_dump": "tests/scheduler.dump",
     "computer_status_dump": "tests/computer.dump",
     "eval_server_id": "unittest",
@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+
+from utils import columnar
+
+
+pytest.importorskip("pyarrow")
+
+
+def test_round_trip():
+    records = [
+        {"id": "1", "answer": "entailed", "tags": ["a"], "input_id": "0"},
+        {"id": "2", "answer": "neutral", "tags": [], "input_id": "0"},
+    ]
+    assert columnar.records_from_bytes(columnar.records_to_bytes(records)) == records
+
+
+def test_round_trip_keeps_json_types():
+    # Mixed ints and floats, and dicts with different keys, can't be stored as
+    # native columns without changing the values.
+    records = [
+        {"id": "1", "answer": 1, "tags": [], "pred": {"a": 1}},
+        {"id": "2", "answer": 2.5, "tags": [], "pred": {"b": [1, 2]}},
+    ]
+    table = columnar.to_table(records)
+    assert columnar.from_table(table) == records
+    assert [type(r["answer"]) for r in columnar.from_table(table)] == [int, float]
+
+
+def test_file_round_trip(tmp_path):
+    records = [{"id": str(i), "answer": i % 3, "tags": ["t"]} for i in range(100)]
+    path = str(tmp_path / "labels.parquet")
+    columnar.write_records(records, path)
+    assert columnar.read_records(path) == records
+
+
+def test_round_trip_records_with_different_keys():
+    records = [
+        {"id": "1", "label": "a"},
+        {"id": "2", "label": "b", "prob": {"a": 0.1, "b": 0.9}},
+        {"label": "c", "id": "3"},
+    ]
+    assert columnar.records_from_bytes(columnar.records_to_bytes(records)) == records
+    assert [
+        list(record) for record in columnar.from_table(columnar.to_table(records))
+    ] == [list(record) for record in records]
+
+
+def test_round_trip_empty_records():
+    assert columnar.from_table(columnar.to_table([{}, {}])) == [{}, {}]
+    assert columnar.from_table(columnar.to_table([])) == []
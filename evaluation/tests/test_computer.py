@@ -5,6 +5,7 @@
 import json
 import logging
 import multiprocessing
+import time
 import weakref
 from pathlib import Path
 from typing import Dict, List, NamedTuple, Tuple
@@ -64,6 +65,12 @@ class FailingMnliDataset(OfflineMnliDataset):
         raise RuntimeError("Move Fast, Break Things")
 
 
+class SlowMnliDataset(OfflineMnliDataset):
+    def compute_job_metrics(self, job: Job) -> Tuple[dict, dict]:
+        time.sleep(1)
+        return super().compute_job_metrics(job)
+
+
 class UnpickableMnliDataset(OfflineMnliDataset):
     def __init__(self, examples):
         super().__init__(examples)
@@ -72,7 +79,7 @@ class UnpickableMnliDataset(OfflineMnliDataset):
 
 class MetricsComputerWithoutDb(MetricsComputer):
     def __init__(self, folder: Path, datasets: dict):
-        config = {"computer_status_dump": str(folder / "computer.unittest.dump")}
+        config = {"computer_job_store": str(folder / "computer.unittest.sqlite")}
         super().__init__(config, datasets)
         self.metrics: dict = {}
 
@@ -89,8 +96,7 @@ class MetricsComputerWithoutDb(MetricsComputer):
         print("Successfully computed metrics for", job.job_name)
 
         # Note: this is copied from the original implementation.
-        if job in self._computing:
-            self._computing.remove(job)
+        self._store.remove(job)
         self.dump()
 
 
@@ -168,9 +174,13 @@ def test_compute_one_async_failing(tmp_path: Path, caplog):
         ("computer", logging.ERROR, "Move Fast, Break Things")
     ]
 
-    # Check that interrupted job are picked up when starting a new computer.
+    # Check that failed jobs are still failed when starting a new computer.
     new_computer = MetricsComputerWithoutDb(tmp_path, {})
-    assert new_computer.get_jobs("Waiting") == [job]
+    assert new_computer.get_status() == {
+        "computing": [],
+        "waiting": [],
+        "failed": [job],
+    }
 
 
 def test_compute_one_async_terminate(tmp_path: Path):
@@ -210,3 +220,39 @@ def test_compute_one_async_unpickable(tmp_path: Path, caplog):
     assert caplog.record_tuples == [
         ("computer", logging.ERROR, "cannot pickle 'weakref' object")
     ]
+
+
+def test_find_ready_jobs_original_first(tmp_path: Path):
+    computer = MetricsComputerWithoutDb(tmp_path, {})
+    perturbed = Job(30, "test_find_ready_jobs", "fake_mnli", perturb_prefix="fairness")
+    original = Job(30, "test_find_ready_jobs", "fake_mnli")
+    computer._store.put(perturbed, "waiting")
+    computer._store.put(original, "waiting")
+
+    # The perturbed job needs the score of the original one, which is still waiting
+    assert computer.find_ready_jobs(2) == [original]
+    assert computer.find_next_ready_job() == original
+
+
+def test_dispatch_fills_free_slots(tmp_path: Path):
+    nli_dataset = SlowMnliDataset(NLI_SAMPLES)
+    computer = MetricsComputerWithoutDb(tmp_path, {"fake_mnli": nli_dataset})
+    jobs = [Job(40 + i, f"test_dispatch_{i}", "fake_mnli") for i in range(3)]
+    for job in jobs:
+        nli_dataset.register_job_output(job, SOME_NLI_MODEL_OUTPUT)
+        computer._store.put(job, "waiting")
+
+    with multiprocessing.pool.Pool(2) as pool:
+        assert computer.dispatch(pool, 2) == 2
+        # The pool is full, the last job has to wait
+        assert computer.dispatch(pool, 2) == 0
+        assert computer.get_jobs("Waiting") == [jobs[2]]
+
+        for _, result in computer._in_flight:
+            result.wait()
+        assert computer.dispatch(pool, 2) == 1
+        pool.close()
+        pool.join()
+
+    assert computer.get_status() == {"computing": [], "waiting": [], "failed": []}
+    assert sorted(computer.metrics) == sorted(job.job_name for job in jobs)
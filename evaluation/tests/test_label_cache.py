@@ -0,0 +1,94 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+
+from utils.label_cache import LabelCache
+
+
+class FakeS3Client:
+    """Serves files from memory, counting the downloads."""
+
+    def __init__(self):
+        self.files = {}
+        self.downloads = 0
+
+    def upload(self, key: str, examples: list):
+        content = "".join(json.dumps(example) + "\n" for example in examples)
+        self.files[key] = (content, f'"{hash(content)}"')
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": self.files[Key][1]}
+
+    def download_file(self, bucket, key, path):
+        self.downloads += 1
+        with open(path, "w") as f:
+            f.write(self.files[key][0])
+
+
+def convert(example):
+    return {"id": example["uid"], "answer": example["label"]}
+
+
+def test_downloads_once(tmp_path):
+    s3_client = FakeS3Client()
+    s3_client.upload("data.jsonl", [{"uid": "1", "label": "e"}])
+    expected = [{"id": "1", "answer": "e"}]
+
+    cache = LabelCache(str(tmp_path))
+    for _ in range(3):
+        assert cache.get(s3_client, "bucket", "data.jsonl", convert) == expected
+    assert s3_client.downloads == 1
+
+    # Other processes and restarts reuse the file on disk
+    other_cache = LabelCache(str(tmp_path))
+    assert other_cache.get(s3_client, "bucket", "data.jsonl", convert) == expected
+    assert s3_client.downloads == 1
+
+
+def test_reupload_invalidates(tmp_path):
+    s3_client = FakeS3Client()
+    s3_client.upload("data.jsonl", [{"uid": "1", "label": "e"}])
+    cache = LabelCache(str(tmp_path))
+    cache.get(s3_client, "bucket", "data.jsonl", convert)
+
+    s3_client.upload("data.jsonl", [{"uid": "2", "label": "n"}])
+    labels = cache.get(s3_client, "bucket", "data.jsonl", convert)
+    assert labels == [{"id": "2", "answer": "n"}]
+    assert s3_client.downloads == 2
+    # Only the latest version is kept on disk
+    etag = s3_client.head_object("bucket", "data.jsonl")["ETag"].strip('"')
+    assert all(etag in path for path in os.listdir(tmp_path))
+
+
+def test_lru_eviction(tmp_path):
+    s3_client = FakeS3Client()
+    for i in range(3):
+        s3_client.upload(f"data{i}.jsonl", [{"uid": str(i), "label": "e"}])
+    cache = LabelCache(str(tmp_path), max_entries=2)
+    for i in range(3):
+        cache.get(s3_client, "bucket", f"data{i}.jsonl", convert)
+    assert [key for _, key, _, _ in cache._labels] == ["data1.jsonl", "data2.jsonl"]
+
+
+def convert_answer_only(example):
+    return {"answer": example["label"]}
+
+
+def test_converter_or_config_change_invalidates(tmp_path):
+    s3_client = FakeS3Client()
+    s3_client.upload("data.jsonl", [{"uid": "1", "label": "e"}])
+    cache = LabelCache(str(tmp_path))
+    cache.get(s3_client, "bucket", "data.jsonl", convert, converter_config="a: 1")
+
+    other_cache = LabelCache(str(tmp_path))
+    labels = other_cache.get(s3_client, "bucket", "data.jsonl", convert_answer_only)
+    assert labels == [{"answer": "e"}]
+    labels = other_cache.get(
+        s3_client, "bucket", "data.jsonl", convert, converter_config="a: 2"
+    )
+    assert labels == [{"id": "1", "answer": "e"}]
+    # The file itself is only downloaded once
+    assert s3_client.downloads == 1
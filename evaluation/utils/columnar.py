@@ -0,0 +1,100 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Parquet copies of the examples and predictions used to compute metrics.
+
+They are much cheaper to read than .jsonl files, since they don't need to be
+parsed line by line and local files can be memory mapped. pyarrow is an optional
+dependency: without it, columnar_available() returns False and callers keep
+using .jsonl files.
+"""
+
+import json
+
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+# Metadata key listing the columns whose values are stored as json strings
+JSON_COLUMNS_KEY = b"dynabench.json_columns"
+# Metadata key set when whole records are stored as json strings, in one column
+JSON_RECORDS_KEY = b"dynabench.json_records"
+
+
+def columnar_available() -> bool:
+    return pa is not None
+
+
+def _to_array(values: list):
+    """Returns a native arrow array for the values, or None if they can't be
+    stored as one without changing them (eg ints mixed with floats, or dicts with
+    different keys). Values are parsed from json, so they are compared as json."""
+    try:
+        array = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None
+    if json.dumps(array.to_pylist()) != json.dumps(values):
+        return None
+    return array
+
+
+def to_table(records: list):
+    """Converts a list of dicts to an arrow table, with one column per key. Dicts
+    that don't all have the same keys, in the same order, can't be stored as
+    columns without changing them, so they are stored as json strings."""
+    names = list(dict.fromkeys(key for record in records for key in record))
+    if not names or any(list(record) != names for record in records):
+        table = pa.Table.from_arrays(
+            [pa.array([json.dumps(record) for record in records], pa.string())],
+            names=["records"],
+        )
+        return table.replace_schema_metadata({JSON_RECORDS_KEY: b"1"})
+    arrays = []
+    json_columns = []
+    for name in names:
+        values = [record.get(name) for record in records]
+        array = _to_array(values)
+        if array is None:
+            array = pa.array([json.dumps(value) for value in values], pa.string())
+            json_columns.append(name)
+        arrays.append(array)
+    table = pa.Table.from_arrays(arrays, names=names)
+    return table.replace_schema_metadata(
+        {JSON_COLUMNS_KEY: json.dumps(json_columns).encode("utf-8")}
+    )
+
+
+def from_table(table) -> list:
+    """Converts a table created by to_table back to a list of dicts."""
+    metadata = table.schema.metadata or {}
+    if JSON_RECORDS_KEY in metadata:
+        return [json.loads(value) for value in table.column(0).to_pylist()]
+    json_columns = json.loads(metadata.get(JSON_COLUMNS_KEY, b"[]"))
+    columns = table.to_pydict()
+    for name in json_columns:
+        columns[name] = [json.loads(value) for value in columns[name]]
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def write_records(records: list, path: str) -> None:
+    pq.write_table(to_table(records), path)
+
+
+def read_records(path: str) -> list:
+    return from_table(pq.read_table(path, memory_map=True))
+
+
+def records_to_bytes(records: list) -> bytes:
+    sink = pa.BufferOutputStream()
+    pq.write_table(to_table(records), sink)
+    return sink.getvalue().to_pybytes()
+
+
+def records_from_bytes(data: bytes) -> list:
+    return from_table(pq.read_table(pa.BufferReader(data)))
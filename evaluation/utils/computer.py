@@ -5,8 +5,7 @@
 import functools
 import json
 import logging
-import pickle
-from typing import Optional
+from typing import List, Optional
 
 from enum import Enum
 
@@ -16,6 +15,7 @@ from models.round import RoundModel
 from models.score import ScoreModel
 from utils.evaluator import Job
 from utils.helpers import update_evaluation_status, update_metadata_json_string
+from utils.job_store import JobStore
 
 
 logger = logging.getLogger("computer")
@@ -29,27 +29,25 @@ class ComputeStatusEnum(Enum):
 
 class MetricsComputer:
     def __init__(self, config, datasets):
-        self._status_dump = config["computer_status_dump"]
-        self._waiting, self._failed = self._load_status()
-        self._computing = []
+        self._store = JobStore(
+            config["computer_job_store"], config.get("computer_status_dump")
+        )
+        # When reloading, we consider that "computing" job have been interrupted
+        # and we need to recompute them
+        interrupted = self._store.move_all("computing", "waiting")
+        if interrupted:
+            logger.info(f"Requeued {interrupted} interrupted jobs.")
         self.datasets = datasets
+        # Called with the job whenever a computation ends, successfully or not
+        self.on_job_done = None
+        # (job, AsyncResult) of the computations started by compute_one_async
+        self._in_flight = []
+        self._dataset_ids = {}  # dataset name -> id
 
-    def _load_status(self):
-        try:
-            status = pickle.load(open(self._status_dump, "rb"))
-            logger.info(f"Load existing status from {self._status_dump}.")
-            # When reloading, we consider that "computing" job have been interrupted
-            # and we need to recompute them
-            computing = status["computing"] + status.get("waiting", [])
-            return computing, status["failed"]
-        except FileNotFoundError:
-            logger.info("No existing computer status found. Re-initializing...")
-            return [], []
-        except Exception as ex:
-            logger.exception(
-                f"Exception in loading computer status: {ex}. Re-initializing..."
-            )
-            return [], []
+    def set_datasets(self, datasets):
+        self.datasets = datasets
+        # Reloaded datasets may have been re-created with new ids
+        self._dataset_ids = {}
 
     def update_database_with_metrics(
         self, job, eval_metrics_dict: dict, delta_metrics_dict: dict
@@ -98,33 +96,34 @@ class MetricsComputer:
                     score_obj["r_realid"] = 0
                 sm.create(**score_obj)
 
-        if job in self._computing:
-            self._computing.remove(job)
+        self._store.remove(job)
         self.dump()
 
         update_evaluation_status(job.model_id, job.dataset_name, "completed")
 
         logger.info(f"Successfully evaluated {job.job_name}")
+        if self.on_job_done:
+            self.on_job_done(job)
 
     def update_status(self, jobs: list):
         if jobs:
-            self._waiting.extend(jobs)
             for job in jobs:
+                self._store.put(job, "waiting")
                 update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
             self.dump()
 
     def log_job_error(self, job, ex):
         logger.exception(ex)
-        if job in self._computing:
-            self._computing.remove(job)
-        self._failed.append(job)
+        self._store.put(job, "failed")
         update_evaluation_status(job.model_id, job.dataset_name, "failed")
+        if self.on_job_done:
+            self.on_job_done(job)
 
     def compute_one_blocking(self, job) -> None:
         try:
 
             logger.info(f"Evaluating {job.job_name}")
-            self._computing.append(job)
+            self._store.put(job, "computing")
             update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
             dataset = self.datasets[job.dataset_name]
             eval_metrics, delta_metrics = dataset.compute_job_metrics(job)
@@ -135,16 +134,19 @@ class MetricsComputer:
             return
 
     def compute_one_async(self, process_pool, job):
+        # The job must be in the computing queue before the callbacks can run
+        self._store.put(job, "computing")
+        update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
         try:
             dataset = self.datasets[job.dataset_name]
-            process_pool.apply_async(
+            result = process_pool.apply_async(
                 dataset.compute_job_metrics,
                 args=(job,),
                 callback=lambda res: self.update_database_with_metrics(job, *res),
                 error_callback=functools.partial(self.log_job_error, job),
             )
         except Exception as e:
-            self._failed.append(job)
+            self._store.put(job, "failed")
             update_evaluation_status(job.model_id, job.dataset_name, "failed")
             logger.error(
                 f"Couldn't start the final evaluation for {job}."
@@ -154,66 +156,130 @@ class MetricsComputer:
             self.dump()
             return
 
-        self._computing.append(job)
-        update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
+        self._in_flight.append((job, result))
         self.dump()
 
+    def dispatch(self, process_pool, max_in_flight: int) -> int:
+        """Starts ready jobs until max_in_flight computations are running.
+
+        Returns the number of jobs started. When the pool is already full, the
+        waiting jobs aren't even looked at.
+        """
+        self._in_flight = [
+            (job, result) for job, result in self._in_flight if not result.ready()
+        ]
+        free_slots = max_in_flight - len(self._in_flight)
+        if free_slots <= 0:
+            return 0
+        jobs = self.find_ready_jobs(free_slots)
+        for job in jobs:
+            self.compute_one_async(process_pool, job)
+        return len(jobs)
+
+    def find_ready_jobs(self, limit: int) -> List[Job]:
+        """Finds up to `limit` jobs ready to start evaluating.
+
+        Jobs on original datasets are always ready and come first, since the jobs
+        on perturbed datasets need their score. Perturbed jobs whose original job
+        is still waiting or computing are skipped without looking at the DB, and the
+        scores of all the others are looked up at once.
+
+        Note: the jobs returned stay in the waiting queue until they're passed to
+        `compute_one_async` or `compute_one_blocking`.
+        """
+        waiting = self._store.get("waiting")
+        ready = [job for job in waiting if not job.perturb_prefix][:limit]
+        if len(ready) == limit:
+            return ready
+
+        pending_originals = {
+            (job.model_id, job.dataset_name)
+            for job in waiting + self._store.get("computing")
+            if not job.perturb_prefix
+        }
+        perturbed = [
+            job
+            for job in waiting
+            if job.perturb_prefix
+            and (job.model_id, job.dataset_name) not in pending_originals
+        ]
+        if not perturbed:
+            return ready
+
+        # A single query tells which of the original evaluations are done
+        dataset_ids = self._get_dataset_ids({job.dataset_name for job in perturbed})
+        sm = ScoreModel()
+        scored = sm.getScoredModelIdAndDatasetIds(
+            {
+                (job.model_id, dataset_ids[job.dataset_name])
+                for job in perturbed
+                if job.dataset_name in dataset_ids
+            }
+        )
+        postponed = 0
+        for job in perturbed:
+            if (job.model_id, dataset_ids.get(job.dataset_name)) in scored:
+                ready.append(job)
+                if len(ready) == limit:
+                    break
+            else:
+                postponed += 1
+        if postponed:
+            logger.info(
+                f"Postponed {postponed} jobs that haven't received "
+                f"their original evaluation."
+            )
+        return ready
+
+    def _get_dataset_ids(self, dataset_names) -> dict:
+        missing = [name for name in dataset_names if name not in self._dataset_ids]
+        if missing:
+            dm = DatasetModel()
+            self._dataset_ids.update(dm.getIdsByNames(missing))
+        return {
+            name: self._dataset_ids[name]
+            for name in dataset_names
+            if name in self._dataset_ids
+        }
+
     def find_next_ready_job(self) -> Optional[Job]:
         """Finds the next job ready to start evaluating.
 
         Returns None if none of the job are ready.
-
-        Note: the job returned doesn't belong anymore to any of the internal lists
-        and need to be added back (eg by passing it to `compute_one_async`)
         """
-        dm = DatasetModel()
-        sm = ScoreModel()
+        jobs = self.find_ready_jobs(1)
+        return jobs[0] if jobs else None
 
-        n = len(self._waiting)
-        traversed = 0
-        while self._waiting and traversed < n:
-            job = self._waiting.pop(0)
-            traversed += 1
-
-            d_entry = dm.getByName(job.dataset_name)
-            score_entry = sm.getOneByModelIdAndDataset(job.model_id, d_entry.id)
-            if job.perturb_prefix and not score_entry:
-                logger.info(
-                    f"Haven't received original evaluation for {job.job_name}. "
-                    f"Postpone computation."
-                )
-                self._waiting.append(job)
-                update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
-            else:
-                self.dump()
-                return job
-        return None
-
-    def get_jobs(self, status="Failed"):
-        if status == "Failed":
-            return self._failed
-        elif status == "Computing":
-            return self._computing
-        elif status == "Waiting":
-            return self._waiting
-        else:
-            raise NotImplementedError(f"Scheduler does not maintain {status} queue")
+    def _queue(self, status):
+        if status not in ("Waiting", "Computing", "Failed"):
+            raise NotImplementedError(f"Computer does not maintain {status} queue")
+        return status.lower()
+
+    def get_jobs(self, status="Failed", model_ids=None):
+        return self._store.get(self._queue(status), model_ids=model_ids)
+
+    def discard_jobs(self, jobs):
+        for job in jobs:
+            self._store.remove(job)
 
     def get_status(self) -> dict:
         return {
-            "computing": self._computing,
-            "waiting": self._waiting,
-            "failed": self._failed,
+            "computing": self._store.get("computing"),
+            "waiting": self._store.get("waiting"),
+            "failed": self._store.get("failed"),
+        }
+
+    def get_queue_depths(self) -> dict:
+        counts = self._store.counts()
+        return {
+            queue: counts.get(queue, 0) for queue in ("waiting", "computing", "failed")
         }
 
     def dump(self):
-        # dump status to pre-specified path
-        status = self.get_status()
+        # The store is updated on every transition, this only logs a summary
+        depths = self.get_queue_depths()
         logger.info(
-            f"Computer status: \n"
-            + f"waiting jobs: {[job.job_name for job in status['waiting']]}\n"
-            + f"computing jobs: {[job.job_name for job in status['computing']]}\n"
-            + f"failed jobs: {[job.job_name for job in status['failed']]}"
+            f"Computer status: {depths['waiting']} waiting, "
+            + f"{depths['computing']} computing, "
+            + f"{depths['failed']} failed jobs"
         )
-        pickle.dump(status, open(self._status_dump, "wb"))
-        print(f"Computer dumped status to {self._status_dump}")
@@ -4,7 +4,6 @@
 
 import functools
 import logging
-import pickle
 from typing import Optional
 
 import ujson
@@ -16,6 +15,7 @@ from utils.helpers import (
     api_model_eval_update,
     api_update_database_with_metrics,
 )
+from utils.job_store import JobStore
 
 
 logger = logging.getLogger("computer")
@@ -29,28 +29,16 @@ class ComputeStatusEnum(Enum):
 
 class MetricsComputer:
     def __init__(self, config, datasets):
-        self._status_dump = config["computer_status_dump"]
-        self._waiting, self._failed = self._load_status()
-        self._computing = []
+        self._store = JobStore(
+            config["computer_job_store"], config.get("computer_status_dump")
+        )
+        # When reloading, we consider that "computing" job have been interrupted
+        # and we need to recompute them
+        interrupted = self._store.move_all("computing", "waiting")
+        if interrupted:
+            logger.info(f"Requeued {interrupted} interrupted jobs.")
         self.datasets = datasets
 
-    def _load_status(self):
-        try:
-            status = pickle.load(open(self._status_dump, "rb"))
-            logger.info(f"Load existing status from {self._status_dump}.")
-            # When reloading, we consider that "computing" job have been interrupted
-            # and we need to recompute them
-            computing = status["computing"] + status.get("waiting", [])
-            return computing, status["failed"]
-        except FileNotFoundError:
-            logger.info("No existing computer status found. Re-initializing...")
-            return [], []
-        except Exception as ex:
-            logger.exception(
-                f"Exception in loading computer status: {ex}. Re-initializing..."
-            )
-            return [], []
-
     def update_database_with_metrics(
         self, job, eval_metrics_dict: dict, delta_metrics_dict: dict
     ) -> None:
@@ -63,8 +51,7 @@ class MetricsComputer:
         }
         model_json = api_update_database_with_metrics(data)
 
-        if job in self._computing:
-            self._computing.remove(job)
+        self._store.remove(job)
         self.dump()
 
         # Don't change model's evaluation status if it has failed.
@@ -82,23 +69,21 @@ class MetricsComputer:
 
     def update_status(self, jobs: list):
         if jobs:
-            self._waiting.extend(jobs)
             for job in jobs:
+                self._store.put(job, "waiting")
                 api_model_eval_update(job.model_id, job.dataset_name, "evaluating")
             self.dump()
 
     def log_job_error(self, job, ex):
         logger.exception(ex)
-        if job in self._computing:
-            self._computing.remove(job)
-        self._failed.append(job)
+        self._store.put(job, "failed")
         api_model_eval_update(job.model_id, job.dataset_name, "failed")
 
     def compute_one_blocking(self, job) -> None:
         try:
 
             logger.info(f"Evaluating {job.job_name}")
-            self._computing.append(job)
+            self._store.put(job, "computing")
             api_model_eval_update(job.model_id, job.dataset_name, "evaluating")
             dataset = self.datasets[job.dataset_name]
             eval_metrics, delta_metrics = dataset.compute_job_metrics(job)
@@ -109,6 +94,9 @@ class MetricsComputer:
             return
 
     def compute_one_async(self, process_pool, job):
+        # The job must be in the computing queue before the callbacks can run
+        self._store.put(job, "computing")
+        api_model_eval_update(job.model_id, job.dataset_name, "evaluating")
         try:
             dataset = self.datasets[job.dataset_name]
             process_pool.apply_async(
@@ -118,7 +106,7 @@ class MetricsComputer:
                 error_callback=functools.partial(self.log_job_error, job),
             )
         except Exception as e:
-            self._failed.append(job)
+            self._store.put(job, "failed")
             api_model_eval_update(job.model_id, job.dataset_name, "failed")
             logger.error(
                 f"Couldn't start the final evaluation for {job}."
@@ -128,8 +116,6 @@ class MetricsComputer:
             self.dump()
             return
 
-        self._computing.append(job)
-        api_model_eval_update(job.model_id, job.dataset_name, "evaluating")
         self.dump()
 
     def find_next_ready_job(self) -> Optional[Job]:
@@ -137,15 +123,10 @@ class MetricsComputer:
 
         Returns None if none of the job are ready.
 
-        Note: the job returned doesn't belong anymore to any of the internal lists
-        and need to be added back (eg by passing it to `compute_one_async`)
+        Note: the job returned stays in the waiting queue until it's passed to
+        `compute_one_async` or `compute_one_blocking`.
         """
-        n = len(self._waiting)
-        traversed = 0
-        while self._waiting and traversed < n:
-            job = self._waiting.pop(0)
-            traversed += 1
-
+        for job in self._store.get("waiting"):
             score_entry = api_get_next_job_score_entry(job.to_dict())
 
             if job.perturb_prefix and (
@@ -156,38 +137,41 @@ class MetricsComputer:
                     f"Haven't received original evaluation for {job.job_name}. "
                     f"Postpone computation."
                 )
-                self._waiting.append(job)
                 api_model_eval_update(job.model_id, job.dataset_name, "evaluating")
             else:
-                self.dump()
                 return job
         return None
 
-    def get_jobs(self, status="Failed"):
-        if status == "Failed":
-            return self._failed
-        elif status == "Computing":
-            return self._computing
-        elif status == "Waiting":
-            return self._waiting
-        else:
-            raise NotImplementedError(f"Scheduler does not maintain {status} queue")
+    def _queue(self, status):
+        if status not in ("Waiting", "Computing", "Failed"):
+            raise NotImplementedError(f"Computer does not maintain {status} queue")
+        return status.lower()
+
+    def get_jobs(self, status="Failed", model_ids=None):
+        return self._store.get(self._queue(status), model_ids=model_ids)
+
+    def discard_jobs(self, jobs):
+        for job in jobs:
+            self._store.remove(job)
 
     def get_status(self) -> dict:
         return {
-            "computing": self._computing,
-            "waiting": self._waiting,
-            "failed": self._failed,
+            "computing": self._store.get("computing"),
+            "waiting": self._store.get("waiting"),
+            "failed": self._store.get("failed"),
+        }
+
+    def get_queue_depths(self) -> dict:
+        counts = self._store.counts()
+        return {
+            queue: counts.get(queue, 0) for queue in ("waiting", "computing", "failed")
         }
 
     def dump(self):
-        # dump status to pre-specified path
-        status = self.get_status()
+        # The store is updated on every transition, this only logs a summary
+        depths = self.get_queue_depths()
         logger.info(
-            f"Computer status: \n"
-            + f"waiting jobs: {[job.job_name for job in status['waiting']]}\n"
-            + f"computing jobs: {[job.job_name for job in status['computing']]}\n"
-            + f"failed jobs: {[job.job_name for job in status['failed']]}"
+            f"Computer status: {depths['waiting']} waiting, "
+            + f"{depths['computing']} computing, "
+            + f"{depths['failed']} failed jobs"
         )
-        pickle.dump(status, open(self._status_dump, "wb"))
-        print(f"Computer dumped status to {self._status_dump}")
@@ -4,26 +4,33 @@
 
 import logging
 import math
-import pickle
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
 import botocore
+from botocore.config import Config
 from dateutil.tz import tzlocal
 
 from models.model import DeploymentStatusEnum, ModelModel
 from utils.helpers import (
     generate_job_name,
-    process_aws_metrics,
+    get_metric_averages,
     round_end_dt,
     round_start_dt,
     update_evaluation_status,
 )
+from utils.job_store import JobStore
 
 
 logger = logging.getLogger("evaluator")
 
+# Retries throttled calls, and slows down all the calls of a client while AWS
+# keeps throttling it.
+AWS_CLIENT_CONFIG = Config(retries={"mode": "adaptive", "max_attempts": 10})
+
 
 class Job:
     TEMP_JOB_NAME_SUFFIX = "???"
@@ -54,16 +61,14 @@ class Job:
 class JobScheduler:
     def __init__(self, config, datasets):
         self.config = config
-        self._status_dump = config["scheduler_status_dump"]
-        (
-            self._submitted,
-            self._queued,
-            self._completed,
-            self._failed,
-        ) = self._load_status()
+        self._store = JobStore(
+            config["scheduler_job_store"], config.get("scheduler_status_dump")
+        )
         self.max_submission = config["max_submission"]
         self.datasets = datasets
         self._clients = {"sagemaker": {}, "logs": {}, "cloudwatch": {}}
+        self._clients_lock = threading.Lock()
+        self.status_update_workers = config.get("status_update_workers", 16)
         self.cloudwatch_namespace = "/aws/sagemaker/TransformJobs"
         self._last_submission = 0
 
@@ -71,42 +76,31 @@ class JobScheduler:
         """Returns the corresponding client for a dataset.
 
         There is one client per region and not all datasets are in the same region.
+        Clients are shared by the threads of update_status, and back off on their
+        own when AWS throttles them.
         """
         dataset = self.datasets[dataset_name]
         assert kind in self._clients
-        task = dataset.task
-
-        if task not in self._clients[kind]:
-            region = task.aws_region
-            self._clients[kind][task] = boto3.client(
-                kind,
-                aws_access_key_id=self.config["aws_access_key_id"],
-                aws_secret_access_key=self.config["aws_secret_access_key"],
-                region_name=region,
-            )
+        region = dataset.task.aws_region
 
-        return self._clients[kind][task]
+        with self._clients_lock:
+            if region not in self._clients[kind]:
+                self._clients[kind][region] = boto3.client(
+                    kind,
+                    aws_access_key_id=self.config["aws_access_key_id"],
+                    aws_secret_access_key=self.config["aws_secret_access_key"],
+                    region_name=region,
+                    config=AWS_CLIENT_CONFIG,
+                )
 
-    def _load_status(self):
-        try:
-            status = pickle.load(open(self._status_dump, "rb"))
-            logger.info(f"Load existing status from {self._status_dump}.")
-            return (
-                status.get("submitted", []),
-                status.get("queued", []),
-                status.get("completed", []),
-                status.get("failed", []),
-            )
-        except FileNotFoundError:
-            logger.info("No existing scheduler status found. Re-initializing...")
-            return [], [], [], []
+        return self._clients[kind][region]
 
     def enqueue(self, model_id, dataset_name, perturb_prefix=None, dump=True):
         # create batch transform job and
         # update the inprogress queue
         job = Job(model_id, dataset_name, perturb_prefix)
         if self.is_predictions_upload(model_id):
-            self._completed.append(job)
+            self._store.put(job, "completed")
             # Although the job is completed here, scores still need to be calculated,
             # so the status is still "evaluating"
             logger.info(
@@ -115,7 +109,7 @@ class JobScheduler:
                 + f"real model"
             )
         else:
-            self._queued.append(job)
+            self._store.put(job, "queued")
             logger.info(f"Queued {job.job_name} for submission")
         update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
 
@@ -159,7 +153,7 @@ class JobScheduler:
                 logger.warning(
                     f"Requeueing job {job.job_name} due to AWS limit exceeds: {ex}"
                 )
-                self._queued.append(job)
+                self._store.put(job, "queued")
                 update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
                 return False
             except sagemaker.exceptions.ResourceInUse as ex:
@@ -167,7 +161,7 @@ class JobScheduler:
                     f"Job {job.job_name} already submitted. Re-computing the metrics."
                 )
                 logger.debug(f"{ex}")
-                self._submitted.append(job)
+                self._store.put(job, "submitted")
                 update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
                 return True
             except botocore.exceptions.ClientError as ex:
@@ -177,7 +171,7 @@ class JobScheduler:
                         f"due to AWS throttling"
                     )
                     logger.debug(f"{ex}")
-                    self._queued.append(job)
+                    self._store.put(job, "queued")
                     update_evaluation_status(
                         job.model_id, job.dataset_name, "evaluating"
                     )
@@ -186,30 +180,32 @@ class JobScheduler:
                     logger.exception(
                         f"Exception in submitting job {job.job_name}: {ex}"
                     )
-                    self._failed.append(job)
+                    self._store.put(job, "failed")
                     update_evaluation_status(job.model_id, job.dataset_name, "failed")
                 return False
             except Exception as ex:
                 logger.exception(f"Exception in submitting job {job.job_name}: {ex}")
-                self._failed.append(job)
+                self._store.put(job, "failed")
                 update_evaluation_status(job.model_id, job.dataset_name, "failed")
                 return False
             else:
                 logger.info(f"Submitted {job.job_name} for batch transform.")
-                self._submitted.append(job)
+                self._store.put(job, "submitted")
                 update_evaluation_status(job.model_id, job.dataset_name, "evaluating")
                 return True
 
         # Submit remaining jobs
-        N_to_submit = min(self.max_submission - len(self._submitted), len(self._queued))
+        # Jobs stay in the queued queue until _create_batch_transform moves them.
+        N_to_submit = self.max_submission - self._store.count("submitted")
         if N_to_submit > 0:
+            jobs = self._store.get("queued", N_to_submit)
             try:
-                for _ in range(N_to_submit):
-                    job = self._queued.pop(0)
+                for job in jobs:
                     self._set_jobname_with_unique_timestamp(job)
                     _create_batch_transform(job)
             finally:
-                self.dump()
+                if jobs:
+                    self.dump()
 
     def stop(self, job):
         try:
@@ -235,138 +231,128 @@ class JobScheduler:
                 return True
 
         logger.info("Updating status")
-        done_job_names = set()
-        for job in self._submitted:
-            if _update_job_status(job):
+        submitted = self._store.get("submitted")
+        with ThreadPoolExecutor(self.status_update_workers) as executor:
+            updated = list(executor.map(_update_job_status, submitted))
+        for job, job_updated in zip(submitted, updated):
+            if job_updated:
                 if job.status["TransformJobStatus"] != "InProgress":
                     if job.status["TransformJobStatus"] != "Completed":
-                        self._failed.append(job)
+                        self._store.put(job, "failed")
                         update_evaluation_status(
                             job.model_id, job.dataset_name, "failed"
                         )
-                        done_job_names.add(job.job_name)
+                        continue
                     elif job.perturb_prefix or round_end_dt(
                         job.status["TransformEndTime"]
                     ) < datetime.now(tzlocal()):
-                        self._completed.append(job)
+                        self._store.put(job, "completed")
                         # Although this particular job is completed here, scores
                         # still need to be calculated, so the status is now
                         # "evaluating"
                         update_evaluation_status(
                             job.model_id, job.dataset_name, "evaluating"
                         )
-                        done_job_names.add(job.job_name)
-        self._submitted = [
-            job for job in self._submitted if job.job_name not in done_job_names
-        ]
+                        continue
+                # Saves the latest status of jobs that are still running
+                self._store.put(job, "submitted")
         logger.info("Fetch metrics")
         # fetch AWS metrics for completed jobs
-        for job in self._completed:
-            if not job.aws_metrics and not job.perturb_prefix:
-                cloudwatch = self.client("cloudwatch", job.dataset_name)
-                cloudwatchlog = self.client("logs", job.dataset_name)
-                logStreams = cloudwatchlog.describe_log_streams(
-                    logGroupName=self.cloudwatch_namespace,
-                    logStreamNamePrefix=f"{job.job_name}/",
-                )["logStreams"]
-                if logStreams:
-                    hosts = set()
-                    for logStream in logStreams:
-                        if logStream["logStreamName"].count("/") == 1:
-                            hosts.add(
-                                "-".join(logStream["logStreamName"].split("-")[:-1])
-                            )  # each host is a machine instance
-                    for host in hosts:
-
-                        metrics = cloudwatch.list_metrics(
-                            Namespace=self.cloudwatch_namespace,
-                            Dimensions=[{"Name": "Host", "Value": host}],
-                        )
-                        if metrics["Metrics"]:
-                            round_start = round_start_dt(
-                                job.status["TransformStartTime"]
-                            )
-                            round_end = round_end_dt(job.status["TransformEndTime"])
-                            # Make sure to not ask more than 1440 points (API limit)
-                            period = (round_end - round_start).total_seconds() / 1440
-                            # Period must be a multiple of 60
-                            period = int(math.ceil(period / 60) * 60)
-                            period = max(60, period)
-                            for m in metrics["Metrics"]:
-                                r = cloudwatch.get_metric_statistics(
-                                    Namespace=m["Namespace"],
-                                    MetricName=m["MetricName"],
-                                    Dimensions=m["Dimensions"],
-                                    StartTime=round_start,
-                                    EndTime=round_end,
-                                    Period=period,
-                                    Statistics=["Average"],
-                                )
-                                if r["Datapoints"]:
-                                    if m["MetricName"] not in job.aws_metrics:
-                                        job.aws_metrics[m["MetricName"]] = []
-                                    job.aws_metrics[m["MetricName"]].append(
-                                        process_aws_metrics(r["Datapoints"])
-                                    )
-        # dump the updated status
+        completed = [
+            job
+            for job in self._store.get("completed")
+            if not job.aws_metrics and not job.perturb_prefix
+        ]
+        with ThreadPoolExecutor(self.status_update_workers) as executor:
+            all_aws_metrics = list(executor.map(self._fetch_aws_metrics, completed))
+        for job, aws_metrics in zip(completed, all_aws_metrics):
+            if aws_metrics:
+                job.aws_metrics = aws_metrics
+                self._store.put(job, "completed")
         self.dump()
 
+    def _fetch_aws_metrics(self, job) -> dict:
+        """Returns the average of each CloudWatch metric of each host of a job.
+
+        Runs in the threads of update_status, so it doesn't modify the job.
+        """
+        try:
+            cloudwatch = self.client("cloudwatch", job.dataset_name)
+            cloudwatchlog = self.client("logs", job.dataset_name)
+            logStreams = cloudwatchlog.describe_log_streams(
+                logGroupName=self.cloudwatch_namespace,
+                logStreamNamePrefix=f"{job.job_name}/",
+            )["logStreams"]
+            hosts = set()
+            for logStream in logStreams:
+                if logStream["logStreamName"].count("/") == 1:
+                    hosts.add(
+                        "-".join(logStream["logStreamName"].split("-")[:-1])
+                    )  # each host is a machine instance
+            if not hosts:
+                return {}
+
+            round_start = round_start_dt(job.status["TransformStartTime"])
+            round_end = round_end_dt(job.status["TransformEndTime"])
+            # Make sure to not ask more than 1440 points (API limit)
+            period = (round_end - round_start).total_seconds() / 1440
+            # Period must be a multiple of 60
+            period = int(math.ceil(period / 60) * 60)
+            period = max(60, period)
+
+            aws_metrics = {}
+            for host in hosts:
+                metrics = cloudwatch.list_metrics(
+                    Namespace=self.cloudwatch_namespace,
+                    Dimensions=[{"Name": "Host", "Value": host}],
+                )
+                if metrics["Metrics"]:
+                    for name, average in get_metric_averages(
+                        cloudwatch, metrics["Metrics"], round_start, round_end, period
+                    ):
+                        aws_metrics.setdefault(name, []).append(average)
+            return aws_metrics
+        except Exception as ex:
+            logger.exception(ex)
+            logger.info(f"Postponing fetching metrics for {job.job_name}")
+            return {}
+
+    def _queue(self, status):
+        if status not in ("Queued", "Submitted", "Completed", "Failed"):
+            raise NotImplementedError(f"Scheduler does not maintain {status} queue")
+        return status.lower()
+
     def pop_jobs(self, status, N=1):
-        def _pop_jobs(queue, N, status):
-            results = []
-            L = len(queue)
-            if L == 0:
-                logger.info(f"No {status} jobs yet. ")
-            elif N == -1:
-                results = queue
-                queue = []
-                logger.info(f"Popping all jobs out from {status} queue. ")
-            else:
-                if N > L:
-                    logger.info(
-                        f"Requested {N} but there are only {L} "
-                        f"jobs to pop from {status} queue. "
-                    )
-                    N = L
-                results = queue[:N]
-                queue = queue[N:]
-                logger.info(f"Poped {N} out of {L} jobs from {status} queue. ")
-            return results, queue
-
-        if status == "Completed":
-            jobs, self._completed = _pop_jobs(self._completed, N, status)
-        elif status == "Failed":
-            jobs, self._failed = _pop_jobs(self._failed, N, status)
-        else:
+        if status not in ("Completed", "Failed"):
             raise NotImplementedError(f"Job status {status} not supported to pop")
+        jobs = self._store.pop(self._queue(status), N)
         if jobs:
+            logger.info(f"Popped {len(jobs)} jobs from {status} queue. ")
             self.dump()
+        else:
+            logger.info(f"No {status} jobs yet. ")
         return jobs
 
-    def get_jobs(self, status="Failed"):
-        if status == "Failed":
-            return self._failed
-        elif status == "Completed":
-            return self._completed
-        elif status == "Submitted":
-            return self._submitted
-        else:
-            raise NotImplementedError(f"Scheduler does not maintain {status} queue")
+    def get_jobs(self, status="Failed", model_ids=None):
+        return self._store.get(self._queue(status), model_ids=model_ids)
 
-    def dump(self):
-        # dump status to pre-specified path
-        status = {
-            "submitted": self._submitted,
-            "queued": self._queued,
-            "completed": self._completed,
-            "failed": self._failed,
+    def discard_jobs(self, jobs):
+        for job in jobs:
+            self._store.remove(job)
+
+    def get_queue_depths(self) -> dict:
+        counts = self._store.counts()
+        return {
+            queue: counts.get(queue, 0)
+            for queue in ("queued", "submitted", "completed", "failed")
         }
+
+    def dump(self):
+        # The store is updated on every transition, this only logs a summary
+        depths = self.get_queue_depths()
         logger.info(
-            f"Scheduler status: \n"
-            + f"Running jobs: {[job.job_name for job in status['submitted']]}\n"
-            + f"Queued jobs: {[job.job_name for job in status['queued']]}\n"
-            + f"completed jobs: {[job.job_name for job in status['completed']]}\n"
-            + f"failed jobs: {[job.job_name for job in status['failed']]}"
+            f"Scheduler status: {depths['submitted']} running, "
+            + f"{depths['queued']} queued, "
+            + f"{depths['completed']} completed, "
+            + f"{depths['failed']} failed jobs"
         )
-        pickle.dump(status, open(self._status_dump, "wb"))
-        print(f"Scheduler dumped status to {self._status_dump}")
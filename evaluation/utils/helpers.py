@@ -2,12 +2,16 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import codecs
+import io
 import json
+import math
 import os
+import re
 import sys
-import tempfile
+import threading
 from datetime import datetime, timedelta
-from typing import List
+from typing import Iterable, Iterator, List
 
 import boto3
 import requests
@@ -15,7 +19,9 @@ import ujson
 
 import common.helpers as util
 from eval_config import eval_config
-from models.model import ModelModel
+from metrics.instance_property import instance_property
+from models.dataset import DatasetModel
+from models.model_dataset_evaluation_status import ModelDatasetEvaluationStatusModel
 
 
 sys.path.append("../api")  # noqa
@@ -40,18 +46,84 @@ def generate_job_name(
     return prefix[: 63 - len(suffix)] + suffix
 
 
+# Used to pick batch transform parameters for tasks that set them to "auto".
+EXAMPLES_PER_TRANSFORM_INSTANCE = 50000
+MAX_AUTO_TRANSFORM_INSTANCE_COUNT = 4
+AUTO_MAX_PAYLOAD_IN_MB = 1
+
+
+def get_auto_batch_transform_params(n_examples, instance_type):
+    """Picks batch transform parameters for a dataset of n_examples.
+
+    Records are sent in MultiRecord mini-batches of at most AUTO_MAX_PAYLOAD_IN_MB,
+    with one concurrent transform per GPU (or per CPU on CPU instances), and one
+    instance per EXAMPLES_PER_TRANSFORM_INSTANCE examples, up to
+    MAX_AUTO_TRANSFORM_INSTANCE_COUNT.
+    """
+    instance_config = instance_property.get(instance_type, {})
+    n_workers = instance_config.get("gpu_count") or instance_config.get("cpu_count")
+    return {
+        "batch_strategy": "MultiRecord",
+        "max_payload_in_mb": AUTO_MAX_PAYLOAD_IN_MB,
+        "max_concurrent_transforms": max(1, n_workers or 1),
+        "instance_count": min(
+            MAX_AUTO_TRANSFORM_INSTANCE_COUNT,
+            max(1, math.ceil(n_examples / EXAMPLES_PER_TRANSFORM_INSTANCE)),
+        ),
+    }
+
+
+# Evaluation statuses set while buffering is on, as {(mid, dataset name): status}.
+# Only the last status set for a model and dataset is written when flushing.
+_evaluation_status_buffer = None
+_evaluation_status_lock = threading.Lock()
+
+
+def buffer_evaluation_statuses():
+    """Makes update_evaluation_status buffer its updates until the next call to
+    flush_evaluation_statuses, instead of writing each of them to the db."""
+    global _evaluation_status_buffer
+    with _evaluation_status_lock:
+        if _evaluation_status_buffer is None:
+            _evaluation_status_buffer = {}
+
+
 def update_evaluation_status(mid, dataset_name, evaluation_status):
-    mm = ModelModel()
-    model = mm.get(mid)
-    if model.evaluation_status_json:
-        eval_statuses = json.loads(model.evaluation_status_json)
-    else:
-        eval_statuses = {}
-    eval_statuses[dataset_name] = evaluation_status
-    model.evaluation_status_json = json.dumps(eval_statuses)
-    mm.dbs.add(model)
-    mm.dbs.flush()
-    mm.dbs.commit()
+    with _evaluation_status_lock:
+        if _evaluation_status_buffer is not None:
+            _evaluation_status_buffer[(mid, dataset_name)] = evaluation_status
+            return
+    write_evaluation_statuses({(mid, dataset_name): evaluation_status})
+
+
+def flush_evaluation_statuses():
+    """Writes the buffered evaluation statuses, in a single statement."""
+    global _evaluation_status_buffer
+    with _evaluation_status_lock:
+        if not _evaluation_status_buffer:
+            return
+        statuses, _evaluation_status_buffer = _evaluation_status_buffer, {}
+    try:
+        write_evaluation_statuses(statuses)
+    except Exception:
+        # Keep the statuses for the next flush, unless they changed since
+        with _evaluation_status_lock:
+            if _evaluation_status_buffer is not None:
+                _evaluation_status_buffer = {**statuses, **_evaluation_status_buffer}
+        raise
+
+
+def write_evaluation_statuses(statuses):
+    """Upserts evaluation statuses given as {(mid, dataset name): status}."""
+    dataset_ids = DatasetModel().getIdsByNames(
+        {dataset_name for _, dataset_name in statuses}
+    )
+    mid_did_to_status = {
+        (mid, dataset_ids[dataset_name]): status
+        for (mid, dataset_name), status in statuses.items()
+        if dataset_name in dataset_ids
+    }
+    ModelDatasetEvaluationStatusModel().bulkUpsert(mid_did_to_status)
 
 
 def get_predictions_s3_path(endpoint_name, task_code, dataset_name):
@@ -231,11 +303,54 @@ def round_start_dt(dt, delta=60, offset=1):
     return floor.replace(tzinfo=dt.tzinfo) - timedelta(seconds=offset)
 
 
-def process_aws_metrics(datapoints):
+# get_metric_data accepts at most 500 queries per call
+MAX_METRIC_DATA_QUERIES = 500
+
+
+def get_metric_averages(cloudwatch, metrics, start_time, end_time, period):
     """
-    Datapoints are a list of dictionaries with exactly the same keys
+    Returns (metric name, average) for each of the given metrics (as returned by
+    list_metrics) that has datapoints in the time range. The average is taken over
+    the per-period averages, and all the metrics are fetched with get_metric_data
+    rather than with one get_metric_statistics call each.
     """
-    return sum([data["Average"] for data in datapoints]) / len(datapoints)
+    queries = [
+        {
+            "Id": f"m{i}",
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": m["Namespace"],
+                    "MetricName": m["MetricName"],
+                    "Dimensions": m["Dimensions"],
+                },
+                "Period": period,
+                "Stat": "Average",
+            },
+            "ReturnData": True,
+        }
+        for i, m in enumerate(metrics)
+    ]
+    values = {}
+    for start in range(0, len(queries), MAX_METRIC_DATA_QUERIES):
+        kwargs = {
+            "MetricDataQueries": queries[start : start + MAX_METRIC_DATA_QUERIES],
+            "StartTime": start_time,
+            "EndTime": end_time,
+        }
+        while True:
+            r = cloudwatch.get_metric_data(**kwargs)
+            for result in r["MetricDataResults"]:
+                values.setdefault(result["Id"], []).extend(result["Values"])
+            if not r.get("NextToken"):
+                break
+            kwargs["NextToken"] = r["NextToken"]
+
+    averages = []
+    for i, m in enumerate(metrics):
+        metric_values = values.get(f"m{i}")
+        if metric_values:
+            averages.append((m["MetricName"], sum(metric_values) / len(metric_values)))
+    return averages
 
 
 def get_perturb_prefix(dataset_name, datasets):
@@ -284,53 +399,107 @@ def update_metadata_json_string(original_json_string, new_json_string_list):
     return metadata_json_string
 
 
-def parse_s3_outfile(s3_client, s3_uri: str) -> List[dict]:
-    """Download raw predictions/dataset file from S3 and parse it.
+# Size of the chunks read from and written to S3 when streaming files
+S3_READ_CHUNK_SIZE = 1024 * 1024
+# S3 requires all the parts of a multipart upload but the last one to be >= 5MB
+S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_s3_outfile(s3_client, s3_uri: str) -> Iterator[dict]:
+    """Stream raw predictions/dataset file from S3 and yield its records.
 
-    We parse batch transform output by balancing brackets,
-    since torchserve outputs pretty printed json by default
+    The file is either in .jsonl format, or a sequence of pretty printed json
+    objects, since torchserve outputs pretty printed json by default. Both are
+    parsed with an incremental decoder over the response body, so only the
+    records being parsed are held in memory.
     """
     raw_s3_bucket, raw_s3_path = parse_s3_uri(s3_uri)
-    fd, local_file = tempfile.mkstemp(suffix=raw_s3_path.split("/")[-1])
-    s3_client.download_file(raw_s3_bucket, raw_s3_path, local_file)
-    os.close(fd)
-
-    data = []
-    json_lines = True
-    with open(local_file) as f:
-        tmp = ""
-        lb = 0
-        for line in f:
-            if not (line.startswith("{") and line.endswith("}\n")):
-                json_lines = False
-            if json_lines:
-                # One json per line
-                data.append(json.loads(line))
-                continue
-            line = line.strip()
-            if line.startswith("{") or line.endswith("{"):
-                lb += 1
-            elif line.startswith("}") or line.endswith("}"):
-                lb -= 1
-            if lb == 0 and tmp:
-                tmp += line
-                data.append(json.loads(tmp))
-                tmp = ""
-            elif line:
-                tmp += line
-    os.remove(local_file)
-    return data
-
-
-def upload_predictions(s3_client, s3_uri: str, predictions: List[dict]) -> None:
+    body = s3_client.get_object(Bucket=raw_s3_bucket, Key=raw_s3_path)["Body"]
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    json_decoder = json.JSONDecoder()
+    buf = ""
+    chunks = body.iter_chunks(S3_READ_CHUNK_SIZE)
+    eof = False
+    while not eof:
+        try:
+            buf += utf8_decoder.decode(next(chunks))
+        except StopIteration:
+            buf += utf8_decoder.decode(b"", final=True)
+            eof = True
+        pos = 0
+        while True:
+            match = _JSON_WHITESPACE.match(buf, pos)
+            pos = match.end()
+            if pos == len(buf):
+                break
+            try:
+                record, end = json_decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The record is split across chunks
+                break
+            if end == len(buf) and not eof:
+                # A number could still go on in the next chunk
+                break
+            yield record
+            pos = end
+        buf = buf[pos:]
+
+
+def parse_s3_outfile(s3_client, s3_uri: str) -> List[dict]:
+    """Download raw predictions/dataset file from S3 and parse it."""
+    return list(iter_s3_outfile(s3_client, s3_uri))
+
+
+def upload_predictions(s3_client, s3_uri: str, predictions: Iterable[dict]) -> None:
+    """Upload predictions in .jsonl format, streaming them in a multipart upload.
+
+    Files that fit in a single part are uploaded with a plain put_object.
+    """
     s3_bucket, s3_path = parse_s3_uri(s3_uri)
-    fd, parsed_pred_file = tempfile.mkstemp(suffix=s3_uri.split("/")[-1] + ".parsed")
-    with open(parsed_pred_file, "w") as f:
+    upload_id = None
+    parts = []
+    buf = io.BytesIO()
+
+    def upload_part():
+        response = s3_client.upload_part(
+            Bucket=s3_bucket,
+            Key=s3_path,
+            UploadId=upload_id,
+            PartNumber=len(parts) + 1,
+            Body=buf.getvalue(),
+        )
+        parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+
+    try:
         for pred in predictions:
-            f.write(json.dumps(pred) + "\n")
-    s3_client.upload_file(parsed_pred_file, s3_bucket, s3_path)
-    os.close(fd)
-    os.remove(parsed_pred_file)
+            buf.write((json.dumps(pred) + "\n").encode("utf-8"))
+            if buf.tell() >= S3_MULTIPART_CHUNK_SIZE:
+                if upload_id is None:
+                    upload_id = s3_client.create_multipart_upload(
+                        Bucket=s3_bucket, Key=s3_path
+                    )["UploadId"]
+                upload_part()
+                buf = io.BytesIO()
+        if upload_id is None:
+            s3_client.put_object(Bucket=s3_bucket, Key=s3_path, Body=buf.getvalue())
+            return
+        if buf.tell():
+            upload_part()
+        s3_client.complete_multipart_upload(
+            Bucket=s3_bucket,
+            Key=s3_path,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(
+                Bucket=s3_bucket, Key=s3_path, UploadId=upload_id
+            )
+        raise
 
 
 # Decentralized Eaas Helpers
@@ -0,0 +1,180 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+
+logger = logging.getLogger("job_store")
+
+
+class JobStore:
+    """Durable store for the jobs of the scheduler and of the metrics computer.
+
+    Each job is a row of a SQLite database, together with the name of the queue
+    it is currently in. Moving a job from one queue to another is a single
+    transaction, and queues are read through an index on (queue, position), so
+    the cost of an operation doesn't depend on how many jobs are in other queues.
+    Within a queue, jobs are returned in the order they were put in it.
+
+    The job objects handed out by the store are cached by row, so the same job
+    is always represented by the same object in a given process. This allows
+    callers to pass back jobs that they got from the store, eg to move them to
+    another queue, without the jobs having to carry their row id.
+    """
+
+    def __init__(self, path: str, legacy_dump: str = None):
+        self.path = path
+        # Metrics are reported from the callback thread of the process pool
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    job_name TEXT NOT NULL,
+                    model_id INTEGER,
+                    payload BLOB NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_queue_position "
+                "ON jobs (queue, position)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_position ON jobs (position)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_model_id ON jobs (model_id, queue)"
+            )
+        self._jobs = {}  # row id -> job
+        self._row_ids = {}  # id(job) -> row id
+        if legacy_dump:
+            self._import_legacy_dump(legacy_dump)
+
+    def _import_legacy_dump(self, legacy_dump: str) -> None:
+        """Imports the queues pickled by previous versions of the evaluation server.
+
+        The dump is renamed once imported, so that this only happens once.
+        """
+        if not os.path.exists(legacy_dump):
+            return
+        with open(legacy_dump, "rb") as f:
+            status = pickle.load(f)
+        with self._lock, self._conn:
+            for queue, jobs in status.items():
+                for job in jobs:
+                    self._insert(job, queue)
+        os.rename(legacy_dump, legacy_dump + ".imported")
+        logger.info(f"Imported legacy status from {legacy_dump} into {self.path}")
+
+    def _register(self, row_id: int, payload: bytes):
+        job = self._jobs.get(row_id)
+        if job is None:
+            job = pickle.loads(payload)
+            self._jobs[row_id] = job
+            self._row_ids[id(job)] = row_id
+        return job
+
+    def _unregister(self, row_id: int) -> None:
+        job = self._jobs.pop(row_id, None)
+        if job is not None:
+            del self._row_ids[id(job)]
+
+    def _insert(self, job, queue: str) -> None:
+        cursor = self._conn.execute(
+            """
+            INSERT INTO jobs (queue, position, job_name, model_id, payload)
+            VALUES (?, (SELECT COALESCE(MAX(position), 0) + 1 FROM jobs), ?, ?, ?)
+            """,
+            (queue, job.job_name, job.model_id, pickle.dumps(job)),
+        )
+        self._jobs[cursor.lastrowid] = job
+        self._row_ids[id(job)] = cursor.lastrowid
+
+    def put(self, job, queue: str) -> None:
+        """Saves the job in the given queue.
+
+        If the job is already in another queue, it's moved to the end of the given
+        one. If it's already in the given queue, it keeps its place and only its
+        content is updated.
+        """
+        with self._lock, self._conn:
+            row_id = self._row_ids.get(id(job))
+            if row_id is None:
+                self._insert(job, queue)
+                return
+            self._conn.execute(
+                """
+                UPDATE jobs SET
+                    position = CASE WHEN queue = ? THEN position
+                        ELSE (SELECT MAX(position) + 1 FROM jobs) END,
+                    queue = ?,
+                    job_name = ?,
+                    payload = ?
+                WHERE id = ?
+                """,
+                (queue, queue, job.job_name, pickle.dumps(job), row_id),
+            )
+
+    def remove(self, job) -> None:
+        """Removes the job from the store, if it's there."""
+        with self._lock, self._conn:
+            row_id = self._row_ids.get(id(job))
+            if row_id is not None:
+                self._conn.execute("DELETE FROM jobs WHERE id = ?", (row_id,))
+                self._unregister(row_id)
+
+    def get(self, queue: str, limit: int = -1, model_ids=None) -> list:
+        """Returns the jobs of a queue, in order, optionally only for some models."""
+        query = "SELECT id, payload FROM jobs WHERE queue = ?"
+        params = [queue]
+        if model_ids is not None:
+            model_ids = list(model_ids)
+            query += f" AND model_id IN ({', '.join('?' * len(model_ids))})"
+            params.extend(model_ids)
+        query += " ORDER BY position LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+            return [self._register(row_id, payload) for row_id, payload in rows]
+
+    def pop(self, queue: str, limit: int = -1) -> list:
+        """Removes the first jobs of a queue from the store and returns them."""
+        with self._lock, self._conn:
+            jobs = self.get(queue, limit)
+            for job in jobs:
+                row_id = self._row_ids[id(job)]
+                self._conn.execute("DELETE FROM jobs WHERE id = ?", (row_id,))
+                self._unregister(row_id)
+            return jobs
+
+    def move_all(self, from_queue: str, to_queue: str) -> int:
+        """Moves all the jobs of a queue to another one, keeping their order."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET queue = ? WHERE queue = ?", (to_queue, from_queue)
+            )
+            return cursor.rowcount
+
+    def count(self, queue: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE queue = ?", (queue,)
+            ).fetchone()[0]
+
+    def counts(self) -> dict:
+        with self._lock:
+            return dict(
+                self._conn.execute(
+                    "SELECT queue, COUNT(*) FROM jobs GROUP BY queue"
+                ).fetchall()
+            )
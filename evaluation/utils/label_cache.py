@@ -0,0 +1,143 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import collections
+import glob
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from utils.columnar import columnar_available, read_records, write_records
+
+
+logger = logging.getLogger("label_cache")
+
+
+@functools.lru_cache()
+def _code_of(function) -> str:
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return getattr(function, "__qualname__", repr(function))
+
+
+def converter_fingerprint(converter, converter_config: str = "") -> str:
+    """Identifies what the converted labels depend on: the code of the converter,
+    and the config it reads, eg the task config."""
+    code = _code_of(getattr(converter, "__func__", converter))
+    content = code + "\0" + converter_config
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+class LabelCache:
+    """Cache of the dataset files read from S3 to compute metrics.
+
+    Files are downloaded once in `cache_dir`, under a name derived from their S3
+    location and ETag, so re-uploading a dataset invalidates its cached copy. The
+    directory can be shared by several processes, eg the processes of the pool
+    computing metrics. On top of this, each process keeps the last
+    `max_entries` converted label lists in memory.
+
+    When pyarrow is installed, the converted labels are also saved next to the
+    downloaded file in parquet format, so other processes memory map them
+    instead of parsing and converting the .jsonl file again. Converted labels
+    are keyed by the fingerprint of the converter and of its config too, so
+    changing either converts the file again.
+
+    Every lookup checks the ETag of the file on S3 with a HEAD request, which is
+    much cheaper than downloading it again.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 8):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._labels = collections.OrderedDict()
+
+    def _local_path_prefix(self, bucket: str, key: str) -> str:
+        digest = hashlib.sha1(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _write_atomically(self, path: str, write) -> None:
+        """Calls write(tmp_path), then moves the file to path, so other processes
+        never see a partially written file."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _download(self, s3_client, bucket: str, key: str, etag: str) -> str:
+        """Returns the local copy of the file with the given ETag, downloading it
+        and removing the copies of its previous versions if needed."""
+        prefix = self._local_path_prefix(bucket, key)
+        path = f"{prefix}-{etag}.jsonl"
+        if os.path.exists(path):
+            return path
+        self._write_atomically(
+            path, lambda tmp_path: s3_client.download_file(bucket, key, tmp_path)
+        )
+        logger.info(f"Downloaded s3://{bucket}/{key} to {path}")
+        for stale_path in glob.glob(f"{prefix}-*"):
+            if not stale_path.startswith((f"{prefix}-{etag}.", f"{prefix}-{etag}-")):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    # Another process sharing the cache removed it first
+                    pass
+        return path
+
+    def get(
+        self, s3_client, bucket: str, key: str, converter, converter_config: str = ""
+    ) -> list:
+        """Returns the examples of a .jsonl file on S3, converted by `converter`.
+
+        `converter_config` is whatever else the converted labels depend on, eg the
+        task config, as a string.
+        """
+        etag = s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+        fingerprint = converter_fingerprint(converter, converter_config)
+        cache_key = (bucket, key, etag, fingerprint)
+        with self._lock:
+            labels = self._labels.get(cache_key)
+            if labels is not None:
+                self._labels.move_to_end(cache_key)
+                return list(labels)
+
+        columnar_path = (
+            f"{self._local_path_prefix(bucket, key)}-{etag}-{fingerprint}.parquet"
+        )
+        if columnar_available() and os.path.exists(columnar_path):
+            labels = read_records(columnar_path)
+        else:
+            path = self._download(s3_client, bucket, key, etag)
+            with open(path) as f:
+                labels = [converter(json.loads(line)) for line in f]
+            if columnar_available() and labels:
+                self._write_atomically(
+                    columnar_path, lambda tmp_path: write_records(labels, tmp_path)
+                )
+
+        with self._lock:
+            self._labels[cache_key] = labels
+            while len(self._labels) > self.max_entries:
+                self._labels.popitem(last=False)
+        return list(labels)
+
+    def clear(self) -> None:
+        """Drops the label lists kept in memory.
+
+        Files on disk don't need to be dropped since they are keyed by ETag.
+        """
+        with self._lock:
+            self._labels.clear()
@@ -4,9 +4,9 @@
 
 import logging
 
-import yaml
-
 from common.config import config
+from common.task_config import get_task_config
+from datasets.common import label_cache
 from models.dataset import DatasetModel
 from models.model import DeploymentStatusEnum, ModelModel
 from utils.computer import MetricsComputer
@@ -59,6 +59,19 @@ class Requester:
     def submit(self):
         self.scheduler.submit()
 
+    def set_datasets(self, datasets):
+        """Switches to newly loaded datasets, keeping the jobs that are in flight."""
+        self.datasets = datasets
+        self.scheduler.datasets = datasets
+        self.computer.set_datasets(datasets)
+        label_cache.clear()
+
+    def get_queue_depths(self) -> dict:
+        return {
+            "scheduler": self.scheduler.get_queue_depths(),
+            "computer": self.computer.get_queue_depths(),
+        }
+
     def _eval_model_on_dataset(self, model_id, dataset_name):
         """
         evaluate a given model on given datasets
@@ -76,13 +89,7 @@ class Requester:
             self.scheduler.enqueue(model_id, dataset_name, perturb_prefix, dump=False)
             if not perturb_prefix:
                 dataset = self.datasets[dataset_name]
-                delta_metric_types = [
-                    obj["type"]
-                    for obj in yaml.load(dataset.task.config_yaml).get(
-                        "delta_metrics", []
-                    )
-                ]
-                for prefix in delta_metric_types:
+                for prefix in get_task_config(dataset.task).delta_metric_types:
                     if dataset.dataset_available_on_s3(prefix):
                         self.scheduler.enqueue(
                             model_id, dataset_name, prefix, dump=False
@@ -137,49 +144,32 @@ class Requester:
 
         failed_models = set()
         mm = ModelModel()
-        remaining_failed_job_ids = []
-        for i, job in enumerate(self.scheduler._failed):
+        algorithm_error_jobs = []
+        for job in self.scheduler.get_jobs(status="Failed"):
             if job.status and job.status.get("FailureReason", "").startswith(
                 "AlgorithmError"
             ):
                 failed_models.add(job.model_id)
-            else:
-                remaining_failed_job_ids.append(i)
+                algorithm_error_jobs.append(job)
 
         if failed_models:
-            remaining_queued_job_ids = []
-            remaining_submitted_job_ids = []
-            remaining_evaluating_job_ids = []
             for mid in failed_models:
                 mm.update(mid, deployment_status=DeploymentStatusEnum.failed)
                 send_takedown_model_request(model_id=mid, config=config, logger=logger)
-                for i, job in enumerate(self.scheduler._queued):
-                    if job.model_id != mid:
-                        remaining_queued_job_ids.append(i)
-
-                for i, job in enumerate(self.scheduler._submitted):
-                    if job.model_id == mid:
-                        self.scheduler.stop(job)
-                    else:
-                        remaining_submitted_job_ids.append(i)
-
-                for i, job in enumerate(self.computer._computing):
-                    if job.model_id != mid:
-                        remaining_evaluating_job_ids.append(i)
-
-            self.scheduler._queued = [
-                self.scheduler._queued[i] for i in remaining_queued_job_ids
-            ]
-            self.scheduler._submitted = [
-                self.scheduler._submitted[i] for i in remaining_submitted_job_ids
-            ]
-            self.computer._computing = [
-                self.computer._computing[i] for i in remaining_evaluating_job_ids
-            ]
-
-            self.scheduler._failed = [
-                self.scheduler._failed[i] for i in remaining_failed_job_ids
-            ]
+
+            submitted_jobs = self.scheduler.get_jobs(
+                status="Submitted", model_ids=failed_models
+            )
+            for job in submitted_jobs:
+                self.scheduler.stop(job)
+            self.scheduler.discard_jobs(
+                self.scheduler.get_jobs(status="Queued", model_ids=failed_models)
+                + submitted_jobs
+                + algorithm_error_jobs
+            )
+            self.computer.discard_jobs(
+                self.computer.get_jobs(status="Computing", model_ids=failed_models)
+            )
 
             self.scheduler.dump()
             self.computer.dump()
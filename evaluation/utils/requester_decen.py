@@ -4,8 +4,7 @@
 
 import logging
 
-import yaml
-
+from common.task_config import get_task_config
 from utils.computer_decen import MetricsComputer
 from utils.evaluator_decen import JobScheduler
 from utils.helpers import (
@@ -78,13 +77,7 @@ class Requester:
             self.scheduler.enqueue(model_id, dataset_name, perturb_prefix, dump=False)
             if not perturb_prefix:
                 dataset = self.datasets[dataset_name]
-                delta_metric_types = [
-                    obj["type"]
-                    for obj in yaml.load(dataset.task.config_yaml, yaml.SafeLoader).get(
-                        "delta_metrics", []
-                    )
-                ]
-                for prefix in delta_metric_types:
+                for prefix in get_task_config(dataset.task).delta_metric_types:
                     if dataset.dataset_available_on_s3(prefix):
                         self.scheduler.enqueue(
                             model_id, dataset_name, prefix, dump=False
@@ -124,51 +117,34 @@ class Requester:
 
         failed_models = set()
         # mm = ModelModel()
-        remaining_failed_job_ids = []
-        for i, job in enumerate(self.scheduler._failed):
+        algorithm_error_jobs = []
+        for job in self.scheduler.get_jobs(status="Failed"):
             if job.status and job.status.get("FailureReason", "").startswith(
                 "AlgorithmError"
             ):
                 failed_models.add(job.model_id)
-            else:
-                remaining_failed_job_ids.append(i)
+                algorithm_error_jobs.append(job)
 
         if failed_models:
-            remaining_queued_job_ids = []
-            remaining_submitted_job_ids = []
-            remaining_evaluating_job_ids = []
             for mid in failed_models:
                 api_model_update(mid, "completed")
                 send_takedown_model_request(
                     model_id=mid, config=self.config, logger=logger, decen=True
                 )
-                for i, job in enumerate(self.scheduler._queued):
-                    if job.model_id != mid:
-                        remaining_queued_job_ids.append(i)
-
-                for i, job in enumerate(self.scheduler._submitted):
-                    if job.model_id == mid:
-                        self.scheduler.stop(job)
-                    else:
-                        remaining_submitted_job_ids.append(i)
-
-                for i, job in enumerate(self.computer._computing):
-                    if job.model_id != mid:
-                        remaining_evaluating_job_ids.append(i)
-
-            self.scheduler._queued = [
-                self.scheduler._queued[i] for i in remaining_queued_job_ids
-            ]
-            self.scheduler._submitted = [
-                self.scheduler._submitted[i] for i in remaining_submitted_job_ids
-            ]
-            self.computer._computing = [
-                self.computer._computing[i] for i in remaining_evaluating_job_ids
-            ]
-
-            self.scheduler._failed = [
-                self.scheduler._failed[i] for i in remaining_failed_job_ids
-            ]
+
+            submitted_jobs = self.scheduler.get_jobs(
+                status="Submitted", model_ids=failed_models
+            )
+            for job in submitted_jobs:
+                self.scheduler.stop(job)
+            self.scheduler.discard_jobs(
+                self.scheduler.get_jobs(status="Queued", model_ids=failed_models)
+                + submitted_jobs
+                + algorithm_error_jobs
+            )
+            self.computer.discard_jobs(
+                self.computer.get_jobs(status="Computing", model_ids=failed_models)
+            )
 
             self.scheduler.dump()
             self.computer.dump()
@@ -41,6 +41,120 @@ def check_fields(data, fields):
     return True
 
 
+def get_request_bodies(request):
+    """
+    Returns the bodies of a single TorchServe request, and whether the request was
+    in jsonlines format. Requests are usually a single json object, but SageMaker
+    batch transforms with the MultiRecord batch strategy send several records in
+    one request, one per line.
+    """
+    body = request.get("body")
+    if body is None:
+        body = request.get("data")
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode("utf-8")
+    if isinstance(body, str):
+        return [json.loads(line) for line in body.splitlines() if line.strip()], True
+    if not body:
+        raise AttributeError("No body found in the request")
+    return [body], False
+
+
+class BatchInferenceHandler:
+    """
+    Mixin for handlers that run every request of a TorchServe batch (and every
+    record of a MultiRecord request) through a single forward pass, instead of
+    only looking at data[0]. Handlers implement:
+
+    - preprocess_item(body), which checks a single request body and returns
+      whatever inference_batch needs for it.
+    - inference_batch(items), which returns one output per item, in order.
+    - postprocess_item(output, item), which returns the signed response.
+    - is_insight(item) and insight_item(item), for requests that ask for word
+      importances. These are handled one at a time.
+
+    Errors only fail the request that caused them. If the forward pass of the
+    whole batch fails, the items are retried one by one.
+    """
+
+    def is_insight(self, item):
+        return False
+
+    def insight_item(self, item):
+        raise NotImplementedError
+
+    def handle_batch(self, data):
+        """
+        Returns one response per request in data, in order.
+        """
+        responses = [[None] for _ in data]
+        is_multi_record = [False] * len(data)
+        batch_indices = []
+        batch_items = []
+        for request_index, request in enumerate(data):
+            try:
+                bodies, is_multi_record[request_index] = get_request_bodies(request)
+            except Exception as ex:
+                logger.exception(ex)
+                responses[request_index] = [self.error_response(ex)]
+                continue
+            responses[request_index] = [None] * len(bodies)
+            for record_index, body in enumerate(bodies):
+                try:
+                    item = self.preprocess_item(body)
+                    if self.is_insight(item):
+                        response = self.insight_item(item)
+                        responses[request_index][record_index] = response
+                    else:
+                        batch_indices.append((request_index, record_index))
+                        batch_items.append(item)
+                except Exception as ex:
+                    logger.exception(ex)
+                    responses[request_index][record_index] = self.error_response(ex)
+
+        for (request_index, record_index), item, output in zip(
+            batch_indices, batch_items, self._batch_outputs(batch_items)
+        ):
+            try:
+                if isinstance(output, Exception):
+                    raise output
+                response = self.postprocess_item(output, item)
+            except Exception as ex:
+                logger.exception(ex)
+                response = self.error_response(ex)
+            responses[request_index][record_index] = response
+
+        return [
+            "\n".join(json.dumps(response) for response in request_responses)
+            if multi_record
+            else request_responses[0]
+            for request_responses, multi_record in zip(responses, is_multi_record)
+        ]
+
+    def _batch_outputs(self, items):
+        if not items:
+            return []
+        try:
+            outputs = self.inference_batch(items)
+            assert len(outputs) == len(items)
+            return outputs
+        except Exception as ex:
+            if len(items) == 1:
+                return [ex]
+            logger.exception(ex)
+        outputs = []
+        for item in items:
+            try:
+                outputs.extend(self.inference_batch([item]))
+            except Exception as ex:
+                outputs.append(ex)
+        return outputs
+
+    @staticmethod
+    def error_response(ex):
+        return {"status": "failed", "error": str(ex)}
+
+
 def handler_initialize(ctx):
     """
     This functions initializes the variables neccessary for the handler
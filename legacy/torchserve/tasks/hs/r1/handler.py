@@ -2,7 +2,6 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import json
 import logging
 import os
 
@@ -18,6 +17,7 @@ from ts.torch_handler.base_handler import BaseHandler
 
 from settings import my_secret
 from shared import (
+    BatchInferenceHandler,
     captum_sequence_forward,
     check_fields,
     construct_input_ref,
@@ -31,7 +31,7 @@ from shared import (
 logger = logging.getLogger(__name__)
 
 
-class TransformersSeqClassifierHandler(BaseHandler):
+class TransformersSeqClassifierHandler(BatchInferenceHandler, BaseHandler):
     """
     Transformers handler class for sequence classification
     """
@@ -83,67 +83,64 @@ class TransformersSeqClassifierHandler(BaseHandler):
         )
         self.initialized = True
 
-    def preprocess(self, data):
+    def preprocess_item(self, body):
         """
         Basic text preprocessing
         """
-        max_length = self.setup_config["max_length"]
-        logger.info("In preprocess, data's value: '%s'", data)
-
-        body = data[0]["body"]
-        if not body:
-            raise AttributeError("No body found in the request")
+        logger.info("In preprocess, body's value: '%s'", body)
 
         # Checks if the request contains the necessary attributes
         attribute_list = ["context", "hypothesis", "insight"]
         check_fields(body, attribute_list)
 
-        context = body["context"]
-        input_text = body["hypothesis"]
         insight = body["insight"]
         target = 0
         if insight:
             target = body["target"]
-        logger.info("In preprocess, body's value: '%s'", body)
-        logger.info("In preprocess, context's value: '%s'", context)
-        logger.info("In preprocess, hypothesis's value: '%s'", input_text)
+        return {
+            "input_text": body["hypothesis"],
+            "context": body["context"],
+            "insight": insight,
+            "target": target,
+        }
+
+    def inference_batch(self, items):
+        """
+        Predict the class (or classes) of the received texts using the serialized \
+        transformers checkpoint, with a single forward pass for all of them.
+        """
+        max_length = self.setup_config["max_length"]
         # preprocessing text for sequence_classification and
         # token_classification.
         batch_encoding = self.tokenizer.batch_encode_plus(
-            [input_text], max_length=int(max_length), pad_to_max_length=True
+            [item["input_text"] for item in items],
+            max_length=int(max_length),
+            pad_to_max_length=True,
+        )
+        input_ids = torch.tensor(
+            batch_encoding["input_ids"], dtype=torch.long, device=self.device
         )
-        input_ids = torch.tensor(batch_encoding["input_ids"], dtype=torch.long)
         attention_mask = torch.tensor(
-            batch_encoding["attention_mask"], dtype=torch.long
+            batch_encoding["attention_mask"], dtype=torch.long, device=self.device
         )
 
-        return input_text, input_ids, attention_mask, context, insight, target
-
-    def inference(self, inputs, attention_mask):
-        """
-        Predict the class (or classes) of the received text using the serialized \
-        transformers checkpoint.
-        """
         # Handling inference for sequence_classification.
         self.model.eval()
         with torch.no_grad():
-            logger.info("Received text: '%s'", inputs)
-            outputs = self.model(inputs, attention_mask)
-            logger.info("Outputs of model: '%s'", outputs)
-            predictions = F.softmax(outputs[0], dim=1).squeeze()
-            predictions = predictions.numpy().tolist()
+            outputs = self.model(input_ids, attention_mask)
+            predictions = F.softmax(outputs[0], dim=1).cpu().numpy().tolist()
             logger.info("Model predictions: %s", predictions)
 
         return predictions
 
-    def postprocess(self, inference_output, data, contx):
+    def postprocess_item(self, inference_output, item):
         """
         Post-processing of the model predictions to handle signature
         """
         # The input text and the output probabilities are concatenated to
         # generate signature
         pred_str = "|".join(str(x) for x in inference_output)
-        stringlist = [pred_str, data]
+        stringlist = [pred_str, item["input_text"]]
         response = {}
 
         response["prob"] = inference_output
@@ -151,8 +148,20 @@ class TransformersSeqClassifierHandler(BaseHandler):
             self.my_task_id, self.my_round_id, my_secret, stringlist
         )
         logger.info("response before json '%s'", response)
-        js = json.dumps(response)
-        return eval("[" + js + "]")
+        return response
+
+    def is_insight(self, item):
+        return item["insight"]
+
+    def insight_item(self, item):
+        return get_insights(
+            item["input_text"],
+            item["target"],
+            self.tokenizer,
+            self.device,
+            self.lig,
+            self.model,
+        )[0]
 
 
 _service = TransformersSeqClassifierHandler()
@@ -200,27 +209,6 @@ def handle(data, context):
         if data is None:
             return None
 
-        (
-            input_text,
-            inputs,
-            attention_mask,
-            contx,
-            insight,
-            target,
-        ) = _service.preprocess(data)
-        if not insight:
-            output = _service.inference(inputs, attention_mask)
-            response = _service.postprocess(output, input_text, contx)
-            return response
-        else:
-            response = get_insights(
-                input_text,
-                target,
-                _service.tokenizer,
-                _service.device,
-                _service.lig,
-                _service.model,
-            )
-            return response
+        return _service.handle_batch(data)
     except Exception as e:
         raise e
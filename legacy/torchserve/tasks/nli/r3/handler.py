@@ -17,6 +17,7 @@ from data_utils.readers.roberta_nli_reader import RoBertaNLIReader
 from roberta_model.nli_training import RoBertaSeqClassification
 from settings import my_secret
 from shared import (
+    BatchInferenceHandler,
     captum_nli_forward_func,
     check_fields,
     generate_response_signature,
@@ -31,7 +32,7 @@ logger = logging.getLogger(__name__)
 sys.path.append("/home/model-server/anli/src")
 
 
-class NliTransformerHandler(BaseHandler):
+class NliTransformerHandler(BatchInferenceHandler, BaseHandler):
     """
     Transformers handler class for NLI.
     """
@@ -101,15 +102,11 @@ class NliTransformerHandler(BaseHandler):
         )
         self.initialized = True
 
-    def preprocess(self, data):
+    def preprocess_item(self, body):
         """
         Basic text preprocessing, based on the user's chocie of application mode.
         """
-        logger.info("--------------- Preprocess satge 1 ------------------- ")
-        logger.info(f"In preprocess, Recieved data '{data}'")
-        body = data[0]["body"]
-        if not body:
-            raise AttributeError("No 'body' found in the request")
+        logger.info(f"In preprocess, Recieved body '{body}'")
         # Checks if the request contains the necessary attributes
         attribute_list = ["context", "hypothesis", "insight"]
         check_fields(body, attribute_list)
@@ -123,59 +120,68 @@ class NliTransformerHandler(BaseHandler):
         example = {"s1": context.strip(), "s2": hypothesis.strip()}
         example["y"] = "h"
         example["uid"] = str(uuid.uuid4())
-        # logger.info(f"In preprocess , example: '{example}'")
         # Generate tokens
         input_ids = self.cs_reader.read([example])[0]
-        paired_sequence = (
-            torch.Tensor(input_ids["paired_sequence"].array).long().unsqueeze(0)
-        )
-        paired_segments_ids = (
-            torch.Tensor(input_ids["paired_segments_ids"].array).long().unsqueeze(0)
-        )
-        attention_mask = (
-            torch.Tensor(input_ids["paired_mask"].array).long().unsqueeze(0)
-        )
 
-        return (
-            input_ids,
-            example,
-            insight,
-            target,
-            paired_sequence,
-            paired_segments_ids,
-            attention_mask,
-        )
-
-    def inference(
-        self, paired_sequence, paired_segments_ids, attention_mask, input_ids
-    ):
-        """Predict the class (or classes) of the received text
-        using the serialized transformers checkpoint.
+        return {
+            "input_ids": input_ids,
+            "example": example,
+            "insight": insight,
+            "target": target,
+        }
+
+    def inference_batch(self, items):
+        """Predict the class (or classes) of the received texts using the
+        serialized transformers checkpoint, with a single forward pass for all of
+        them. Sequences are padded to the longest one in the batch.
         """
         id2label = {0: "e", 1: "n", 2: "c"}
-        self.model.eval()
-        output = self.model(
-            input_ids=paired_sequence,
-            attention_mask=attention_mask,
-            token_type_ids=paired_segments_ids,
-            mode=RoBertaSeqClassification.ForwardMode.EVAL,
-        )
-
-        result = dict()
-        result["uid"] = input_ids["uid"].metadata
-        result["fid"] = input_ids["fid"].metadata
-        result["element"] = input_ids["item"].metadata
-        result["predicted_label"] = id2label[int(torch.max(output, 1)[1])]
-        result["logits"] = output.tolist()
-        result["prob"] = F.softmax(output, dim=1).squeeze(0).tolist()
-
-        print("----------------- Inference returns -------------------", result)
-        return result
+        sequences = [item["input_ids"]["paired_sequence"].array for item in items]
+        segments_ids = [
+            item["input_ids"]["paired_segments_ids"].array for item in items
+        ]
+        masks = [item["input_ids"]["paired_mask"].array for item in items]
+        max_l = max(len(sequence) for sequence in sequences)
+        pad_index = self.cur_roberta.task.source_dictionary.pad()
+
+        def pad(arrays, value):
+            return torch.tensor(
+                [array.tolist() + [value] * (max_l - len(array)) for array in arrays],
+                dtype=torch.long,
+                device=self.device,
+            )
 
-    def postprocess(self, inference_output, data):
+        self.model.eval()
+        with torch.no_grad():
+            output = self.model(
+                input_ids=pad(sequences, pad_index),
+                attention_mask=pad(masks, 0),
+                token_type_ids=pad(segments_ids, 0),
+                mode=RoBertaSeqClassification.ForwardMode.EVAL,
+            )
+        output = output.cpu()
+        probs = F.softmax(output, dim=1)
+
+        results = []
+        for index, item in enumerate(items):
+            input_ids = item["input_ids"]
+            result = dict()
+            result["uid"] = input_ids["uid"].metadata
+            result["fid"] = input_ids["fid"].metadata
+            result["element"] = input_ids["item"].metadata
+            result["predicted_label"] = id2label[int(torch.argmax(output[index]))]
+            result["logits"] = output[index : index + 1].tolist()
+            result["prob"] = probs[index].tolist()
+            results.append(result)
+
+        logger.info(f"Inference returns {results}")
+        return results
+
+    def postprocess_item(self, inference_output, item):
         """
         Post-processing of the model predictions to handle signature
         """
+        data = item["example"]
         # The input and the output probabilities are concatenated to generate
         # signature
         pred_str = "|".join(str(x) for x in inference_output["prob"])
@@ -190,9 +196,26 @@ class NliTransformerHandler(BaseHandler):
         inference_output["signed"] = generate_response_signature(
             self.my_task_id, self.my_round_id, my_secret, stringlist
         )
-        logger.info(inference_output)
         logger.info(f"response before json '{inference_output}'")
-        return [inference_output]
+        return inference_output
+
+    def is_insight(self, item):
+        return item["insight"]
+
+    def insight_item(self, item):
+        input_ids = item["input_ids"]
+        paired_sequence = (
+            torch.Tensor(input_ids["paired_sequence"].array).long().unsqueeze(0)
+        )
+        paired_segments_ids = (
+            torch.Tensor(input_ids["paired_segments_ids"].array).long().unsqueeze(0)
+        )
+        attention_mask = (
+            torch.Tensor(input_ids["paired_mask"].array).long().unsqueeze(0)
+        )
+        return get_insights(
+            paired_sequence, paired_segments_ids, attention_mask, item["target"], self
+        )[0]
 
 
 _service = NliTransformerHandler()
@@ -250,24 +273,7 @@ def handle(data, context):
 
         if data is None:
             return None
-        (
-            input_ids,
-            input_text,
-            insight,
-            target,
-            paired_sequence,
-            paired_segments_ids,
-            attention_mask,
-        ) = _service.preprocess(data)
-        if insight:
-            response = get_insights(
-                paired_sequence, paired_segments_ids, attention_mask, target, _service
-            )
-        else:
-            output = _service.inference(
-                paired_sequence, paired_segments_ids, attention_mask, input_ids
-            )
-            response = _service.postprocess(output, input_text)
+        response = _service.handle_batch(data)
         logger.info(response)
 
         return response
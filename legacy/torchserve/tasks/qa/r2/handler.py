@@ -19,6 +19,7 @@ from ts.torch_handler.base_handler import BaseHandler
 from qa_utils import compute_predictions_logits, convert_to_squad_example
 from settings import my_secret
 from shared import (
+    BatchInferenceHandler,
     captum_qa_forward,
     check_fields,
     construct_input_ref_pair,
@@ -46,7 +47,7 @@ QA_CONFIG = {
 }
 
 
-class TransformersQAHandler(BaseHandler):
+class TransformersQAHandler(BatchInferenceHandler, BaseHandler):
     """
     Transformers handler class for question answering
     """
@@ -95,14 +96,10 @@ class TransformersQAHandler(BaseHandler):
         )
         self.initialized = True
 
-    def preprocess(self, data):
+    def preprocess_item(self, body):
         """
         Basic text preprocessing
         """
-        logger.info("In preprocess, data's value: '%s'", data)
-        body = data[0]["body"]
-        if not body:
-            raise AttributeError("No body found in the request")
         # Checks if the request contains the necessary attributes
         attribute_list = ["answer", "context", "hypothesis", "insight"]
         check_fields(body, attribute_list)
@@ -122,7 +119,18 @@ class TransformersQAHandler(BaseHandler):
 
         example = {"passage": passage.strip(), "question": question.strip()}
 
-        return [example], answer, insight, compute_end_importances
+        return {
+            "example": example,
+            "answer": answer,
+            "insight": insight,
+            "compute_end_importances": compute_end_importances,
+        }
+
+    def is_insight(self, item):
+        return item["insight"]
+
+    def insight_item(self, item):
+        return self.inspect([item["example"]], item["compute_end_importances"])[0]
 
     def inspect(self, example, compute_end_importances):
         """
@@ -171,11 +179,12 @@ class TransformersQAHandler(BaseHandler):
         response["words"] = all_tokens
         return [response]
 
-    def inference(self, examples):
+    def inference_batch(self, items):
         """
-        Predict the class (or classes) of the received text using the serialized
-        transformers checkpoint.
+        Predict the answers to the received questions using the serialized
+        transformers checkpoint, batching the features of all of them.
         """
+        examples = [item["example"] for item in items]
 
         def to_list(tensor):
             return tensor.detach().cpu().tolist()
@@ -207,7 +216,6 @@ class TransformersQAHandler(BaseHandler):
             )
 
             all_results = []
-            predictions = {}
 
             for batch in eval_dataloader:
                 inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
@@ -225,37 +233,38 @@ class TransformersQAHandler(BaseHandler):
 
                     all_results.append(result)
 
-                batch_predictions = compute_predictions_logits(
-                    examples,
-                    features,
-                    all_results,
-                    QA_CONFIG["n_best_per_passage_size"],
-                    QA_CONFIG["max_answer_length"],
-                    QA_CONFIG["do_lower_case"],
-                    None,
-                    None,
-                    None,
-                    False,
-                    False,
-                    0.0,
-                    self.tokenizer,
-                )
-                predictions.update(batch_predictions)
+            # Predictions need the results of every feature of an example, and
+            # examples can have features in more than one batch.
+            predictions = compute_predictions_logits(
+                examples,
+                features,
+                all_results,
+                QA_CONFIG["n_best_per_passage_size"],
+                QA_CONFIG["max_answer_length"],
+                QA_CONFIG["do_lower_case"],
+                None,
+                None,
+                None,
+                False,
+                False,
+                0.0,
+                self.tokenizer,
+            )
 
             predictions_by_examples = [predictions[ex.qas_id] for ex in examples]
-            predictions_by_example = predictions_by_examples[0]
             logger.info(
-                "predictions_by_example at the end of inference %s",
-                predictions_by_example,
+                "predictions_by_examples at the end of inference %s",
+                predictions_by_examples,
             )
-            return predictions_by_example
+            return predictions_by_examples
 
-    def postprocess(self, predictions_by_example, example, answer):
+    def postprocess_item(self, predictions_by_example, item):
         """
         Post-processing of the model predictions to handle signature
         """
-        contx = example[0]["passage"]
-        data = example[0]["question"]
+        contx = item["example"]["passage"]
+        data = item["example"]["question"]
+        answer = item["answer"]
         response = {}
 
         logger.info("response without sign '%s'", response)
@@ -283,7 +292,7 @@ class TransformersQAHandler(BaseHandler):
         )
         logger.info("response before return '%s'", response)
 
-        return [response]
+        return response
 
 
 _service = TransformersQAHandler()
@@ -307,14 +316,7 @@ def handle(data, context):
         if data is None:
             return None
 
-        example, answer, insight, compute_end_importances = _service.preprocess(data)
-        if not insight:
-            predictions_by_example = _service.inference(example)
-            response = _service.postprocess(predictions_by_example, example, answer)
-            return response
-        else:
-            response = _service.inspect(example, compute_end_importances)
-            return response
+        return _service.handle_batch(data)
 
     except Exception as e:
         raise e